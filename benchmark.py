@@ -0,0 +1,374 @@
+"""
+Замеры скорости конвертации (convert_adoc.py и convert_docstrings.py) на синтетических документах
+
+Настоящих документов Julia в репозитории нет, поэтому скрипт сам генерирует дерево документов в стиле вывода Kramdoc
+(папки base, manual, stdlib, devdocs и index.adoc) и пары файлов docstrings в новом и старом форматах.
+Количество и размер файлов, а также доля блоков кода, блоков Admonition, ссылок и математических выражений
+задаются параметрами. Сгенерированные документы хранятся в BENCH_DIR и генерируются заново только при изменении параметров.
+
+Замеряются этапы:
+adoc_tree_full - конвертация всего дерева (convert_tree, --full)
+adoc_tree_incremental - повторный запуск по неизмененному дереву (все файлы пропускаются по манифесту)
+adoc_texts - конвертация тех же документов в памяти (convert_texts)
+docstring_index - разбор файлов нового формата (docstring_index.py, без кэша)
+docstrings_batch - пакетная конвертация пар файлов docstrings (convert_batch, без кэша)
+Каждый этап выполняется REPEAT раз, берется лучшее время. По каждому этапу выводится файлов/с и МБ/с.
+
+Результаты можно сохранить как базовые (--save-baseline) в BASELINE_FILE, отдельно для каждого набора параметров.
+При следующих запусках с теми же параметрами скорость сравнивается с базовой, и если какой-то этап стал медленнее,
+чем TOLERANCE от базовой скорости, он помечается REGRESSION, а скрипт завершается с кодом 1.
+
+Примеры:
+python benchmark.py --save-baseline
+python benchmark.py --files 1000 --size 64K --math 0.5
+python benchmark.py --files 10 --size 10M --stages adoc_tree_full adoc_texts
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import contextlib
+
+import convert_adoc
+import convert_docstrings
+from docstring_index import load_index
+
+# НАСТРОЙКИ
+
+# Папка для сгенерированных документов и результатов конвертации
+BENCH_DIR = './benchmark_data'
+# Файл с базовыми результатами
+BASELINE_FILE = 'benchmark_baseline.json'
+# Количество документов adoc и их примерный размер в байтах
+FILES = 100
+FILE_SIZE = 16 * 1024
+# Количество пар файлов docstrings (размер файла - тот же FILE_SIZE)
+DOCSTRING_FILES = 10
+# Доли блоков кода и блоков Admonition среди всех блоков документа
+CODE_DENSITY = 0.15
+ADMONITION_DENSITY = 0.05
+# Доли абзацев со ссылками (xref, link) и с математическими выражениями ($...$)
+XREF_DENSITY = 0.3
+MATH_DENSITY = 0.2
+# Начальное значение генератора случайных чисел (одни и те же параметры - одни и те же документы)
+SEED = 1
+# Количество процессов для конвертации
+JOBS = 1
+# Сколько раз повторять каждый этап (берется лучшее время)
+REPEAT = 3
+# Этап считается регрессией, если его скорость (МБ/с) меньше этой доли от базовой
+TOLERANCE = 0.8
+
+STAGES = ('adoc_tree_full', 'adoc_tree_incremental', 'adoc_texts', 'docstring_index', 'docstrings_batch')
+
+
+# ГЕНЕРАЦИЯ ДОКУМЕНТОВ
+
+WORDS = ('array', 'function', 'returns', 'value', 'the', 'of', 'a', 'for', 'index', 'string', 'type', 'method',
+         'collection', 'element', 'iterator', 'is', 'and', 'with', 'number', 'integer', 'float', 'given', 'if',
+         'otherwise', 'see', 'also', 'keyword', 'argument', 'default', 'dimension', 'matrix', 'vector', 'to', 'in')
+NAMES = ('push!', 'pop!', 'sort', 'map', 'filter', 'reduce', 'open', 'close', 'read', 'write', 'show', 'parse',
+         'getindex', 'setindex!', 'length', 'similar', 'zeros', 'ones', 'reshape', 'convert', 'promote')
+
+# Имена из списков translated, toclevel_pages и правил с ограничением по путям, чтобы такие правила тоже выполнялись
+SPECIAL_FILES = ('base/punctuation.adoc', 'base/arrays.adoc', 'base/io-network.adoc', 'base/c.adoc',
+                 'base/parallel.adoc', 'manual/documentation.adoc', 'stdlib/Markdown.adoc', 'stdlib/Dates.adoc')
+FOLDERS = ('base', 'manual', 'stdlib', 'devdocs')
+
+
+def sentence(rng, words=12):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize() + '.'
+
+# Абзац текста, в который с заданными долями вставляются ссылки, сноски и математические выражения
+def paragraph(rng, params):
+    parts = [sentence(rng, rng.randint(6, 20)) for _ in range(rng.randint(1, 4))]
+    if rng.random() < params['xrefs']:
+        name = rng.choice(NAMES)
+        parts.insert(rng.randint(0, len(parts)), rng.choice((
+            'See link:../base/collections.md#Base.' + name + '[`' + name + '`].',
+            'See xref:./base.adoc#Base.' + name + '[`' + name + '`] and link:./strings.md[strings].',
+            'Go [here](https://docs.julialang.org/en/v1/base/' + name + ') now.',
+            'footnote:[see `' + name + '(x)` \\] for details]')))
+    if rng.random() < params['math']:
+        parts.insert(rng.randint(0, len(parts)), 'The value $x^{%d} + \\alpha$ is used -- see $n$.' % rng.randint(1, 9))
+    return ' '.join(parts) + '\n\n'
+
+def code_block(rng):
+    lines = ['julia> ' + rng.choice(NAMES) + '([1, 2, 3])' for _ in range(rng.randint(1, 6))]
+    lines.append('# cost is $x $y -- not math')
+    return '[source,julia]\n----\n' + '\n'.join(lines) + '\n----\n\n'
+
+def admonition(rng):
+    text = sentence(rng)
+    return rng.choice((
+        '!!! compat "Julia 1.%d"\n    %s\n\n' % (rng.randint(3, 9), text),
+        '!!! note\n    %s\n\n' % text,
+        '!!! warning\n    %s\n\n' % text,
+        '!!! tip\n    %s\n\n' % text,
+        '[NOTE]\n====\n%s\n====\n\n' % text))
+
+# Блок описания функции так, как его выводит Kramdoc (якоря, заголовок docstring, таблица)
+def docstring_block(rng):
+    name = rng.choice(NAMES)
+    return ('+++<a id="Base.%s-1">++++++</a>+++\n\n<<Base.%s,#>>\n*`Base.%s`* &mdash; _Function_.\n\n'
+            '|===\n| x | y\n|===\n\n' % (name, name, name))
+
+# Документ в стиле вывода Kramdoc размером примерно size байт
+def generate_adoc(rng, title, size, params):
+    blocks = [':doctype: book\n\n+++<a id="' + title + '">++++++</a>+++\n\n= ' + title + '\n\n']
+    length = len(blocks[0])
+    while length < size:
+        r = rng.random()
+        if r < params['code']:
+            block = code_block(rng)
+        elif r < params['code'] + params['admonitions']:
+            block = admonition(rng)
+        elif rng.random() < 0.1:
+            block = docstring_block(rng)
+        else:
+            block = paragraph(rng, params)
+        blocks.append(block)
+        length += len(block)
+    return ''.join(blocks)
+
+# Пара файлов docstrings размером примерно size байт: новый формат и переведенный старый формат
+# Binding старого формата в основном совпадает с новым, частично отличается (входит в новый или новый входит в него)
+def generate_docstrings(rng, size):
+    new_blocks = ['# Docstrings\n\n']
+    old_blocks = ['# Docstrings\n\n']
+    length = 0
+    i = 0
+    while length < size:
+        name = rng.choice(NAMES) + str(i)
+        binding = 'Base.' + name
+        first = name + '(x' + ', y' * rng.randint(0, 2) + ')'
+        body = sentence(rng) + '\n\n' + sentence(rng) + '\n'
+        new_block = '"""\n    %s\n\n%s"""\n@binding: %s\n@typesig: Tuple{Any}\n\n' % (first, body, binding)
+        r = rng.random()
+        old_binding = binding if r < 0.7 else (binding + '(::Any)' if r < 0.85 else name)
+        old_blocks.append('"""\n    %s\n\nПеревод: %s"""\n%s\n\n' % (first, body, old_binding))
+        new_blocks.append(new_block)
+        length += len(new_block)
+        i += 1
+    return ''.join(new_blocks), ''.join(old_blocks)
+
+# Функция возвращает относительные пути документов: сначала особые имена, потом сгенерированные по папкам
+def adoc_paths(files):
+    paths = ['index.adoc'] + list(SPECIAL_FILES)
+    i = 0
+    while len(paths) < files:
+        folder = FOLDERS[i % len(FOLDERS)]
+        # Раскладываем по подпапкам, как в stdlib
+        paths.append('%s/part%d/page_%05d.adoc' % (folder, i // 100, i))
+        i += 1
+    return paths[:files]
+
+def write_text(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf8', newline='\n') as file:
+        file.write(text)
+
+# Функция генерирует документы в папку root, если их там еще нет для тех же параметров
+def generate_corpus(root, params):
+    params_file = os.path.join(root, 'params.json')
+    if os.path.exists(params_file):
+        with open(params_file, 'r', encoding='utf8') as file:
+            if json.load(file) == params:
+                return False
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    rng = random.Random(params['seed'])
+    for rel_path in adoc_paths(params['files']):
+        write_text(os.path.join(root, 'adoc', rel_path), generate_adoc(rng, rel_path, params['size'], params))
+    for i in range(params['docstring_files']):
+        new_text, old_text = generate_docstrings(rng, params['size'])
+        write_text(os.path.join(root, 'docstrings', 'new', 'file_%04d.md' % i), new_text)
+        write_text(os.path.join(root, 'docstrings', 'old', 'file_%04d.md' % i), old_text)
+    with open(params_file, 'w', encoding='utf8') as file:
+        json.dump(params, file)
+    return True
+
+
+# ЗАМЕРЫ
+
+def folder_size(folder):
+    count = 0
+    size = 0
+    for paths, subdirs, files in os.walk(folder):
+        for file_name in files:
+            count += 1
+            size += os.path.getsize(os.path.join(paths, file_name))
+    return count, size
+
+# Функция выполняет run() repeat раз (перед каждым разом - prepare()) и возвращает лучшее время в секундах
+def best_time(run, repeat, prepare=None):
+    best = None
+    for _ in range(repeat):
+        if prepare is not None:
+            prepare()
+        start = time.perf_counter()
+        run()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+# Функция замеряет этапы stages на документах из root. Возвращает {этап: {'files', 'bytes', 'seconds'}}
+def run_stages(root, stages, jobs, repeat):
+    adoc_dir = os.path.join(root, 'adoc')
+    output_dir = os.path.join(root, 'adoc_output')
+    new_dir = os.path.join(root, 'docstrings', 'new')
+    old_dir = os.path.join(root, 'docstrings', 'old')
+    adoc_files, adoc_bytes = folder_size(adoc_dir)
+    doc_files, doc_bytes = folder_size(new_dir)
+    old_files, old_bytes = folder_size(old_dir)
+    results = {}
+
+    def full():
+        convert_adoc.convert_tree(adoc_dir, output_dir, jobs=jobs, full=True, clean=False)
+
+    # Результат прошлого прогона удаляем вне замера: в замер входит только конвертация
+    def remove_output():
+        if os.path.exists(output_dir):
+            shutil.rmtree(output_dir)
+
+    if 'adoc_tree_full' in stages:
+        results['adoc_tree_full'] = {'files': adoc_files, 'bytes': adoc_bytes,
+                                     'seconds': best_time(full, repeat, prepare=remove_output)}
+    if 'adoc_tree_incremental' in stages:
+        if not os.path.exists(output_dir):
+            full()
+        seconds = best_time(lambda: convert_adoc.convert_tree(adoc_dir, output_dir, jobs=jobs), repeat)
+        results['adoc_tree_incremental'] = {'files': adoc_files, 'bytes': adoc_bytes, 'seconds': seconds}
+    if 'adoc_texts' in stages:
+        pairs = []
+        for source_file, target_file in convert_adoc.list_source_files(adoc_dir, output_dir,
+                                                                       convert_adoc.source_folders(adoc_dir)):
+            with open(source_file, 'r', encoding='utf8') as file:
+                pairs.append((os.path.relpath(source_file, adoc_dir), file.read()))
+        # Пул создается один раз, как в сервисе сборки
+        with convert_adoc.BatchConverter(jobs) as converter:
+            seconds = best_time(lambda: list(converter.convert(pairs)), repeat)
+        results['adoc_texts'] = {'files': adoc_files, 'bytes': adoc_bytes, 'seconds': seconds}
+    if 'docstring_index' in stages:
+        paths = [os.path.join(new_dir, name) for name in sorted(os.listdir(new_dir))]
+        seconds = best_time(lambda: [load_index(path, cache_dir=None) for path in paths], repeat)
+        results['docstring_index'] = {'files': doc_files, 'bytes': doc_bytes, 'seconds': seconds}
+    if 'docstrings_batch' in stages:
+        report_file = os.path.join(root, 'docstrings_report.json')
+        def batch():
+            # Построчный вывод по файлам в замер не выводим
+            with contextlib.redirect_stdout(io.StringIO()):
+                convert_docstrings.convert_batch(new_dir, old_dir, os.path.join(root, 'docstrings_output'),
+                                                 report_file, jobs, cache_dir=None)
+        results['docstrings_batch'] = {'files': doc_files + old_files, 'bytes': doc_bytes + old_bytes,
+                                       'seconds': best_time(batch, repeat)}
+    for result in results.values():
+        seconds = max(result['seconds'], 1e-9)
+        result['files_per_s'] = result['files'] / seconds
+        result['mb_per_s'] = result['bytes'] / seconds / 1024 / 1024
+    return results
+
+
+# БАЗОВЫЕ РЕЗУЛЬТАТЫ
+
+# Ключ набора параметров в файле базовых результатов: сравнивать можно только замеры с одинаковыми параметрами
+def baseline_key(params, jobs):
+    return ' '.join('{}={}'.format(name, params[name]) for name in sorted(params)) + ' jobs={}'.format(jobs)
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf8') as file:
+        return json.load(file)
+
+def save_baseline(path, baseline):
+    with open(path + '.tmp', 'w', encoding='utf8') as file:
+        json.dump(baseline, file, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+# Функция выводит таблицу результатов и сравнение с базовыми. Возвращает список этапов с регрессией
+def print_results(results, base, tolerance=TOLERANCE):
+    regressions = []
+    print('{:<24}{:>8}{:>10}{:>10}{:>10}{:>10}{:>12}'.format('stage', 'files', 'MB', 'seconds', 'files/s', 'MB/s',
+                                                            'vs baseline'))
+    for stage, result in results.items():
+        line = '{:<24}{:>8}{:>10.2f}{:>10.3f}{:>10.1f}{:>10.2f}'.format(
+            stage, result['files'], result['bytes'] / 1024 / 1024, result['seconds'],
+            result['files_per_s'], result['mb_per_s'])
+        if stage in base:
+            ratio = result['mb_per_s'] / max(base[stage]['mb_per_s'], 1e-9)
+            line += '{:>+11.1f}%'.format((ratio - 1) * 100)
+            if ratio < tolerance:
+                line += '  REGRESSION'
+                regressions.append(stage)
+        print(line)
+    return regressions
+
+# Функция разбирает размер вида 512, 16K, 10M
+def parse_size(text):
+    text = text.strip().upper()
+    factor = {'K': 1024, 'M': 1024 * 1024}.get(text[-1:], 1)
+    return int(float(text.rstrip('KM')) * factor)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Замеры скорости конвертации на синтетических документах')
+    parser.add_argument('--files', type=int, default=FILES, help='количество документов adoc (по умолчанию %(default)s)')
+    parser.add_argument('--size', type=parse_size, default=FILE_SIZE,
+                        help='примерный размер документа: 512, 16K, 10M (по умолчанию %(default)s байт)')
+    parser.add_argument('--docstring-files', type=int, default=DOCSTRING_FILES,
+                        help='количество пар файлов docstrings (по умолчанию %(default)s)')
+    parser.add_argument('--code', type=float, default=CODE_DENSITY, help='доля блоков кода')
+    parser.add_argument('--admonitions', type=float, default=ADMONITION_DENSITY, help='доля блоков Admonition')
+    parser.add_argument('--xrefs', type=float, default=XREF_DENSITY, help='доля абзацев со ссылками')
+    parser.add_argument('--math', type=float, default=MATH_DENSITY, help='доля абзацев с математическими выражениями')
+    parser.add_argument('--seed', type=int, default=SEED, help='начальное значение генератора случайных чисел')
+    parser.add_argument('-j', '--jobs', type=int, default=JOBS, help='количество процессов (по умолчанию %(default)s)')
+    parser.add_argument('--repeat', type=int, default=REPEAT, help='сколько раз повторять каждый этап')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES, help='какие этапы замерять')
+    parser.add_argument('--dir', default=BENCH_DIR, help='папка для сгенерированных документов')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='файл базовых результатов')
+    parser.add_argument('--save-baseline', action='store_true', help='сохранить результаты как базовые')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='регрессия - скорость меньше этой доли от базовой (по умолчанию %(default)s)')
+    args = parser.parse_args()
+
+    params = {'files': args.files, 'size': args.size, 'docstring_files': args.docstring_files,
+              'code': args.code, 'admonitions': args.admonitions, 'xrefs': args.xrefs, 'math': args.math,
+              'seed': args.seed}
+    os.makedirs(args.dir, exist_ok=True)
+    corpus = os.path.join(args.dir, 'corpus')
+    start = time.perf_counter()
+    if generate_corpus(corpus, params):
+        print('Corpus generated in {:.1f} s: {}'.format(time.perf_counter() - start, os.path.abspath(corpus)))
+
+    # Лог конвертации пишем в файл, как при обычном запуске (запись лога - часть работы конвертации)
+    logging.basicConfig(filename=os.path.join(args.dir, 'benchmark.log'), filemode='w',
+                        format='%(levelname)s %(message)s', level=logging.DEBUG)
+
+    results = run_stages(corpus, args.stages, args.jobs, args.repeat)
+    baseline = load_baseline(args.baseline)
+    key = baseline_key(params, args.jobs)
+    regressions = print_results(results, baseline.get(key, {}), args.tolerance)
+
+    if args.save_baseline:
+        baseline[key] = {stage: {'files_per_s': result['files_per_s'], 'mb_per_s': result['mb_per_s']}
+                         for stage, result in results.items()}
+        save_baseline(args.baseline, baseline)
+        print('Baseline saved: ' + args.baseline)
+    elif key not in baseline:
+        print('No baseline for these parameters (save one with --save-baseline)')
+    if regressions:
+        print('Regressions: ' + ', '.join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -12,7 +12,32 @@
 Скрипт должен лежать рядом с папкой-источником.
 
 Результат конвертации записывается в папку converted_by_adoc_converter (имя можно менять в НАСТРОЙКАХ) с сохранением разделения на подпапки. 
-В процессе записывается подробный лог в отдельный файл с именем вида convert_adoc_2023-06-05_21-55-19.log
+В процессе записывается подробный лог в отдельный файл с именем вида convert_adoc_2023-06-05_21-55-19.log,
+а рядом - тот же лог построчно в JSON (convert_adoc_2023-06-05_21-55-19.jsonl: файл, правило, количество замен, время)
+с итогами конвертации в последней записи. Какие файлы писать - LOG_FORMAT (--log-format).
+Лог пишется в фоновом потоке и не тормозит конвертацию (см. ЛОГ). Текстовый лог из JSONL:
+python convert_adoc.py --render-log convert_adoc_2023-06-05_21-55-19.jsonl
+
+Файлы конвертируются параллельно в нескольких процессах. Количество процессов задается в НАСТРОЙКАХ (JOBS)
+или параметром запуска, по умолчанию - по числу ядер процессора:
+python convert_adoc.py --jobs 4
+Каждый процесс возвращает счетчики замен по своему файлу, а лог пишется одним процессом в порядке обхода папок,
+поэтому он получается таким же, как и при конвертации в одном процессе (--jobs 1).
+
+Конвертация инкрементальная: в папке результата хранится манифест (.convert_adoc_manifest.json) с хэшами файлов-источников,
+отпечатком набора правил и попаданием файла в списки translated/toclevel_pages. Неизмененные файлы пропускаются,
+результаты удаленных файлов-источников удаляются. Сконвертировать все заново: python convert_adoc.py --full
+Каждый файл-источник читается один раз, а результат сразу пишется в папку результата (через временный файл,
+поэтому при падении скрипта не остается полусконвертированных файлов). Файлы, которые не нужно конвертировать
+(картинки и тп.), переносятся жесткими ссылками, если это возможно (настройка LINK_ASSETS).
+Если папки лежат на медленном (сетевом, синхронизируемом) диске, чтение и запись можно вынести в фоновые потоки
+(IO_THREADS, --io-threads): следующие файлы читаются заранее, а результаты пишутся через очередь пачками
+по FSYNC_BATCH файлов (--fsync-batch), поэтому конвертация не ждет диска. Объем прочитанного заранее и ждущего записи
+ограничен (PREFETCH_BYTES, WRITE_BEHIND_SIZE). На локальном диске это только замедляет, поэтому по умолчанию выключено:
+python convert_adoc.py --io-threads 4 --fsync-batch 32
+Очень большие файлы (больше STREAM_THRESHOLD, например склеенные docstrings целых пакетов) конвертируются потоково:
+читаются, конвертируются и пишутся кусками примерно по STREAM_CHUNK_SIZE байт, поэтому память не растет вместе с файлом.
+Куски режутся только по пустым строкам между абзацами вне блоков кода, так что результат тот же, что и при конвертации целиком.
 
 Основные преобразования данной конвертации подробно описаны на странице:
 https://wiki.yandex.ru/engee/dokumentacija/razrabotka-dokumentacii/julia-dokumentacija/konvertacija-iz-md-v-adoc/
@@ -29,15 +54,61 @@ https://wiki.yandex.ru/engee/dokumentacija/razrabotka-dokumentacii/julia-dokumen
 9) Заменяются двойные дефисы на длинное тире не между пробелами (Antora автоматически делает это только между пробелами)
 10) В некоторых случаях выставляется ширина столбцов таблиц (например, в документе base/punctuation.adoc)
 11) ... Некоторые другие преобразования
+
+Все преобразования заданы упорядоченным списком правил RULES (скомпилированные регулярки и замены по словарям,
+у каждого правила может быть ограничение по путям файлов). По окончании конвертации в командную строку
+выводится количество замен и время по каждому правилу,
+а также самые медленные правила и файлы. Подробную статистику (время, размер текста до и после и количество замен
+по каждому правилу в каждом файле) можно записать в JSON или CSV, чтобы сравнивать разные запуски:
+python convert_adoc.py --full --profile profile.json
+
+Регулярки, которые на испорченном выводе Kramdoc могут долго перебирать варианты (блоки Admonition, ссылки Markdown,
+шапка _index.adoc и др.), по умолчанию выполняются в устойчивом варианте с тем же результатом (HARDENED_RULES, --no-hardened).
+Кроме того, на каждый файл можно задать бюджет времени (TIME_BUDGET, --time-budget, по умолчанию выключен):
+файл, который не уложился, копируется в результат без изменений, попадает в лог и в итоговый список
+и конвертируется заново при следующем запуске. Бюджет проверяется между правилами и не прерывает саму регулярку.
+Правила, которые не могут сработать на документе (в нем нет их обязательной строки, например '!!! note' или 'link:'),
+пропускаются без выполнения регулярки (LITERAL_PREFILTER, --no-prefilter), количество пропусков выводится в статистике.
+
+Скрипт можно импортировать: при импорте ничего не конвертируется, файл лога не создается, а регулярки правил
+компилируются при первом выполнении. Конвертация дерева папок и одного текста в памяти:
+import convert_adoc
+result = convert_adoc.convert_tree('converted_by_kramdoc', 'converted_by_adoc_converter')
+text = convert_adoc.convert_text(text, 'base/punctuation.adoc')
+for rel_path, text in convert_adoc.convert_texts(pairs, jobs=4):  # пары (путь, текст), без диска
+Лог пишется в логгер 'convert_adoc' (при запуске скрипта - в файл лога).
+
+Ссылки xref в результате можно проверить сразу после конвертации, не дожидаясь сборки Antora
+(индекс страниц и якорей хранится в папке результата и обновляется только по измененным страницам, см. ПРОВЕРКА ССЫЛОК):
+python convert_adoc.py --check-xrefs
+Битые ссылки выводятся с файлом и строкой, скрипт в этом случае завершается с кодом 1.
+
+Для предпросмотра в Antora есть режим наблюдения: после конвертации скрипт следит за папкой-источником
+и сразу конвертирует измененные файлы, после чего может запустить пересборку (WATCH_HOOK):
+python convert_adoc.py --watch --hook "npx antora antora-playbook.yml"
 """
 
 import os
+import posixpath
 import re
-from distutils.dir_util import copy_tree
+import bisect
 import logging
 import sys
 from datetime import datetime
 import shutil
+import argparse
+import time
+import hashlib
+import json
+import tempfile
+import mmap
+import contextlib
+import csv
+import select
+import struct
+import threading
+import collections
+import queue
 
 # НАСТРОЙКИ
 
@@ -51,106 +122,309 @@ SOURCE_PATH = './converted_by_kramdoc'
 #SOURCE_PATH = './test_input'
 # Чистить ли папку для результата перед записью
 CLEAN_TARGET_FOLDER = False
-
-
-# Создаем файл лога в текущей папке
-cur_time = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-log_file = os.path.join('./', 'convert_adoc_' + cur_time + '.log')
-
-# Чистим файл лога, если он уже есть
-if os.path.exists(log_file):
-    os.remove(log_file)
-
-# Настройки лога
-logging.basicConfig(filename = log_file, #filemode='a', 
-                    #format='%(asctime)s %(levelname)s %(message)s',
-                    format='%(levelname)s %(message)s',
-                    datefmt='%H:%M:%S',
-                    level=logging.DEBUG)
-
-# Выводим пути источника и результата 
-logging.info('Source path: ' + str(os.path.abspath(SOURCE_PATH)))
-logging.info('Output path: ' + str(os.path.abspath(OUTPUT_FOLDER_NAME)))
-
-
-# Берем полные пути всех папок внутри SOURCE_PATH
-subfolders = [f.path for f in os.scandir(SOURCE_PATH) if (f.is_dir() or str(f.path).endswith('.adoc'))]
-# Берем имена всех папок
-subfolders_names = [os.path.basename(f) for f in subfolders]
-
-folders_found = False
-# Проверяем имена папок внутри папки-источника
-for folder in subfolders_names:
-    if folder in FOLDERS_TO_CONVERT:
-        #copy_tree(os.path.join(SOURCE_PATH, folder), os.path.join(output_path, folder))
-        folders_found = True
-
-# Если не нашли нужных папок, то выдаем сообщение и выходим
-if not folders_found:
-    logging.warning('No folders found in source folder with names from: ' + str(FOLDERS_TO_CONVERT))
-    sys.exit()
-
-# Если нашли, то начинаем конвертацию
-
-# Создаем папку для результатов конвертации
-#output_path = os.path.join(SOURCE_PATH, OUTPUT_FOLDER_NAME)
-output_path = OUTPUT_FOLDER_NAME
-if not os.path.exists(output_path):
-    os.makedirs(output_path)
-
-# Чистим ее, если она есть и настройка True
-if os.path.exists(output_path) and CLEAN_TARGET_FOLDER:
-    shutil.rmtree(output_path)
-
-# Копируем папки с их поддеревьями в папку с результатами, проверяя имена папок
-# Здесь же копируем файлы из корня (проверяя просто по расширению)
-# Файл index.adoc переименовываем в _index.adoc (так как он не будет публиковаться сам по себе)
-for folder in subfolders_names:
-    if folder in FOLDERS_TO_CONVERT:
-        if folder.endswith('.adoc'):
-            if folder == 'index.adoc':
-                shutil.copyfile(os.path.join(SOURCE_PATH, folder), os.path.join(output_path, '_index.adoc'))
-            else:
-                shutil.copyfile(os.path.join(SOURCE_PATH, folder), os.path.join(output_path, folder))
-        else:
-            copy_tree(os.path.join(SOURCE_PATH, folder), os.path.join(output_path, folder))
-
-# Функция для вывода лога 
-def log_it(message, count):
+# Количество процессов для конвертации (None - по числу ядер процессора, 1 - все в текущем процессе)
+JOBS = None
+# Конвертировать только новые и измененные файлы (по манифесту в папке результата, см. ИНКРЕМЕНТАЛЬНАЯ КОНВЕРТАЦИЯ)
+INCREMENTAL = True
+# Имя файла манифеста внутри папки с результатом
+MANIFEST_FILE_NAME = '.convert_adoc_manifest.json'
+# Переносить файлы, которые не нужно конвертировать (картинки и тп.), жесткими ссылками вместо копирования
+LINK_ASSETS = True
+# Файлы больше этого размера (в байтах) конвертируются потоково, кусками (None - всегда целиком)
+STREAM_THRESHOLD = 16 * 1024 * 1024
+# Примерный размер куска при потоковой конвертации (в байтах)
+STREAM_CHUNK_SIZE = 1024 * 1024
+# Файл для подробной статистики по правилам и файлам (.json или .csv, None - не записывать), см. ПРОФИЛИРОВАНИЕ
+PROFILE_FILE = None
+# Сколько самых медленных правил и файлов выводить в командную строку
+PROFILE_TOP = 10
+# Выполнять правила в устойчивом варианте (без долгого перебора с возвратами на испорченных документах, см. RegexRule)
+HARDENED_RULES = True
+# Сколько документов отдавать процессу за раз при конвертации в памяти (см. КОНВЕРТАЦИЯ В ПАМЯТИ)
+BATCH_SIZE = 16
+# Пропускать правила, для которых в тексте нет обязательного литерала (см. ПРЕДВАРИТЕЛЬНЫЙ ОТБОР ПРАВИЛ)
+LITERAL_PREFILTER = True
+# Фоновый ввод-вывод (см. ФОНОВЫЙ ВВОД-ВЫВОД): сколько потоков читают файлы-источники заранее и сколько пишут
+# (0 - каждый файл читается и пишется там же, где конвертируется). Для сетевых и синхронизируемых папок - например, 4
+IO_THREADS = 0
+# Сколько байт файлов-источников может быть прочитано заранее
+PREFETCH_BYTES = 64 * 1024 * 1024
+# Сколько символов результатов может ждать записи в очереди
+WRITE_BEHIND_SIZE = 64 * 1024 * 1024
+# Сколько файлов результата записывать на диск (fsync) за раз (0 - не ждать записи на диск, как на локальном диске)
+# Только вместе с IO_THREADS, для синхронизируемых папок - например, 32
+FSYNC_BATCH = 0
+# Бюджет времени на конвертацию одного файла в секундах (None - без ограничения)
+# Файл, который не уложился, копируется в результат без изменений и попадает в отчет.
+# Проверяется только между правилами, поэтому от зависшей регулярки не спасает (для этого - HARDENED_RULES)
+TIME_BUDGET = None
+# Режим наблюдения (--watch, см. РЕЖИМ НАБЛЮДЕНИЯ): период опроса папки-источника в секундах,
+# если inotify недоступен (не Linux) или отключен (--poll)
+WATCH_INTERVAL = 0.5
+# Сколько секунд после последнего изменения ждать, прежде чем конвертировать (пачка сохранений - одна конвертация)
+WATCH_DEBOUNCE = 0.2
+# Команда, которая запускается после каждой конвертации в режиме наблюдения (None - ничего не запускать),
+# например пересборка Antora: 'npx antora --fetch antora-playbook.yml'
+WATCH_HOOK = None
+# Проверять ссылки xref в папке результата после конвертации (см. ПРОВЕРКА ССЫЛОК)
+CHECK_XREFS = False
+# Имя файла индекса страниц и якорей внутри папки с результатом
+XREF_INDEX_FILE_NAME = '.convert_adoc_xrefs.json'
+# Префикс и разделитель id, которые Asciidoctor создает для заголовков разделов (атрибуты idprefix и idseparator)
+XREF_IDPREFIX = '_'
+XREF_IDSEPARATOR = '_'
+# Какие файлы лога писать при запуске скрипта: 'text' - convert_adoc_*.log, 'jsonl' - convert_adoc_*.jsonl, 'both' - оба
+LOG_FORMAT = 'both'
+
+
+# Лог пишем в логгер модуля: при запуске скрипта он попадает в файл лога (см. setup_logging),
+# а при импорте - туда, куда его направит вызывающий скрипт
+logger = logging.getLogger('convert_adoc')
+
+# Очередь фонового лога (см. setup_logging), None - лог пишется обычными записями logging построчно
+log_queue = None
+
+# Функция для записи счетчика замен по файлу (сам лог пишется потом в write_log)
+# rule - имя правила, seconds - время его выполнения на файле (для JSONL)
+def log_it(records, message, count, level=logging.INFO, rule=None, seconds=None):
     if count > 0:
-        logging.info('... ' + message + ': ' + str(count))
+        records.append((message, count, level, rule, seconds))
+
+# Функция для вывода лога по одному файлу
+# В фоновый лог весь файл уходит одной записью, строки из нее получает уже поток лога (см. log_entries)
+def write_log(norm_path, records):
+    if log_queue is not None:
+        logger.info('File: ' + str(norm_path), extra={'log_file': str(norm_path), 'log_records': records})
+        return
+    logger.info('File: ' + str(norm_path))
+    for message, count, level, rule, seconds in records:
+        logger.log(level, '... ' + message + ': ' + str(count))
+
+# Функция пишет в лог итоги конвертации (result - как у sync_tree) за seconds секунд
+# В JSONL это последняя запись, в текстовый лог она не попадает: там итоги - обычными строками
+def log_summary(result, seconds):
+    summary = {'converted': result['converted'], 'skipped': result['skipped'], 'removed': result['removed'],
+               'over_budget': len(result['over_budget']), 'seconds': round(seconds, 3),
+               'rules': {name: [stat[0], round(stat[1], 6)] for name, stat in result['rule_stats'].items()}}
+    logger.info('Summary', extra={'log_summary': summary})
+
+
+# ЛОГ
+
+# При запуске скрипта логгер пишет записи в очередь (QueueHandler), а в файлы их пишет отдельный поток
+# (QueueListener): конвертация не ждет записи на диск и не делит блокировку файла лога.
+# Лог по файлу - одна запись на файл с его счетчиками замен, пока идет конвертация, файлы лога не сбрасываются
+# на диск после каждой строки, а только когда очередь опустела.
+# Каждая запись разворачивается в структурированные записи (словари, log_entries): из них пишутся строки JSONL
+# (render_json) и текстового лога в прежнем виде 'INFO ... message: count' (render_text)
+
+# Функция возвращает структурированные записи для записи лога record:
+# {'time', 'level', 'event': 'file' | 'rule' | 'message' | 'summary', ...}
+def log_entries(record):
+    created = round(record.created, 3)
+    summary = getattr(record, 'log_summary', None)
+    if summary is not None:
+        return [dict({'time': created, 'level': record.levelname, 'event': 'summary'}, **summary)]
+    norm_path = getattr(record, 'log_file', None)
+    if norm_path is None:
+        return [{'time': created, 'level': record.levelname, 'event': 'message', 'message': record.getMessage()}]
+
+    entries = [{'time': created, 'level': record.levelname, 'event': 'file', 'file': norm_path}]
+    for message, count, level, rule, seconds in record.log_records:
+        entry = {'time': created, 'level': logging.getLevelName(level), 'event': 'rule', 'file': norm_path,
+                 'rule': rule, 'message': message, 'count': count}
+        if seconds is not None:
+            entry['seconds'] = round(seconds, 6)
+        entries.append(entry)
+    return entries
+
+# Строка текстового лога для структурированной записи (None - в текстовый лог не пишется)
+def render_text(entry):
+    event = entry['event']
+    if event == 'summary':
+        return None
+    if event == 'file':
+        text = 'File: ' + entry['file']
+    elif event == 'rule':
+        text = '... ' + entry['message'] + ': ' + str(entry['count'])
+    else:
+        text = entry['message']
+    return entry['level'] + ' ' + text
+
+def render_json(entry):
+    return json.dumps(entry, ensure_ascii=False)
+
+# Обработчик для потока лога: пишет строки render(entry) в файл и сбрасывает файл на диск,
+# только когда в очереди лога больше ничего нет
+class LogFileHandler(logging.FileHandler):
+    def __init__(self, filename, render, log_queue, encoding=None):
+        super().__init__(filename, mode='w', encoding=encoding)
+        self.render = render
+        self.queue = log_queue
+
+    def emit(self, record):
+        try:
+            for entry in log_entries(record):
+                line = self.render(entry)
+                if line is not None:
+                    self.stream.write(line + self.terminator)
+            if self.queue.empty():
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+# Функция выводит лог JSONL в текстовом виде (как convert_adoc_*.log)
+def render_log(path, out=sys.stdout):
+    with open(path, encoding='utf8') as file:
+        for line in file:
+            text = render_text(json.loads(line))
+            if text is not None:
+                out.write(text + '\n')
+
+# Регулярка, возвращающая в группе 1 блоки кода
+#code_pattern = re.compile('\[,.{1,100}\]\n----\n(?P<group1>[\s\S]*?)----')
+code_pattern = re.compile('\n----\n(?P<group1>[\s\S]*?)----')
 
 # Функция для парсинга блоков кода
-# Возвращает список спанов (по номерам строк) всех блоков кода в документе
+# Возвращает список спанов (по номерам строк) всех блоков кода в документе, отсортированный по началу
+# Номера строк считаем за один проход по документу: переводы строк считаются только между соседними спанами
 def find_code_lines(data):
-    # Регулряка, возвращающая в группе 1 блоки кода
-    #r = re.compile('\[,.{1,100}\]\n----\n(?P<group1>[\s\S]*?)----')
-    r = re.compile('\n----\n(?P<group1>[\s\S]*?)----')
-    
-    # Записываем спаны по символам
-    char_spans = []
-    for m in r.finditer(data):
-        char_spans.append(m.span(1))
-    
-    # Вычисляем спаны по строкам
     line_spans = []
-    for span in char_spans:
-        begin = data[:span[0]].count("\n")
-        end = data[:span[1]].count("\n")
-        line_spans.append((begin, end))
-        
-    return line_spans
+    pos = 0
+    line = 0
+    for m in code_pattern.finditer(data):
+        start, end = m.span(1)
+        line += data.count('\n', pos, start)
+        begin_line = line
+        line += data.count('\n', start, end)
+        line_spans.append((begin_line, line))
+        pos = end
 
-# Функция проверяет, что данный индекс находится внутри одного из спанов
-def in_spans(spans, line_index):
-    res = False
-    for span in spans:
-        if line_index >= span[0] and line_index < span[1]:
-            res = True
-    return res
+    return line_spans
 
+# Функция возвращает для каждой из line_count строк признак, что строка внутри блока кода
+# Нужна, чтобы при проходе по всем строкам документа проверять каждую строку за O(1)
+def code_line_flags(spans, line_count):
+    flags = bytearray(line_count)
+    for begin, end in spans:
+        end = min(end, line_count)
+        if begin < end:
+            flags[begin:end] = b'\x01' * (end - begin)
+    return flags
+
+
+# СТРУКТУРА ДОКУМЕНТА
+
+# Вместо того чтобы угадывать контекст в каждом правиле (блоки кода, отрицательные опережающие проверки и тп.),
+# документ один раз разбирается на области: блоки кода, блоки Admonition (====), таблицы (|===),
+# пропуски +++...+++, ссылки (xref:, link:, http(s)://...[...]), сноски (footnote:[...]) и код в строке (`...`).
+# Результат - таблица спанов по видам областей. Правило с skip_regions (см. RegexRule) пропускает совпадения,
+# которые начинаются внутри областей этих видов, проверка каждого совпадения - O(1) (см. RegionTable.checker).
+# Все области, кроме блоков кода, Admonition и таблиц, не выходят за пределы строки,
+# поэтому при потоковой конвертации (куски режутся только вне блоков кода) они находятся так же, как во всем документе
+
+# Одна регулярка на все виды областей, документ просматривается за один проход
+# Блок кода - как в code_pattern: открывающая строка '----', закрывающее - первое '----' после нее
+# Внутри ссылок и сносок учитываем экранированные символы (\]), закрывающая скобка - первая неэкранированная
+# Опережающая проверка первого символа в начале нужна для скорости: без нее на каждой позиции пробуются все варианты
+region_pattern = re.compile(r'''(?=[\n=|+fxlh`])(?:
+    (?P<code>\n----\n(?P<code_body>[\s\S]*?)----)
+  | (?P<admonition>^====$)
+  | (?P<table>^\|===$)
+  | (?P<passthrough>\+\+\+[^\n]*?\+\+\+)
+  | (?P<footnote>footnote:\[(?:\\.|[^\]\\\n])*\])
+  | (?P<xref>(?:xref:|link:|https?://)[^\s\[]*\[(?:\\.|[^\]\\\n])*\])
+  | (?P<inline_code>`[^`\n]+`)
+)''', re.MULTILINE | re.VERBOSE)
+
+REGION_KINDS = ('code', 'admonition', 'table', 'passthrough', 'footnote', 'xref', 'inline_code')
+
+# Таблица областей документа: {вид: отсортированный список непересекающихся спанов (начало, конец)}
+# Однострочные области не могут захватить '\n----\n', с которого начинается блок кода, поэтому блоки кода
+# не зависят от остальных областей. Если нужны только они (замена math), хватает быстрого поиска по code_pattern,
+# полный разбор делается только при первом запросе других видов
+class RegionTable:
+    def __init__(self, data):
+        self.data = data
+        self.spans = None
+        self.merged = {}
+
+    # Область кода - целые строки между открывающей строкой и строкой с закрывающим '----'
+    # (те же строки, что находит find_code_lines)
+    def code_span(self, start, end):
+        end = self.data.rfind('\n', start, end) + 1 or start
+        return (start, end) if start < end else None
+
+    def code_spans(self):
+        if self.spans is not None:
+            return self.spans['code']
+        spans = (self.code_span(*m.span(1)) for m in code_pattern.finditer(self.data))
+        return [span for span in spans if span]
+
+    def scan(self):
+        data = self.data
+        self.spans = {kind: [] for kind in REGION_KINDS}
+        # Начало открытых блоков Admonition и таблиц: они задаются парами одинаковых строк
+        opened = {}
+        for m in region_pattern.finditer(data):
+            kind = m.lastgroup
+            if kind in ('code', 'code_body'):
+                span = self.code_span(*m.span('code_body'))
+                if span:
+                    self.spans['code'].append(span)
+            elif kind in ('admonition', 'table'):
+                if kind in opened:
+                    self.spans[kind].append((opened.pop(kind), m.end()))
+                else:
+                    opened[kind] = m.start()
+            else:
+                self.spans[kind].append(m.span())
+
+    # Функция возвращает проверку inside(pos): находится ли позиция внутри области одного из видов kinds
+    # Позиции нужно проверять по возрастанию (как идут совпадения в re.sub), тогда каждая проверка - O(1)
+    def checker(self, kinds):
+        if kinds not in self.merged:
+            if kinds == ('code',):
+                spans = self.code_spans()
+            else:
+                if self.spans is None:
+                    self.scan()
+                spans = sorted(span for kind in kinds for span in self.spans[kind])
+            merged = []
+            for start, end in spans:
+                if merged and start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+            self.merged[kinds] = merged
+        merged = self.merged[kinds]
+        index = 0
+
+        def inside(pos):
+            nonlocal index
+            while index < len(merged) and merged[index][1] <= pos:
+                index += 1
+            return index < len(merged) and merged[index][0] <= pos
+        return inside
+
+# Области текущего текста документа. Создаются в apply_rules на каждый документ (или кусок) и передаются в правила:
+# таблица строится при первом запросе и используется, пока правила не изменили текст (см. update)
+class DocumentRegions:
+    def __init__(self, data):
+        self.data = data
+        self.table = None
+
+    # Функция вызывается после каждого правила: если текст изменился, таблица строится заново при следующем запросе
+    def update(self, data):
+        if data is not self.data:
+            self.data = data
+            self.table = None
+
+    def checker(self, kinds):
+        if self.table is None:
+            self.table = RegionTable(self.data)
+        return self.table.checker(kinds)
 
-file_count = 0
 
 # Задаем список переведенных документов. 
 # От этого будет зависеть, добавлять ли в начале плашку "в процессе перевода".
@@ -247,356 +521,2136 @@ r'```\\alpha = 1```':r'`+++``\\alpha = 1``+++`',
 '[`Int64`](../base/numbers.md#Core.Int64)':'xref:base/numbers.adoc#Core.Int64[`Int64`]'
 }
 
-# КОНВЕРТАЦИЯ
-
-# Делаем все замены во всех файлах .adoc внутри output_path 
-for paths, subdirs, files in os.walk(output_path):
-    for file_name in files:
-        full_path = os.path.join(paths, file_name)
-        # Нормализуем путь к файлу (разные слэши бывают)
-        norm_path = os.path.normpath(full_path)
-        # Проверяем, что это файл adoc
-        if norm_path.endswith('.adoc'):
-            #print(norm_path)
-
-            with open(norm_path, 'r', encoding='utf8') as file:
-                #print(norm_path)
-                data = file.read()
-                logging.info('File: ' + str(norm_path))
-                file_count += 1
-
-                # Удаляем :doctype: book в заголовке страниц
-                data_tuple = re.subn(r':doctype: book\n\n?', 
-                                     r'', 
-                                     data)
-                data = data_tuple[0]
-                log_it('Deleted :doctype: headers', data_tuple[1])
-
-                # Удаляем :pp: {plus}{plus} в заголовке страниц
-                data_tuple = re.subn(r':pp:\s{plus}{plus}\n\n?', 
-                                     r'', 
-                                     data)
-                data = data_tuple[0]
-                log_it('Deleted :pp: headers', data_tuple[1])
-
-                # Удаляем :stem: latexmath в заголовке страниц
-                data_tuple = re.subn(r':stem: latexmath\n\n?', 
-                                     r'', 
-                                     data)
-                data = data_tuple[0]
-                log_it('Deleted :stem: headers', data_tuple[1])
-
-                # Удаляем лишние якоря с постфиксом "-1"
-                data_tuple = re.subn(r'\+{3}.*?-1\">\+{6}</a>\+{3}\n\n?', 
-                                     r'', 
-                                     data)
-                data = data_tuple[0]
-                log_it('Deleted "-1" anchors', data_tuple[1])
-
-                # Меняем местами якорь и главный заголовок
-                data_tuple = re.subn(r'(?P<group1>\+{3}<a.*?a>\+{3})\n{1,3}(?P<group2>=\s.*)', 
-                                     r'\2\n\n\1', 
-                                     data)
-                data = data_tuple[0]
-                log_it('Main headers moved up', data_tuple[1])
-
-                # Добавляем в начале документа плашку, если он еще не переведен
-                if not norm_path.endswith(translated):
-                    data_tuple = re.subn(r'(?P<group1>^=\s.*\n)', 
-                                        r'\1\n[NOTE]\n====\nДокументация в процессе перевода.\n====\n', 
-                                        data)
-                    data = data_tuple[0]
-                    log_it('Added header Translation in progress', data_tuple[1])
-
-                # Заменяем заголовки разделов в docstrings
-                data_tuple = re.subn(r'<<(?P<group1>.{1,200}),#>>\n\*', 
-                                     r'[id="\1"]\n=== *', 
-                                     data)
-                data = data_tuple[0]
-                log_it('Replaced docstring headers', data_tuple[1])
-
-                # Убираем точки в заголовках разделов в docstrings
-                data_tuple = re.subn(r'\&mdash;\s_(?P<group1>.{1,50}?)_\.', 
-                                     r'— _\1_', 
-                                     data)
-                data = data_tuple[0]
-                log_it('Deleted points in docstring headers', data_tuple[1])
-
-                # Заменяем перекрестные ссылки в два этапа
-                # Этап 1
-                data_tuple = re.subn(r'link:(?P<group1>.{1,200}?).md', 
-                                     r'xref:./\1.adoc', 
-                                     data)
-                data = data_tuple[0]
-                log_it('Replaced links Part 1', data_tuple[1])
-
-                # Этап 2
-                data_tuple = re.subn(r'xref:./../', 
-                                     r'xref:', 
-                                     data)
-                data = data_tuple[0]
-                log_it('Replaced links Part 2', data_tuple[1])
-
-                # Заменяем блоки Compat
-                data_tuple = re.subn(r'!!! compat \"(?P<group1>.{1,100}?)\"\n\s{4}(?P<group2>.{1,10000}?)\n',
-                                     r'[IMPORTANT]\n.Совместимость: \1\n====\n\2\n====\n', 
-                                     data)
-                data = data_tuple[0]
-                log_it('Replaced Compat blocks', data_tuple[1])
-
-                # Заменяем блоки Note
-                data_tuple = re.subn(r'!!! note\n\s{4,5}(?P<group1>.{1,10000}?)\n',
-                                     r'[NOTE]\n====\n\1\n====\n', 
-                                     data)
-                data = data_tuple[0]
-                log_it('Replaced Note blocks', data_tuple[1])
-
-                # Заменяем блоки Warning
-                data_tuple = re.subn(r'!!! warning\n\s{4,5}(?P<group1>.{1,10000}?)\n',
-                                     r'[WARNING]\n====\n\1\n====\n', 
-                                     data)
-                data = data_tuple[0]
-                log_it('Replaced Warning blocks', data_tuple[1])
-
-                # Заменяем блоки Tip
-                data_tuple = re.subn(r'!!! tip\n\s{4,5}(?P<group1>.{1,10000}?)\n',
-                                     r'[TIP]\n====\n\1\n====\n', 
-                                     data)
-                data = data_tuple[0]
-                log_it('Replaced Tip blocks', data_tuple[1])
-
-                # Заменяем блоки sidebar (см. RTFM-682)
-                data_tuple = re.subn(r'!!! sidebar \"(?P<group1>.{1,1000}?)\"\n\s{4}(?P<group2>.{1,10000}?)\n',
-                                     r'[NOTE]\n.\1\n====\n\2\n====\n', 
-                                     data)
-                data = data_tuple[0]
-                log_it('Replaced sidebar blocks', data_tuple[1])
-                
-                # Присоединяем к блокам Note, Warning, Tip строки в четверных точках
-                data_tuple = re.subn(r'====\n\+?\n\.{4}\n(?P<group1>[\s\S]{1,10000}?)\.{4}',
-                                     r'\n\1\n====\n', 
-                                     data)
-                data = data_tuple[0]
-                log_it('Added parts in four points to admonition blocks', data_tuple[1])
-
-                # Вставляем дополнительные переносы строки для списков внутри блоков Admonition (см. RTFM-682)
-                if not norm_path.endswith('Markdown.adoc'):
-                    data_tuple = re.subn(r'\n[^\S\r\n]{2}\*[^\S\r\n]',
-                                        r'\n\n  * ', 
-                                        data)
-                    data = data_tuple[0]
-                    log_it('Added extra line breaks in lists', data_tuple[1])
-
-                # Заменяем блоки математических выражений
-                # Все что между двух $ но слева обязательно пробел! Иначе много лишних захватов
-                # Пробел, но не newline можно записать только так: [^\S\r\n]
-                """
-                data_tuple = re.subn(r'[^\S\r\n]\$(?P<group1>[^\$`\r\n]{1,100}?)\$',
-                                     r' stem:[\1]', 
-                                     data)
-                data = data_tuple[0]
-                log_it('Replaced Math blocks', data_tuple[1])
-                """
-                # Теперь делаем через цикл, чтобы не заменять в блоках с кодом
-                # Парсим текст на блоки кода
-                code_lines = find_code_lines(data)
-                #print(code_lines)
-                
-                lines_edited = []
-                data_lines = data.splitlines()
-                replace_count = 0
-                for i in range(len(data_lines)):
-                    if in_spans(code_lines, i):
-                        lines_edited.append(data_lines[i])
-                        #print('line in spans:', i)
-                    else:
-                        data_tuple = re.subn(r'[^\S\r\n]\$(?P<group1>[^\$`\r\n]{1,100}?)\$',
-                                            r' stem:[\1]', 
-                                            data_lines[i])
-                        if data_tuple[1] == 0:
-                            lines_edited.append(data_lines[i])
-                        else:
-                            lines_edited.append(data_tuple[0])
-                            replace_count += data_tuple[1]
-                # Добавляем пустую строку в конце, потому что она там была везде
-                lines_edited.append('')
-                data = '\n'.join(lines_edited)
-                log_it('Replaced Math blocks', replace_count)
-
-                # Добавляем ограничение на уровни в Contents (см. RTFM-688)
-                if norm_path.endswith(toclevel_pages):
-                    data_tuple = re.subn(r'^(?P<group1>=\s[^\s].*?\n)', 
-                                        r'\1:page-toclevels: 1\n', 
-                                        data)
-                    data = data_tuple[0]
-                    log_it('Added page-toclevels', data_tuple[1])
-
-                # Заменяем якоря с одинарными кавычками внутри (Kramdoc с таким не справляется)
-                data_tuple = re.subn(r'<a id=\'(?P<group1>.{1,1000}\'.{1,1000}?)\'></a>',
-                                     r'+++<a id="\1">++++++</a>+++', 
-                                     data)
-                data = data_tuple[0]
-                log_it('Replaced id with single quote', data_tuple[1])
-
-                # Обрамляем __текст__ в двойных подчеркиваниях в +++ (см. RTFM-536)
-                # Сначала только внутри backticks: `__FILE__` -> `+++__FILE__+++`
-                # Слева и справа может быть дополнительный текст
-                data_tuple = re.subn(r'(?P<group1>`\S{0,100}?)(?P<group2>__\S{1,100}__)(?P<group3>\S{0,100}?`)',
-                                     r'\1+++\2+++\3', 
-                                     data)
-                data = data_tuple[0]
-                log_it('Adding "+++" to text in backticks', data_tuple[1])
-
-                # Обрамляем __текст__ в двойных подчеркиваниях в +++ (см. RTFM-536)
-                # Теперь только в ссылках: xref:./base.adoc#Base.@__FILE__ -> xref:./base.adoc#Base.@+++__FILE__+++
-                # Ссылки обрабатываются раньше. Порядок замен важен!
-                data_tuple = re.subn(r'(?P<group1>xref:\S{1,100}?)(?P<group2>__\S{1,100}?__)',
-                                     r'\1+++\2+++', 
-                                     data)
-                data = data_tuple[0]
-                log_it('Adding "+++" to text in xref links', data_tuple[1])
-
-                # Заменяем двойные дефисы на длинное тире после кода неразрывного пробела 
-                # (Antora делает это только между двух обычных пробелов)
-                replace_count = data.count('&nbsp;-- ')
-                data = data.replace('&nbsp;-- ',
-                                    '&nbsp;— ')
-                log_it("Replaced two hyphens", replace_count)
-
-                # Заменяем отбитые закрывающие квадратные скобки \] на неотбитые ]
-                # Kramdoc отбивает такие скобки в некоторых контекстах, например в сносках (footnote), из-за чего они ломаются
-                # Но в ссылках (xref) эти отбивания нужны, поэтому делаем negative lookahead на сочетание )` - в ссылках только в таком контексте это встречается
-                # Это не очень честно, но по-честному нужно парсить весь текст на фрагменты внутри ссылок и внутри сносок, а это все сильно усложнит.
-                # (см. RTFM-687)
-                data_tuple = re.subn(r'\\](?!\)`)',
-                                     r']', 
-                                     data)
-                data = data_tuple[0]
-                log_it("Replaced escaped closing square brackets '\]'", data_tuple[1])
-
-                # Заменяем ссылки (внешние на http) формата Markdown на формат Asciidoc (см. RTFM-672)
-                # В некоторых блоках Kramdoc сам их не заменяет, приходится доделывать. Файл Markdown не трогаем, так как там есть такой пример на Markdown
-                if not norm_path.endswith('Markdown.adoc'):
-                    data_tuple = re.subn(r'\[(?P<group1>[^\n\r]{1,10000}?)\]\((?P<group2>http[^\n\r]{1,10000}?)\)',
-                                        r'\2[\1]', 
-                                        data)
-                    data = data_tuple[0]
-                    log_it('Replaced links from .md to .adoc', data_tuple[1])
-
-                # На странице Punctuation делаем специальные преобразования 
-                if norm_path.endswith('base\punctuation.adoc'):
-                    # Задаем относительную ширину столбцов таблицы  
-                    data_tuple = re.subn(r'\|===\n\|',
-                                        r'[cols="10%,90%"]\n|===\n|', 
-                                        data)
-                    data = data_tuple[0]
-                    log_it('Table columns width', data_tuple[1])
-
-                    # Убираем одно лишнее экранирование знака | (или)
-                    replace_count = data.count('\\\\|')
-                    data = data.replace('\\\\|', r'\|')
-                    log_it("Replaced OR '\\|'", replace_count)
-
-                    # Экранируем тильду
-                    replace_count = data.count('`~`')
-                    data = data.replace('`~`', r'`+~+`')
-                    log_it("Replaced tilde", replace_count)
-
-                    # Экранируем backticks
-                    replace_count = data.count('`` ``')
-                    data = data.replace('`` ``', r'`+++` `+++`')
-                    log_it("Escaped backticks ` `", replace_count)
-                
-                # На странице _index.adoc удаляем весь текст из шапки, оставляем только после слова "Введение"
-                if norm_path.endswith('_index.adoc'):  
-                    data_tuple = re.subn(r'[\s\S]*= Введение(?P<group1>[\s\S]*)',
-                                        r'\1', 
-                                        data)
-                    data = data_tuple[0]
-                    log_it('Deleted header in index', data_tuple[1])
-
-                # Замены конкретных последовательностей, ломающих форматирование adoc (символы '=' мешаются)
-                # В manual/strings.adoc
-                replace_count = data.count('(str, i, n=1)')
-                data = data.replace('(str, i, n=1)',
-                                    '+++(str, i, n=1)+++')
-                log_it("Replaced '(str, i, n=1)'", replace_count)
-
-                # В manual/arrays.adoc
-                replace_count = data.count('similar(A,T=eltype(A),dims=size(A))')
-                data = data.replace('similar(A,T=eltype(A),dims=size(A))',
-                                    '+similar(A,T=eltype(A),dims=size(A))+')
-                log_it("Replaced 'similar(A,T=eltype(A),dims=size(A))'", replace_count)
-
-                # В manual/faq.adoc
-                replace_count = data.count('`#=`')
-                data = data.replace('`#=`', '`+#=+`')
-                log_it("Replaced '`#=`'", replace_count)
-
-                replace_count = data.count('`=#`')
-                data = data.replace('`=#`', '`+=#+`')
-                log_it("Replaced '`=#`'", replace_count)
-
-                # В manual/calling-c-and-fortran-code.adoc
-                replace_count = data.count('dims, own = false')
-                data = data.replace('dims, own = false', 'dims, own +++=+++ false')
-                log_it("Replaced 'dims, own = false'", replace_count)
-
-                # ВРЕМЕННО 
-                # Добавляем прямо здесь переводы объектов, которые не собираются в julia из-за ошибок
-                if norm_path.endswith('base\io-network.adoc'):
-                    replace_count = 0
-                    for item in translation_io_network:
-                        source = item
-                        target = translation_io_network[item]
-                        replace_count += data.count(source)
-                        data = data.replace(source, target)
-                    log_it("Replaced translated sentences", replace_count)
-                if norm_path.endswith('base\c.adoc'):
-                    replace_count = 0
-                    for item in translation_c:
-                        source = item
-                        target = translation_c[item]
-                        replace_count += data.count(source)
-                        data = data.replace(source, target)
-                    log_it("Replaced translated sentences", replace_count)
-                if norm_path.endswith('base\parallel.adoc'):
-                    replace_count = 0
-                    for item in translation_parallel:
-                        source = item
-                        target = translation_parallel[item]
-                        replace_count += data.count(source)
-                        data = data.replace(source, target)
-                    log_it("Replaced translated sentences", replace_count)
-                
-                # Замены по словарю в manual/documentation
-                if norm_path.endswith('manual\documentation.adoc'):
-                    replace_count = 0
-                    for item in replace_documentation:
-                        source = item
-                        target = replace_documentation[item]
-                        replace_count += data.count(source)
-                        data = data.replace(source, target)
-                    log_it("Replaced with dict replace_documentation", replace_count)
-
-                    # В этом же документе нужно убрать все одиночные пробелы в начале строк.
-                    # Они там остаются от длинного списка, но в блоках Admonition они мешаются.
-                    data_tuple = re.subn(r'\n[^\S\r\n](?=[^\s])',
-                                         r'\n', 
-                                        data)
-                    data = data_tuple[0]
-                    log_it('Deleted single spaces', data_tuple[1])
-
-            # Записываем текст после всех замен обратно в файл
-            with open(norm_path, 'w', encoding='utf8') as file:
-                file.write(data)
-
-# Выводим количество сконвертированных файлов
-logging.info('Files converted total: ' + str(file_count))
+# ПРАВИЛА ЗАМЕН
+
+# Приводим путь к виду с обратными слэшами, как в списках translated, toclevel_pages и в правилах ниже
+# (пути там заданы по-виндовому, а под Linux normpath оставляет прямые слэши)
+def path_key(norm_path):
+    return norm_path.replace('/', '\\')
+
+# Базовый класс правила замены. Все правила собраны по порядку в список RULES (порядок замен важен!)
+# name - короткое уникальное имя правила (для статистики), message - сообщение для лога,
+# paths - выполнять правило только для файлов, путь которых заканчивается на один из этих суффиксов,
+# exclude - не выполнять правило для файлов, путь которых заканчивается на один из этих суффиксов,
+# scope - на чем можно выполнять правило при потоковой конвертации (см. ПОТОКОВАЯ КОНВЕРТАЦИЯ):
+# 'chunk' - на каждом куске документа, 'head' - только на первом куске (регулярка привязана к началу документа),
+# 'document' - только на всем документе (файлы с таким правилом всегда конвертируются целиком)
+# literals - строки, хотя бы одна из которых должна быть в тексте, чтобы правило могло что-то заменить
+# (см. ПРЕДВАРИТЕЛЬНЫЙ ОТБОР ПРАВИЛ). Для регулярок задаются в таблице правил, для словарей - это их ключи
+# (find_literals). Если литералов нет, правило выполняется всегда
+class Rule:
+    def __init__(self, name, message, paths=None, exclude=None, scope='chunk', literals=None):
+        self.name = name
+        self.message = message
+        self.paths = tuple(paths) if paths else None
+        self.exclude = tuple(exclude) if exclude else None
+        self.scope = scope
+        self.literals = tuple(literals) if literals else None
+        self.literals_ready = literals is not None
+
+    # Литералы правила (None - правило выполняется всегда). Ищутся при первом обращении, а не при импорте
+    def required_literals(self):
+        if not self.literals_ready:
+            self.literals = self.find_literals()
+            self.literals_ready = True
+        return self.literals
+
+    def find_literals(self):
+        return None
+
+    # Проверяем, нужно ли выполнять правило для файла (путь уже приведен через path_key)
+    def applies_to(self, key):
+        if self.paths is not None and not key.endswith(self.paths):
+            return False
+        if self.exclude is not None and key.endswith(self.exclude):
+            return False
+        return True
+
+    # Замену делает apply(data, regions) подкласса (RegexRule, LiteralRule, FunctionRule), она возвращает кортеж
+    # (текст после замены, количество замен). regions - области текста (DocumentRegions) или None.
+    # Здесь - то же плюс подробности для лога: словарь {что заменяли: количество замен} или None
+    def apply_detailed(self, data, regions=None):
+        data, count = self.apply(data, regions)
+        return data, count, None
+
+# ЗАМЕНЫ ФИКСИРОВАННЫХ СТРОК
+
+# Функция проверяет, есть ли у строк общий кусок вида "конец a = начало b" (собственные суффикс и префикс)
+def strings_overlap(a, b):
+    for n in range(1, min(len(a), len(b))):
+        if a.endswith(b[:n]):
+            return True
+    return False
+
+# Функция проверяет, что замены по словарю не влияют друг на друга и их можно сделать за один проход
+# с тем же результатом, что и последовательные str.replace в порядке ключей:
+# ключи не входят друг в друга и не перекрываются, а подставленный текст не может образовать следующий ключ
+def literals_independent(replacements):
+    keys = list(replacements)
+    for key in keys:
+        if not key or not replacements[key]:
+            return False
+    for i, a in enumerate(keys):
+        value = replacements[a]
+        for b in keys[i + 1:]:
+            if a in b or b in a or strings_overlap(a, b) or strings_overlap(b, a):
+                return False
+            if b in value or value in b or strings_overlap(value, b) or strings_overlap(b, value):
+                return False
+    return True
+
+# Функция строит из ключей префиксное дерево (trie) и записывает его одной регуляркой:
+# 'abc', 'abd', 'xy' -> '(?:ab(?:c|d)|xy)'. Такая регулярка проверяет в каждой позиции все ключи сразу,
+# не перебирая их по одному, то есть работает как автомат Ахо-Корасик, но внутри движка re (на C)
+def trie_pattern(keys):
+    trie = {}
+    for key in keys:
+        node = trie
+        for char in key:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def build(node):
+        branches = [re.escape(char) + build(child) for char, child in node.items() if char != '']
+        if not branches:
+            return ''
+        if len(branches) == 1 and '' not in node:
+            return branches[0]
+        group = '(?:' + '|'.join(branches) + ')'
+        return group + '?' if '' in node else group
+
+    return build(trie)
+
+# Заменщик фиксированных строк по словарю. Автомат (регулярка из trie_pattern) строится один раз при первой замене,
+# и весь словарь заменяется за один проход по документу с подсчетом замен по каждому ключу.
+# Если ключи влияют друг на друга (см. literals_independent) или ключ один,
+# делаем как раньше: str.count и str.replace по порядку ключей
+class LiteralReplacer:
+    def __init__(self, replacements):
+        self.replacements = dict(replacements)
+        self.pattern = None
+        self.prepared = False
+
+    def prepare(self):
+        if len(self.replacements) > 1 and literals_independent(self.replacements):
+            self.pattern = re.compile(trie_pattern(self.replacements))
+        self.prepared = True
+
+    # Возвращает кортеж (текст после замен, словарь {ключ: количество замен} только для найденных ключей)
+    def replace(self, data):
+        if not self.prepared:
+            self.prepare()
+        counts = {}
+        if self.pattern is None:
+            for source, target in self.replacements.items():
+                count = data.count(source)
+                # Не копируем документ, если заменять нечего
+                if count > 0:
+                    data = data.replace(source, target)
+                    counts[source] = count
+            return data, counts
+
+        replacements = self.replacements
+        def substitute(m):
+            source = m.group()
+            counts[source] = counts.get(source, 0) + 1
+            return replacements[source]
+        return self.pattern.sub(substitute, data), counts
+
+
+# Замена по регулярке. Регулярка компилируется один раз, при первом выполнении правила
+# (а не при импорте скрипта: большинство правил для конкретного запуска может и не понадобиться)
+# hardened - устойчивый вариант правила с тем же результатом: регулярка (классы символов вместо точки, якоря,
+# опережающие проверки; без атомарных групп и притяжательных квантификаторов, их нет до Python 3.11)
+# или функция func(data) -> (текст, количество замен).
+# Используется, если включен HARDENED_RULES
+# skip_regions - виды областей документа (см. СТРУКТУРА ДОКУМЕНТА), внутри которых совпадения не заменяются
+class RegexRule(Rule):
+    def __init__(self, name, message, pattern, repl, hardened=None, skip_regions=None, **kwargs):
+        super().__init__(name, message, **kwargs)
+        self.source = pattern
+        self.repl = repl
+        self.hardened_source = hardened
+        self.skip_regions = tuple(skip_regions) if skip_regions else None
+        self.compiled = None
+        self.hardened_compiled = None
+
+    @property
+    def pattern(self):
+        if self.compiled is None:
+            self.compiled = re.compile(self.source)
+        return self.compiled
+
+    @property
+    def hardened(self):
+        if self.hardened_compiled is None and self.hardened_source is not None:
+            hardened = self.hardened_source
+            self.hardened_compiled = re.compile(hardened) if isinstance(hardened, str) else hardened
+        return self.hardened_compiled
+
+    def apply(self, data, regions=None):
+        pattern = self.pattern
+        if HARDENED_RULES and self.hardened is not None:
+            if callable(self.hardened):
+                return self.hardened(data)
+            pattern = self.hardened
+        if self.skip_regions is None:
+            return pattern.subn(self.repl, data)
+        return sub_outside(pattern, self.repl, data, self.skip_regions, regions)
+
+# Замена фиксированных строк по словарю {что: на что}, количество замен суммируется по всем парам
+# Для словарей из нескольких строк в лог (DEBUG) дополнительно пишется количество замен по каждой строке
+class LiteralRule(Rule):
+    def __init__(self, name, message, replacements, **kwargs):
+        super().__init__(name, message, **kwargs)
+        self.replacements = replacements
+        self.replacer = LiteralReplacer(replacements)
+
+    def find_literals(self):
+        return tuple(self.replacements)
+
+    def apply(self, data, regions=None):
+        data, count, details = self.apply_detailed(data)
+        return data, count
+
+    def apply_detailed(self, data, regions=None):
+        data, counts = self.replacer.replace(data)
+        details = None
+        if len(self.replacements) > 1:
+            details = {source: counts[source] for source in self.replacements if source in counts}
+        return data, sum(counts.values()), details
+
+# Замена, которую нельзя записать одной регуляркой. func(data) возвращает (текст, количество замен)
+# uses_regions - func нужны области документа, она вызывается как func(data, regions)
+class FunctionRule(Rule):
+    def __init__(self, name, message, func, uses_regions=False, **kwargs):
+        super().__init__(name, message, **kwargs)
+        self.func = func
+        self.uses_regions = uses_regions
+
+    def apply(self, data, regions=None):
+        if self.uses_regions:
+            return self.func(data, regions)
+        return self.func(data)
+
+
+# ПРЕДВАРИТЕЛЬНЫЙ ОТБОР ПРАВИЛ
+
+# Большинство правил может что-то заменить, только если в тексте есть определенная строка ('!!! note', 'link:',
+# ':doctype:', '<<' и тп.), а на большинстве страниц срабатывает лишь несколько правил. Поэтому для каждого
+# правила известны обязательные литералы (для регулярки - строка, без которой она не может совпасть, она задается
+# в таблице правил рядом с регуляркой; для словаря - его ключи), по тексту один раз проверяется наличие всех
+# литералов, и правила без них пропускаются. Количество пропусков выводится в статистике по правилам.
+# Литерал регулярки должен входить в любое ее совпадение (и совпадение устойчивого варианта), иначе правило
+# будет пропускаться зря. У правил, которые срабатывают почти везде (по '\n' или '='), литералов нет.
+
+# Наличие литералов правил в тексте одного документа (или куска при потоковой конвертации)
+# Сначала все литералы проверяются по исходному тексту (str.__contains__ по каждому литералу быстрее одной общей
+# регулярки). Правила меняют текст и могут создать литерал, которого не было (например, links_1 пишет 'xref:./'
+# для links_2, а удаление строки склеивает соседние). Поэтому после изменения текста литералы, которых не было,
+# перепроверяются по текущему тексту, когда они понадобятся. Найденные литералы считаются найденными и дальше:
+# если правило их удалило, следующее правило просто выполнится зря
+class LiteralPresence:
+    def __init__(self, data, rules):
+        literals = {literal for rule in rules for literal in (rule.required_literals() or ())}
+        self.present = {literal for literal in literals if literal in data}
+        self.changed = False
+
+    # Функция проверяет, может ли правило что-то заменить в тексте data
+    def may_match(self, rule, data):
+        literals = rule.required_literals()
+        if literals is None or not self.present.isdisjoint(literals):
+            return True
+        if not self.changed:
+            return False
+        found = [literal for literal in literals if literal in data]
+        self.present.update(found)
+        return bool(found)
+
+# Функция добавляет в rule_stats пропуск правила
+def skip_rule(rule, rule_stats):
+    rule_stats.setdefault(rule.name, [0, 0.0, 0, 0, 0, 0])[5] += 1
+
+
+# Замена по регулярке pattern во всем тексте, кроме областей видов kinds (см. RegionTable)
+# repl - строка замены (как в re.sub) или функция от совпадения. Возвращает (текст, количество замен)
+# regions - области этого же текста из apply_rules (DocumentRegions), без них таблица строится только для этой замены
+def sub_outside(pattern, repl, data, kinds, regions=None):
+    if regions is None or regions.data is not data:
+        regions = DocumentRegions(data)
+    # Таблицу областей строим только при первом совпадении: в документах без совпадений разбор не нужен
+    inside = None
+    count = 0
+
+    def substitute(m):
+        nonlocal count, inside
+        if inside is None:
+            inside = regions.checker(kinds)
+        if inside(m.start()):
+            return m.group()
+        count += 1
+        return repl(m) if callable(repl) else m.expand(repl)
+    data = pattern.sub(substitute, data)
+    return data, count
+
+
+# Регулярка для математических выражений
+# Все что между двух $ но слева обязательно пробел! Иначе много лишних захватов
+# Пробел, но не newline можно записать только так: [^\S\r\n]
+math_pattern = re.compile(r'[^\S\r\n]\$(?P<group1>[^\$`\r\n]{1,100}?)\$')
+
+# Символы, которые str.splitlines считает переводами строк, кроме \n
+extra_line_breaks = re.compile('[\r\v\f\x1c\x1d\x1e\x85\u2028\u2029]')
+
+# Заменяем математические выражения во всем тексте, кроме блоков кода (по таблице областей)
+# Выражение не может переходить на другую строку, поэтому результат тот же, что при замене по строкам.
+# Как и раньше, документ после замены всегда заканчивается переводом строки
+def replace_math(data, regions=None):
+    # Если в тексте есть другие переводы строк, номера строк блоков кода считаются по-другому, делаем по-старому
+    if extra_line_breaks.search(data):
+        return replace_math_lines(data)
+    # Без '$' заменять нечего (правило-функция, поэтому проверяем здесь, а не в предварительном отборе:
+    # перевод строки в конце добавляется в любом случае)
+    replace_count = 0
+    if '$' in data:
+        data, replace_count = sub_outside(math_pattern, r' stem:[\1]', data, ('code',), regions)
+    if data and not data.endswith('\n'):
+        data += '\n'
+    return data, replace_count
+
+# Заменяем блоки математических выражений построчно, чтобы не заменять в блоках с кодом
+def replace_math_lines(data):
+    # Парсим текст на блоки кода
+    data_lines = data.splitlines()
+    in_code = code_line_flags(find_code_lines(data), len(data_lines))
+
+    lines_edited = []
+    replace_count = 0
+    for i in range(len(data_lines)):
+        if in_code[i]:
+            lines_edited.append(data_lines[i])
+        else:
+            data_tuple = math_pattern.subn(r' stem:[\1]', data_lines[i])
+            lines_edited.append(data_tuple[0])
+            replace_count += data_tuple[1]
+    # Добавляем пустую строку в конце, потому что она там была везде
+    lines_edited.append('')
+    return '\n'.join(lines_edited), replace_count
+
+
+# Устойчивая замена ссылок Markdown [текст](http...) для правила md_links
+# Регулярка md_links из каждой '[' просматривает всю строку до конца в поисках '](http', поэтому на строках
+# с множеством '[' работает квадратичное время. Здесь для каждой строки один раз находим все '](http'
+# и для каждой '[' проверяем только их: результат тот же, что у регулярки
+# (самый короткий текст до '](http', после которой до ')' есть хотя бы один символ, не длиннее 10000)
+md_link_middle = re.compile(r'\]\(http')
+
+def replace_md_links(data, max_length=10000):
+    pieces = []
+    count = 0
+    pos = 0
+    search = 0
+    line_end = -1
+    middles = []
+    while True:
+        start = data.find('[', search)
+        if start == -1:
+            break
+        if start >= line_end:
+            # Новая строка: находим ее конец и все '](http' в ней
+            line_end = len(data)
+            for char in '\n\r':
+                end = data.find(char, start, line_end)
+                if end != -1:
+                    line_end = end
+            middles = [m.start() for m in md_link_middle.finditer(data, start, line_end)]
+            last_paren = data.rfind(')', start, line_end)
+        if not middles:
+            search = line_end
+            continue
+
+        match = None
+        for middle in middles[bisect.bisect_left(middles, start + 2):]:
+            if middle - start - 1 > max_length:
+                break
+            link = middle + 2
+            if link + 5 > last_paren:
+                break
+            close = data.find(')', link + 5, line_end)
+            if close != -1 and close - (link + 4) <= max_length:
+                match = (middle, link, close)
+                break
+        if match is None:
+            search = start + 1
+            continue
+
+        middle, link, close = match
+        pieces.append(data[pos:start])
+        pieces.append(data[link:close] + '[' + data[start + 1:middle] + ']')
+        count += 1
+        pos = search = close + 1
+    if not count:
+        return data, 0
+    pieces.append(data[pos:])
+    return ''.join(pieces), count
+
+
+# Версия набора правил. Увеличиваем при изменении кода правил-функций (например, replace_math),
+# чтобы при инкрементальной конвертации все файлы пересобрались заново
+RULES_VERSION = 2
+
+RULES = [
+    # Удаляем :doctype: book в заголовке страниц
+    RegexRule('doctype', 'Deleted :doctype: headers',
+              r':doctype: book\n\n?', r'', literals=(':doctype: book',)),
+
+    # Удаляем :pp: {plus}{plus} в заголовке страниц
+    RegexRule('pp', 'Deleted :pp: headers',
+              r':pp:\s{plus}{plus}\n\n?', r'', literals=(':pp:',)),
+
+    # Удаляем :stem: latexmath в заголовке страниц
+    RegexRule('stem', 'Deleted :stem: headers',
+              r':stem: latexmath\n\n?', r'', literals=(':stem: latexmath',)),
+
+    # Удаляем лишние якоря с постфиксом "-1"
+    RegexRule('anchors_1', 'Deleted "-1" anchors',
+              r'\+{3}.*?-1\">\+{6}</a>\+{3}\n\n?', r'', literals=('-1">++++++</a>+++',)),
+
+    # Меняем местами якорь и главный заголовок
+    RegexRule('main_header', 'Main headers moved up',
+              r'(?P<group1>\+{3}<a.*?a>\+{3})\n{1,3}(?P<group2>=\s.*)', r'\2\n\n\1', literals=('+++<a',)),
+
+    # Добавляем в начале документа плашку, если он еще не переведен
+    RegexRule('in_translation', 'Added header Translation in progress',
+              r'(?P<group1>^=\s.*\n)', r'\1\n[NOTE]\n====\nДокументация в процессе перевода.\n====\n',
+              exclude=translated, scope='head'),
+
+    # Заменяем заголовки разделов в docstrings
+    RegexRule('docstring_headers', 'Replaced docstring headers',
+              r'<<(?P<group1>.{1,200}),#>>\n\*', r'[id="\1"]\n=== *', literals=(',#>>',)),
+
+    # Убираем точки в заголовках разделов в docstrings
+    RegexRule('docstring_points', 'Deleted points in docstring headers',
+              r'\&mdash;\s_(?P<group1>.{1,50}?)_\.', r'— _\1_', literals=('&mdash;',)),
+
+    # Заменяем перекрестные ссылки в два этапа
+    # Этап 1
+    RegexRule('links_1', 'Replaced links Part 1',
+              r'link:(?P<group1>.{1,200}?).md', r'xref:./\1.adoc', literals=('link:',)),
+
+    # Этап 2
+    RegexRule('links_2', 'Replaced links Part 2',
+              r'xref:./../', r'xref:', literals=('xref:',)),
+
+    # Заменяем блоки Compat
+    RegexRule('compat', 'Replaced Compat blocks',
+              r'!!! compat \"(?P<group1>.{1,100}?)\"\n\s{4}(?P<group2>.{1,10000}?)\n',
+              r'[IMPORTANT]\n.Совместимость: \1\n====\n\2\n====\n',
+              hardened=r'!!! compat \"(?P<group1>.{1,100}?)\"\n\s{4}(?P<group2>[^\n]{1,10000})\n',
+              literals=('!!! compat "',)),
+
+    # Заменяем блоки Note
+    RegexRule('note', 'Replaced Note blocks',
+              r'!!! note\n\s{4,5}(?P<group1>.{1,10000}?)\n', r'[NOTE]\n====\n\1\n====\n',
+              hardened=r'!!! note\n\s{4,5}(?P<group1>[^\n]{1,10000})\n', literals=('!!! note',)),
+
+    # Заменяем блоки Warning
+    RegexRule('warning', 'Replaced Warning blocks',
+              r'!!! warning\n\s{4,5}(?P<group1>.{1,10000}?)\n', r'[WARNING]\n====\n\1\n====\n',
+              hardened=r'!!! warning\n\s{4,5}(?P<group1>[^\n]{1,10000})\n', literals=('!!! warning',)),
+
+    # Заменяем блоки Tip
+    RegexRule('tip', 'Replaced Tip blocks',
+              r'!!! tip\n\s{4,5}(?P<group1>.{1,10000}?)\n', r'[TIP]\n====\n\1\n====\n',
+              hardened=r'!!! tip\n\s{4,5}(?P<group1>[^\n]{1,10000})\n', literals=('!!! tip',)),
+
+    # Заменяем блоки sidebar (см. RTFM-682)
+    RegexRule('sidebar', 'Replaced sidebar blocks',
+              r'!!! sidebar \"(?P<group1>.{1,1000}?)\"\n\s{4}(?P<group2>.{1,10000}?)\n',
+              r'[NOTE]\n.\1\n====\n\2\n====\n',
+              hardened=r'!!! sidebar \"(?P<group1>.{1,1000}?)\"\n\s{4}(?P<group2>[^\n]{1,10000})\n',
+              literals=('!!! sidebar "',)),
+
+    # Присоединяем к блокам Note, Warning, Tip строки в четверных точках
+    RegexRule('four_points', 'Added parts in four points to admonition blocks',
+              r'====\n\+?\n\.{4}\n(?P<group1>[\s\S]{1,10000}?)\.{4}', r'\n\1\n====\n', literals=('\n....\n',)),
+
+    # Вставляем дополнительные переносы строки для списков внутри блоков Admonition (см. RTFM-682)
+    RegexRule('list_breaks', 'Added extra line breaks in lists',
+              r'\n[^\S\r\n]{2}\*[^\S\r\n]', r'\n\n  * ',
+              exclude=('Markdown.adoc',)),
+
+    # Заменяем блоки математических выражений (кроме блоков с кодом)
+    FunctionRule('math', 'Replaced Math blocks', replace_math, uses_regions=True),
+
+    # Добавляем ограничение на уровни в Contents (см. RTFM-688)
+    RegexRule('toclevels', 'Added page-toclevels',
+              r'^(?P<group1>=\s[^\s].*?\n)', r'\1:page-toclevels: 1\n',
+              paths=toclevel_pages, scope='head'),
+
+    # Заменяем якоря с одинарными кавычками внутри (Kramdoc с таким не справляется)
+    RegexRule('single_quote_id', 'Replaced id with single quote',
+              r'<a id=\'(?P<group1>.{1,1000}\'.{1,1000}?)\'></a>', r'+++<a id="\1">++++++</a>+++',
+              hardened=r'<a id=\'(?=.*\'></a>)(?P<group1>.{1,1000}\'.{1,1000}?)\'></a>', literals=("<a id='",)),
+
+    # Обрамляем __текст__ в двойных подчеркиваниях в +++ (см. RTFM-536)
+    # Сначала только внутри backticks: `__FILE__` -> `+++__FILE__+++`
+    # Слева и справа может быть дополнительный текст
+    RegexRule('plus_backticks', 'Adding "+++" to text in backticks',
+              r'(?P<group1>`\S{0,100}?)(?P<group2>__\S{1,100}__)(?P<group3>\S{0,100}?`)', r'\1+++\2+++\3',
+              hardened=r'(?=`\S{4,304}`)(?P<group1>`\S{0,100}?)(?P<group2>__\S{1,100}__)(?P<group3>\S{0,100}?`)',
+              literals=('__',)),
+
+    # Обрамляем __текст__ в двойных подчеркиваниях в +++ (см. RTFM-536)
+    # Теперь только в ссылках: xref:./base.adoc#Base.@__FILE__ -> xref:./base.adoc#Base.@+++__FILE__+++
+    # Ссылки обрабатываются раньше. Порядок замен важен!
+    RegexRule('plus_xref', 'Adding "+++" to text in xref links',
+              r'(?P<group1>xref:\S{1,100}?)(?P<group2>__\S{1,100}?__)', r'\1+++\2+++', literals=('xref:',)),
+
+    # Заменяем двойные дефисы на длинное тире после кода неразрывного пробела 
+    # (Antora делает это только между двух обычных пробелов)
+    LiteralRule('hyphens', 'Replaced two hyphens',
+                {'&nbsp;-- ': '&nbsp;— '}),
+
+    # Заменяем отбитые закрывающие квадратные скобки \] на неотбитые ]
+    # Kramdoc отбивает такие скобки в некоторых контекстах, например в сносках (footnote), из-за чего они ломаются
+    # Но в ссылках (xref, link) эти отбивания нужны, поэтому внутри ссылок (и пропусков +++) не заменяем
+    # Раньше ссылки угадывались по сочетанию )` после скобки, теперь берутся из таблицы областей документа
+    # (см. RTFM-687 и СТРУКТУРА ДОКУМЕНТА)
+    RegexRule('escaped_brackets', "Replaced escaped closing square brackets '\]'",
+              r'\\]', r']', skip_regions=('xref', 'passthrough'), literals=(r'\]',)),
+
+    # Заменяем ссылки (внешние на http) формата Markdown на формат Asciidoc (см. RTFM-672)
+    # В некоторых блоках Kramdoc сам их не заменяет, приходится доделывать. Файл Markdown не трогаем, так как там есть такой пример на Markdown
+    RegexRule('md_links', 'Replaced links from .md to .adoc',
+              r'\[(?P<group1>[^\n\r]{1,10000}?)\]\((?P<group2>http[^\n\r]{1,10000}?)\)', r'\2[\1]',
+              hardened=replace_md_links, exclude=('Markdown.adoc',), literals=('](http',)),
+
+    # На странице Punctuation делаем специальные преобразования 
+    # Задаем относительную ширину столбцов таблицы  
+    RegexRule('punctuation_cols', 'Table columns width',
+              r'\|===\n\|', r'[cols="10%,90%"]\n|===\n|',
+              paths=('base\punctuation.adoc',), literals=('|===\n|',)),
+
+    # Убираем одно лишнее экранирование знака | (или)
+    LiteralRule('punctuation_or', "Replaced OR '\\|'",
+                {'\\\\|': r'\|'},
+                paths=('base\punctuation.adoc',)),
+
+    # Экранируем тильду
+    LiteralRule('punctuation_tilde', "Replaced tilde",
+                {'`~`': r'`+~+`'},
+                paths=('base\punctuation.adoc',)),
+
+    # Экранируем backticks
+    LiteralRule('punctuation_backticks', "Escaped backticks ` `",
+                {'`` ``': r'`+++` `+++`'},
+                paths=('base\punctuation.adoc',)),
+
+    # На странице _index.adoc удаляем весь текст из шапки, оставляем только после слова "Введение"
+    RegexRule('index_header', 'Deleted header in index',
+              r'[\s\S]*= Введение(?P<group1>[\s\S]*)', r'\1',
+              hardened=r'\A[\s\S]*= Введение(?P<group1>[\s\S]*)',
+              paths=('_index.adoc',), scope='document', literals=('= Введение',)),
+
+    # Замены конкретных последовательностей, ломающих форматирование adoc (символы '=' мешаются)
+    # В manual/strings.adoc
+    LiteralRule('str_i_n', "Replaced '(str, i, n=1)'",
+                {'(str, i, n=1)': '+++(str, i, n=1)+++'}),
+
+    # В manual/arrays.adoc
+    LiteralRule('similar', "Replaced 'similar(A,T=eltype(A),dims=size(A))'",
+                {'similar(A,T=eltype(A),dims=size(A))': '+similar(A,T=eltype(A),dims=size(A))+'}),
+
+    # В manual/faq.adoc
+    LiteralRule('comment_open', "Replaced '`#=`'",
+                {'`#=`': '`+#=+`'}),
+
+    LiteralRule('comment_close', "Replaced '`=#`'",
+                {'`=#`': '`+=#+`'}),
+
+    # В manual/calling-c-and-fortran-code.adoc
+    LiteralRule('dims_own', "Replaced 'dims, own = false'",
+                {'dims, own = false': 'dims, own +++=+++ false'}),
+
+    # ВРЕМЕННО 
+    # Добавляем прямо здесь переводы объектов, которые не собираются в julia из-за ошибок
+    LiteralRule('translation_io_network', "Replaced translated sentences",
+                translation_io_network,
+                paths=('base\io-network.adoc',)),
+
+    LiteralRule('translation_c', "Replaced translated sentences",
+                translation_c,
+                paths=('base\c.adoc',)),
+
+    LiteralRule('translation_parallel', "Replaced translated sentences",
+                translation_parallel,
+                paths=('base\parallel.adoc',)),
+
+    # Замены по словарю в manual/documentation
+    LiteralRule('replace_documentation', "Replaced with dict replace_documentation",
+                replace_documentation,
+                paths=('manual\documentation.adoc',)),
+
+    # В этом же документе нужно убрать все одиночные пробелы в начале строк.
+    # Они там остаются от длинного списка, но в блоках Admonition они мешаются.
+    RegexRule('single_spaces', 'Deleted single spaces',
+              r'\n[^\S\r\n](?=[^\s])', r'\n',
+              paths=('manual\documentation.adoc',)),
+]
+
+# Функция выполняет по порядку все правила из rules, которые относятся к файлу norm_path
+# Счетчики замен записываются в records (для лога), а в rule_stats копятся по каждому правилу
+# количество замен, время и размер текста до и после: {name: [count, seconds, chars_in, chars_out]}
+# Если файл не укладывается в TIME_BUDGET, выбрасывается TimeBudgetExceeded
+def apply_rules(data, norm_path, records, rule_stats, rules=RULES):
+    key = path_key(norm_path)
+    active = [rule for rule in rules if rule.applies_to(key)]
+    presence = LiteralPresence(data, active) if LITERAL_PREFILTER else None
+    regions = DocumentRegions(data)
+    start = time.perf_counter()
+    for rule in active:
+        if presence is not None and not presence.may_match(rule, data):
+            skip_rule(rule, rule_stats)
+            continue
+        new_data, count, details, seconds = run_rule(rule, data, rule_stats, regions)
+        if presence is not None and new_data is not data:
+            presence.changed = True
+        data = new_data
+        regions.update(data)
+        check_time_budget(rule, start)
+        log_rule(records, rule, count, details, seconds)
+    return data
+
+# То же для документа, разбитого на куски (см. read_chunks): генератор отдает куски после всех замен
+# Счетчики замен по каждому правилу суммируются по всем кускам и записываются в records
+# в порядке правил, когда отдан последний кусок, поэтому лог такой же, как при замене во всем документе
+def apply_rules_chunked(chunks, norm_path, records, rule_stats, rules=RULES):
+    key = path_key(norm_path)
+    active = [rule for rule in rules if rule.applies_to(key)]
+    totals = {rule.name: [0, {}, 0.0] for rule in active}
+    start = time.perf_counter()
+    for index, data in enumerate(chunks):
+        presence = LiteralPresence(data, active) if LITERAL_PREFILTER else None
+        regions = DocumentRegions(data)
+        for rule in active:
+            if rule.scope == 'head' and index > 0:
+                continue
+            if presence is not None and not presence.may_match(rule, data):
+                skip_rule(rule, rule_stats)
+                continue
+            new_data, count, details, seconds = run_rule(rule, data, rule_stats, regions)
+            if presence is not None and new_data is not data:
+                presence.changed = True
+            data = new_data
+            regions.update(data)
+            check_time_budget(rule, start)
+            total = totals[rule.name]
+            total[0] += count
+            total[2] += seconds
+            if details:
+                for source, source_count in details.items():
+                    total[1][source] = total[1].get(source, 0) + source_count
+        yield data
+
+    for rule in active:
+        count, details, seconds = totals[rule.name]
+        if details:
+            # Подробности по словарю - в порядке ключей, как в LiteralRule.apply_detailed
+            details = {source: details[source] for source in rule.replacements if source in details}
+        log_rule(records, rule, count, details, seconds)
+
+# Функция выполняет одно правило и добавляет в rule_stats его количество замен, время, размеры текста
+# и количество выполнений (см. PROFILE_FIELDS). Возвращает текст, количество замен, подробности и время
+def run_rule(rule, data, rule_stats, regions=None):
+    chars_in = len(data)
+    start = time.perf_counter()
+    data, count, details = rule.apply_detailed(data, regions)
+    elapsed = time.perf_counter() - start
+
+    stat = rule_stats.setdefault(rule.name, [0, 0.0, 0, 0, 0, 0])
+    stat[0] += count
+    stat[1] += elapsed
+    stat[2] += chars_in
+    stat[3] += len(data)
+    stat[4] += 1
+    return data, count, details, elapsed
+
+# Файл не уложился в бюджет времени TIME_BUDGET (см. check_time_budget)
+class TimeBudgetExceeded(Exception):
+    def __init__(self, rule_name, seconds):
+        super().__init__(rule_name, seconds)
+        self.rule_name = rule_name
+        self.seconds = seconds
+
+# Функция проверяет после очередного правила, что время конвертации файла (с момента start) не вышло за TIME_BUDGET
+# Прервать саму регулярку нельзя, поэтому долгие правила имеют устойчивые варианты (HARDENED_RULES),
+# а бюджет не дает одному испорченному файлу тянуть за собой все остальные правила
+def check_time_budget(rule, start):
+    if TIME_BUDGET is None:
+        return
+    elapsed = time.perf_counter() - start
+    if elapsed > TIME_BUDGET:
+        raise TimeBudgetExceeded(rule.name, elapsed)
+
+# Функция задает режим выполнения правил в текущем процессе (в процессах пула вызывается при их запуске)
+# Меняются только переданные настройки (None - оставить как есть), time_budget=0 - без ограничения
+def configure(hardened_rules=None, time_budget=None, literal_prefilter=None):
+    global HARDENED_RULES, TIME_BUDGET, LITERAL_PREFILTER
+    if hardened_rules is not None:
+        HARDENED_RULES = hardened_rules
+    if time_budget is not None:
+        TIME_BUDGET = time_budget or None
+    if literal_prefilter is not None:
+        LITERAL_PREFILTER = literal_prefilter
+
+# Функция записывает в records счетчик замен правила и подробности по словарю (DEBUG)
+def log_rule(records, rule, count, details, seconds=None):
+    log_it(records, rule.message, count, rule=rule.name, seconds=seconds)
+    if details:
+        for source, source_count in details.items():
+            log_it(records, short_text(source), source_count, level=logging.DEBUG, rule=rule.name)
+
+# Функция обрезает длинный текст для лога
+def short_text(text, length=60):
+    if len(text) > length:
+        text = text[:length - 3] + '...'
+    return "'" + text + "'"
+
+# Функция складывает статистику по правилам из одного файла в общую
+def merge_rule_stats(total, rule_stats):
+    for name, values in rule_stats.items():
+        stat = total.setdefault(name, [0, 0.0, 0, 0, 0, 0])
+        for i, value in enumerate(values):
+            stat[i] += value
+
+# Функция выводит в командную строку статистику по правилам в порядке их выполнения
+def print_rule_stats(total):
+    print('Rule stats (replaces, seconds, runs, skipped):')
+    for rule in RULES:
+        if rule.name in total:
+            count, seconds, chars_in, chars_out, runs, skipped = total[rule.name]
+            print('  {:<25} {:>8} {:>10.3f} {:>8} {:>8}'.format(rule.name, count, seconds, runs, skipped))
+    runs = sum(stat[4] for stat in total.values())
+    skipped = sum(stat[5] for stat in total.values())
+    print('Rule runs skipped by literal prefilter: {} of {}'.format(skipped, runs + skipped))
+
+
+# ПРОФИЛИРОВАНИЕ
+
+# По каждому сконвертированному файлу хранится его статистика по правилам из apply_rules:
+# {путь: {правило: [count, seconds, chars_in, chars_out, runs, skipped]}}. В конце запуска выводятся самые медленные
+# правила и файлы, а вся статистика может быть записана в JSON или CSV (--profile), чтобы сравнивать запуски
+# и замечать, что новое правило или правка регулярки замедлили конвертацию.
+# Размеры текста - в символах (len), а не в байтах: считать байты пришлось бы перекодированием всего документа
+
+# runs - сколько раз правило выполнялось, skipped - сколько раз пропущено предварительным отбором
+PROFILE_FIELDS = ('count', 'seconds', 'chars_in', 'chars_out', 'runs', 'skipped')
+
+# Путь в статистике - всегда с прямыми слэшами, чтобы файлы статистики сравнивались между системами
+def profile_key(norm_path):
+    return norm_path.replace('\\', '/')
+
+# Функция выводит в командную строку top самых медленных правил и файлов
+def print_profile_summary(total, file_stats, top=PROFILE_TOP):
+    rules = sorted(total.items(), key=lambda item: item[1][1], reverse=True)[:top]
+    print('Slowest rules (seconds, replaces, chars in):')
+    for name, (count, seconds, chars_in, chars_out, runs, skipped) in rules:
+        print('  {:<25} {:>10.3f} {:>8} {:>12}'.format(name, seconds, count, chars_in))
+
+    files = sorted(((sum(stat[1] for stat in rule_stats.values()), norm_path, rule_stats)
+                    for norm_path, rule_stats in file_stats.items()), key=lambda item: item[0], reverse=True)[:top]
+    print('Slowest files (seconds, slowest rule):')
+    for seconds, norm_path, rule_stats in files:
+        slowest = max(rule_stats, key=lambda name: rule_stats[name][1]) if rule_stats else ''
+        print('  {:>10.3f}  {}  ({})'.format(seconds, profile_key(norm_path), slowest))
+
+# Функция записывает всю статистику в файл path: CSV, если имя заканчивается на .csv, иначе JSON
+# Правила внутри файла идут в порядке RULES, файлы - по алфавиту, поэтому файлы разных запусков удобно сравнивать
+def write_profile(path, total, file_stats):
+    order = {rule.name: i for i, rule in enumerate(RULES)}
+
+    def rows(rule_stats):
+        for name in sorted(rule_stats, key=order.get):
+            values = list(rule_stats[name])
+            values[1] = round(values[1], 6)
+            yield name, values
+
+    if path.lower().endswith('.csv'):
+        with open(path, 'w', encoding='utf8', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(('file', 'rule') + PROFILE_FIELDS)
+            for name, values in rows(total):
+                writer.writerow(['TOTAL', name] + values)
+            for norm_path in sorted(file_stats, key=profile_key):
+                for name, values in rows(file_stats[norm_path]):
+                    writer.writerow([profile_key(norm_path), name] + values)
+        return
+
+    profile = {'rules': {name: dict(zip(PROFILE_FIELDS, values)) for name, values in rows(total)},
+               'files': {profile_key(norm_path): {name: dict(zip(PROFILE_FIELDS, values))
+                                                  for name, values in rows(rule_stats)}
+                         for norm_path, rule_stats in file_stats.items()}}
+    with open(path, 'w', encoding='utf8') as file:
+        json.dump(profile, file, ensure_ascii=False, indent=1, sort_keys=True)
 
-# Выводим в командную строку сообщение об окончании процесса
-print('Files converted total: ' + str(file_count))
-print('Conversion finished')
 
+# КОНВЕРТАЦИЯ
 
+# Функция записывает текст в файл через временный файл в той же папке,
+# чтобы при падении скрипта не оставалось недописанных или полусконвертированных файлов
+# Текст передается кусками (при потоковой конвертации куски пишутся по мере получения), целый текст - (data,)
+def write_chunks_atomic(path, chunks):
+    tmp_path = write_temp_file(path, chunks)
+    try:
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+# Функция записывает куски текста во временный файл в папке файла path и возвращает путь к временному файлу
+def write_temp_file(path, chunks):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.', suffix='.tmp')
+    try:
+        with open(fd, 'w', encoding='utf8') as file:
+            for data in chunks:
+                file.write(data)
+        set_default_mode(tmp_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return tmp_path
+
+# mkstemp создает файл с правами 0600, выставляем обычные права (с учетом umask)
+def set_default_mode(path):
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(path, 0o666 & ~umask)
+
+# Функция копирует файл-источник в результат без изменений, байт в байт (файл, который не уложился в TIME_BUDGET)
+# Как и остальные файлы результата - через временный файл
+def copy_unchanged(source_file, target_file):
+    os.makedirs(os.path.dirname(target_file) or '.', exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target_file) or '.', prefix='.', suffix='.tmp')
+    os.close(fd)
+    try:
+        shutil.copyfile(source_file, tmp_path)
+        set_default_mode(tmp_path)
+        os.replace(tmp_path, target_file)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+# Функция записывает файл результата, создавая его папку (куски текста - как в write_chunks_atomic)
+def write_target(path, chunks):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    write_chunks_atomic(path, chunks)
+
+# Функция переносит в папку результата файл, который не нужно конвертировать (картинки и тп.)
+# Сначала пробуем жесткую ссылку (ничего не копируется), если нельзя - обычное копирование
+def copy_asset(source_file, target_file):
+    if os.path.lexists(target_file):
+        os.remove(target_file)
+    if LINK_ASSETS:
+        try:
+            os.link(source_file, target_file)
+            return
+        except OSError:
+            pass
+    shutil.copy2(source_file, target_file)
+
+# ПОТОКОВАЯ КОНВЕРТАЦИЯ
+
+# Большой документ делится на куски, которые можно конвертировать по отдельности с тем же результатом,
+# что и весь документ целиком. Для этого режем только перед строкой, которая начинается с буквы или цифры,
+# если перед ней ровно одна пустая строка, а перед пустой - обычная строка текста, заканчивающаяся точкой.
+# Ни одна замена из RULES не захватывает такое место (блоки Admonition начинаются с '!!!', списки и
+# продолжения блоков - с пробелов, заголовки - с '='). Кроме того, не режем внутри блоков кода
+# (как их находит code_pattern) и внутри блоков в четверных точках (правило four_points).
+
+# Все поиски мест разреза идут по байтам UTF-8 файла, отображенного в память (mmap), скомпилированными
+# байтовыми регулярками: файл не декодируется и не копируется целиком, декодируются только готовые куски.
+# Переводы строк - \n или \r\n (файлы с одиночными \r не режем, см. chunk_limit)
+
+# То же, что code_pattern, но по байтам (все символы в регулярке ASCII, поэтому спаны совпадают)
+code_pattern_bytes = re.compile(rb'\n----\r?\n(?P<group1>[\s\S]*?)----')
+# Строка '....', с которой может начаться замена four_points ('====', затем пустая строка или '+', затем '....').
+# Перед ней должна быть пустая строка или '+', или строка, которую удаляют правила doctype, pp, stem, anchors_1
+literal_open_bytes = re.compile(rb'\n(?:\+|:[^\r\n]*|\+\+\+[^\r\n]*)?\r?\n(?P<group1>\.{4}\r?\n)')
+# Символы, которые str.splitlines (в replace_math) считает переводами строк, кроме \r и \n, в UTF-8
+# Если они есть в документе, номера строк в replace_math зависят от всего текста до них, и дальше не режем
+extra_line_breaks_bytes = (b'\x0b', b'\x0c', b'\x1c', b'\x1d', b'\x1e', b'\xc2\x85', b'\xe2\x80\xa8', b'\xe2\x80\xa9')
+lone_cr_bytes = re.compile(rb'\r(?!\n)')
+# Кандидат на место разреза: точка в конце строки и ровно одна пустая строка после нее
+chunk_cut_bytes = re.compile(rb'\.\r?\n\r?\n')
+
+# Функция декодирует байты файла так же, как при чтении в текстовом режиме (универсальные переводы строк)
+def decode_text(raw):
+    return str(raw, 'utf8').replace('\r\n', '\n').replace('\r', '\n')
+
+# Функция открывает файл только на чтение, отображенным в память. Пустой файл отобразить нельзя - отдаем b''
+def map_file(file):
+    if os.fstat(file.fileno()).st_size == 0:
+        return contextlib.nullcontext(b'')
+    return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+# Функция проверяет, что символ, который начинается в buf с позиции pos, - буква или цифра
+def starts_alnum(buf, pos):
+    return buf[pos:pos + 4].decode('utf8', 'ignore')[:1].isalnum()
+
+# Функция возвращает отсортированные спаны (в байтах), внутри которых резать нельзя:
+# блоки кода (как их находит code_pattern) и блоки в четверных точках до первых следующих '....'
+def unsafe_spans(buf):
+    spans = [m.span() for m in code_pattern_bytes.finditer(buf)]
+    pos = 0
+    while True:
+        m = literal_open_bytes.search(buf, pos)
+        if m is None:
+            break
+        end = buf.find(b'....', m.end('group1') + 1)
+        spans.append((m.start('group1'), len(buf) if end == -1 else end + 4))
+        pos = m.start('group1') - 1
+    spans.sort()
+    return spans
+
+# Функция возвращает позицию, дальше которой резать нельзя
+def chunk_limit(buf):
+    if lone_cr_bytes.search(buf):
+        return 0
+    positions = [buf.find(sequence) for sequence in extra_line_breaks_bytes]
+    return min([pos for pos in positions if pos != -1], default=len(buf))
+
+# Генератор отдает текст из buf (байты или mmap) кусками не меньше chunk_size байт,
+# разрезанными только в безопасных местах (см. выше). Каждый кусок декодируется отдельно.
+# Если безопасного места долго нет (например, огромный блок кода), кусок просто растет до него
+def read_chunks(buf, chunk_size):
+    spans = unsafe_spans(buf)
+    starts = [span[0] for span in spans]
+    # Для каждого спана - самый дальний конец среди спанов, начинающихся не позже него
+    max_ends = []
+    for begin, end in spans:
+        max_ends.append(max(end, max_ends[-1]) if max_ends else end)
+    limit = chunk_limit(buf)
+
+    def inside(pos):
+        i = bisect.bisect_left(starts, pos) - 1
+        return i >= 0 and max_ends[i] > pos
+
+    start = 0
+    pos = chunk_size
+    while True:
+        m = chunk_cut_bytes.search(buf, pos)
+        if m is None or m.end() > limit:
+            break
+        cut = m.end()
+        line_start = buf.rfind(b'\n', 0, m.start()) + 1
+        if inside(cut) or not starts_alnum(buf, cut) or not starts_alnum(buf, line_start):
+            pos = m.start() + 1
+            continue
+        yield decode_text(buf[start:cut])
+        start = cut
+        pos = start + chunk_size
+    if start < len(buf):
+        yield decode_text(buf[start:])
+
+# Функция проверяет, конвертировать ли файл потоково: он больше STREAM_THRESHOLD
+# и для него нет правил, которые можно выполнить только на всем документе
+def stream_file(size, norm_path, rules=RULES):
+    if STREAM_THRESHOLD is None or size <= STREAM_THRESHOLD:
+        return False
+    key = path_key(norm_path)
+    return not any(rule.scope == 'document' and rule.applies_to(key) for rule in rules)
+
+
+# Функция читает файл-источник .adoc, делает все замены и записывает результат сразу в target_file
+# Файл отображается в память (mmap) один раз: по этим байтам считается хэш для манифеста,
+# и если файл не изменился, он даже не копируется и не декодируется.
+# Большие файлы (см. stream_file) не декодируются целиком: текст конвертируется и пишется кусками.
+# Если передан known_hash и он совпал с хэшем файла (а результат уже есть), файл не конвертируется.
+# Если файл не уложился в TIME_BUDGET, он копируется в результат без изменений (copy_unchanged).
+# Выполняется в процессах-исполнителях, поэтому ничего не пишет в лог сама, а возвращает
+# путь к файлу результата, список счетчиков замен для write_log (см. log_it, None, если файл пропущен),
+# статистику по правилам для merge_rule_stats, хэш файла-источника и признак, что бюджет времени превышен
+def convert_file(source_file, target_file, known_hash=None):
+    with open(source_file, 'rb') as file, map_file(file) as buf:
+        result = convert_buffer(buf, target_file, known_hash, write_target)
+    if result[4]:
+        copy_unchanged(source_file, target_file)
+    return result
+
+# То же для содержимого файла-источника buf (байты или mmap): результат передается в write(target_file, chunks),
+# где chunks - куски текста (см. write_chunks_atomic). Файл, который не уложился в бюджет времени,
+# здесь не пишется: его копирует без изменений вызывающая функция (copy_unchanged)
+def convert_buffer(buf, target_file, known_hash, write):
+    norm_path = os.path.normpath(target_file)
+    records = []
+    rule_stats = {}
+    source_hash = hashlib.sha256(buf).hexdigest()
+    if source_hash == known_hash and os.path.exists(target_file):
+        return norm_path, None, {}, source_hash, False
+
+    try:
+        if stream_file(len(buf), norm_path):
+            chunks = apply_rules_chunked(read_chunks(buf, STREAM_CHUNK_SIZE), norm_path, records, rule_stats)
+            write(target_file, chunks)
+            return norm_path, records, rule_stats, source_hash, False
+
+        data = apply_rules(decode_text(buf), norm_path, records, rule_stats)
+    except TimeBudgetExceeded as error:
+        return norm_path, [budget_record(error)], rule_stats, source_hash, True
+
+    # Записываем текст после всех замен сразу в папку результата
+    write(target_file, (data,))
+
+    return norm_path, records, rule_stats, source_hash, False
+
+# Запись лога для файла, который не уложился в бюджет времени
+def budget_record(error):
+    return ('Time budget exceeded, file copied unchanged (rule ' + error.rule_name + ')',
+            '{:.1f} s'.format(error.seconds), logging.WARNING, error.rule_name, error.seconds)
+
+# Функция конвертирует текст одного документа в памяти, без чтения и записи файлов
+# rel_path - путь документа относительно папки-источника (например, 'base/punctuation.adoc' или 'index.adoc'),
+# по нему выбираются правила с ограничением по путям. В records и rule_stats (если заданы) добавляются
+# записи лога и статистика по правилам, как при конвертации файла.
+# Возвращает текст после всех замен (если не уложились в бюджет времени - исходный текст)
+def convert_text(text, rel_path, records=None, rule_stats=None):
+    norm_path = os.path.normpath(target_rel_path(rel_path))
+    if records is None:
+        records = []
+    if rule_stats is None:
+        rule_stats = {}
+    # Переводы строк - как при чтении файла (см. decode_text)
+    source = text
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    try:
+        return apply_rules(text, norm_path, records, rule_stats)
+    except TimeBudgetExceeded as error:
+        # Текст, который не уложился в бюджет, возвращается как есть (как copy_unchanged для файлов)
+        records[:] = [budget_record(error)]
+        return source
+
+# То же для пула процессов (imap передает один аргумент): задача (source_file, target_file, known_hash, raw)
+# Если содержимое файла-источника raw уже прочитано (см. Prefetcher), файл не читается, а результат не пишется,
+# а возвращается текстом (последний элемент результата, None - файл пропущен или не прочитан заранее)
+def convert_task(task):
+    source_file, target_file, known_hash, raw = task
+    if raw is None:
+        return convert_file(source_file, target_file, known_hash) + (None,)
+    output = []
+    result = convert_buffer(raw, target_file, known_hash, lambda path, chunks: output.append(''.join(chunks)))
+    if result[4]:
+        copy_unchanged(source_file, target_file)
+    return result + (output[0] if output else None,)
+
+# Функция запускает конвертацию списка задач (source_file, target_file, known_hash)
+# и возвращает результаты convert_file в том же порядке
+# При IO_THREADS файлы читаются заранее и пишутся в фоновых потоках (см. ФОНОВЫЙ ВВОД-ВЫВОД)
+def convert_files(tasks, jobs):
+    if not IO_THREADS:
+        for result in map_tasks([task + (None,) for task in tasks], jobs, len(tasks)):
+            yield result[:5]
+        return
+
+    # Файлы раздаем процессам по одному: пока результат файла не отдан, его место в PREFETCH_BYTES занято
+    # Чтение останавливаем раньше пула: пул при завершении ждет поток, который берет у Prefetcher задачи
+    prefetcher = Prefetcher(tasks)
+    with WriteBehind() as writer, \
+            contextlib.closing(map_tasks(prefetcher, jobs, len(tasks), chunksize=1)) as results, prefetcher:
+        for result in results:
+            if result[5] is not None:
+                writer.write(result[0], result[5])
+            prefetcher.release()
+            yield result[:5]
+
+# Функция выполняет convert_task для задач tasks (count штук) и возвращает результаты в том же порядке
+# При jobs > 1 файлы раздаются пулу процессов, imap сохраняет порядок результатов
+def map_tasks(tasks, jobs, count, chunksize=None):
+    if jobs <= 1 or count <= 1:
+        for task in tasks:
+            yield convert_task(task)
+        return
+
+    # Раздаем файлы пачками, чтобы не гонять по одному файлу между процессами
+    if chunksize is None:
+        chunksize = max(1, count // (jobs * 4))
+    with create_pool(jobs) as pool:
+        for result in pool.imap(convert_task, tasks, chunksize=chunksize):
+            yield result
+
+# Функция создает пул из jobs процессов для конвертации
+# Режим правил передаем процессам явно: при запуске через spawn (Windows) модуль в них импортируется заново
+def create_pool(jobs):
+    import multiprocessing
+    return multiprocessing.Pool(processes=jobs, initializer=configure,
+                                initargs=(HARDENED_RULES, TIME_BUDGET or 0, LITERAL_PREFILTER))
+
+
+# ФОНОВЫЙ ВВОД-ВЫВОД
+
+# Папки источника и результата могут лежать на медленном (сетевом, синхронизируемом) диске. Чтобы конвертация
+# не ждала диска, файлы-источники заранее читаются в нескольких потоках (Prefetcher), а результаты отдаются
+# в очередь, из которой их пишут другие потоки (WriteBehind). При jobs > 1 процессам передается уже прочитанный
+# текст, а обратно возвращается результат: весь ввод-вывод остается в потоках главного процесса.
+# Память ограничена при любом размере дерева: заранее читается не больше PREFETCH_BYTES, место освобождается,
+# когда результат файла отдан дальше, а очередь записи ждет, если в ней больше WRITE_BEHIND_SIZE символов.
+# Файлы больше PREFETCH_BYTES и файлы для потоковой конвертации заранее не читаются (конвертируются как раньше).
+# На локальном диске потоки и fsync только добавляют работы, поэтому по умолчанию все это выключено (IO_THREADS = 0).
+# Результаты пишутся пачками по FSYNC_BATCH файлов: все во временные файлы, затем ожидание записи на диск (fsync)
+# для всей пачки, переименование и fsync папок. Файл появляется в результате, только когда он уже на диске.
+
+# Чтение файлов-источников заранее. Отдает задачи convert_task в порядке задач tasks (см. convert_files)
+# После того как результат очередного файла использован, нужно вызвать release
+# threads и limit по умолчанию (None) - текущие IO_THREADS и PREFETCH_BYTES
+class Prefetcher:
+    def __init__(self, tasks, threads=None, limit=None):
+        from concurrent.futures import ThreadPoolExecutor
+        threads = IO_THREADS if threads is None else threads
+        limit = PREFETCH_BYTES if limit is None else limit
+        self.tasks = tasks
+        self.limit = limit
+        # Сколько задач ставить в очередь потокам наперед (остальное ограничивает limit)
+        self.ahead = threads * 8
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='prefetch')
+        self.condition = threading.Condition()
+        self.reserved = 0
+        # Размеры прочитанных файлов по номерам задач, пока их результат не использован
+        self.sizes = {}
+        # Номер задачи, результат которой будет использован следующим
+        self.next_index = 0
+        self.closed = False
+
+    def __iter__(self):
+        pending = collections.deque()
+        for index, task in enumerate(self.tasks):
+            if self.closed:
+                return
+            pending.append(self.executor.submit(self.read, index, *task))
+            if len(pending) >= self.ahead:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    # Функция читает файл-источник в потоке. Если файл не нужно или не удалось прочитать заранее,
+    # вместо содержимого отдается None (тогда файл прочитает и сообщит об ошибке convert_file)
+    def read(self, index, source_file, target_file, known_hash):
+        try:
+            size = os.path.getsize(source_file)
+            if size > self.limit or stream_file(size, os.path.normpath(target_file)) or not self.reserve(index, size):
+                return source_file, target_file, known_hash, None
+            with open(source_file, 'rb') as file:
+                raw = file.read()
+        except OSError:
+            return source_file, target_file, known_hash, None
+        return source_file, target_file, known_hash, raw
+
+    # Функция ждет, пока прочитанные заранее файлы займут не больше limit вместе с этим файлом
+    # Файл, результат которого нужен следующим, читается всегда: иначе все ждали бы друг друга
+    def reserve(self, index, size):
+        with self.condition:
+            while not self.closed and index != self.next_index and self.reserved + size > self.limit:
+                self.condition.wait()
+            if self.closed:
+                return False
+            self.reserved += size
+            self.sizes[index] = size
+            return True
+
+    def release(self):
+        with self.condition:
+            self.reserved -= self.sizes.pop(self.next_index, 0)
+            self.next_index += 1
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# Запись результатов в фоновых потоках (threads). Ошибка записи выбрасывается при следующем write или в close
+# threads, limit и fsync_batch по умолчанию (None) - текущие IO_THREADS, WRITE_BEHIND_SIZE и FSYNC_BATCH
+class WriteBehind:
+    def __init__(self, threads=None, limit=None, fsync_batch=None):
+        threads = IO_THREADS if threads is None else threads
+        self.limit = WRITE_BEHIND_SIZE if limit is None else limit
+        self.fsync_batch = FSYNC_BATCH if fsync_batch is None else fsync_batch
+        self.queue = collections.deque()
+        # Сколько символов ждет записи
+        self.pending = 0
+        self.error = None
+        self.closed = False
+        self.condition = threading.Condition()
+        self.threads = [threading.Thread(target=self.run, name='write-behind', daemon=True) for _ in range(threads)]
+        for thread in self.threads:
+            thread.start()
+
+    # Функция ставит текст в очередь на запись в файл path (папка создается при записи)
+    # Если очередь заполнена, ждет, пока часть файлов запишется
+    def write(self, path, text):
+        with self.condition:
+            while self.error is None and self.pending and self.pending + len(text) > self.limit:
+                self.condition.wait()
+            if self.error is not None:
+                raise self.error
+            self.queue.append((path, text))
+            self.pending += len(text)
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed and self.error is None:
+                    self.condition.wait()
+                if not self.queue or self.error is not None:
+                    return
+                batch = [self.queue.popleft() for _ in range(min(len(self.queue), max(1, self.fsync_batch)))]
+            try:
+                write_batch(batch, self.fsync_batch > 0)
+            except BaseException as error:
+                with self.condition:
+                    self.error = self.error or error
+                    self.queue.clear()
+                    self.pending = 0
+                    self.condition.notify_all()
+                return
+            with self.condition:
+                self.pending -= sum(len(text) for path, text in batch)
+                self.condition.notify_all()
+
+    # Функция дожидается записи всех файлов из очереди
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        # Если конвертация уже упала, ошибка записи ее не заменяет
+        try:
+            self.close()
+        except Exception:
+            if exc_type is None:
+                raise
+
+# Функция записывает пачку файлов [(path, text)]: сначала все во временные файлы, затем (если fsync)
+# ждет записи на диск их всех, переименовывает и ждет записи папок. Так диск ждем раз на пачку, а не на каждый файл
+def write_batch(batch, fsync):
+    written = []
+    try:
+        for path, text in batch:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            written.append((write_temp_file(path, (text,)), path))
+        if fsync:
+            for tmp_path, path in written:
+                fsync_file(tmp_path)
+        while written:
+            tmp_path, path = written[-1]
+            os.replace(tmp_path, path)
+            written.pop()
+    except BaseException:
+        for tmp_path, path in written:
+            os.remove(tmp_path)
+        raise
+    if fsync:
+        for folder in sorted({os.path.dirname(path) or '.' for path, text in batch}):
+            fsync_folder(folder)
+
+def fsync_file(path):
+    fd = os.open(path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# Запись папки (переименований в ней) на диск. На Windows папку так не открыть, а некоторые файловые системы
+# fsync для папок не поддерживают - тогда просто пропускаем
+def fsync_folder(folder):
+    if os.name == 'nt':
+        return
+    try:
+        fd = os.open(folder, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+# Функция задает фоновый ввод-вывод: количество потоков чтения (0 - без фоновых потоков) и размер пачки fsync
+# Меняются только переданные настройки (None - оставить как есть)
+def configure_io(io_threads=None, fsync_batch=None):
+    global IO_THREADS, FSYNC_BATCH
+    if io_threads is not None:
+        IO_THREADS = io_threads
+    if fsync_batch is not None:
+        FSYNC_BATCH = fsync_batch
+
+
+# КОНВЕРТАЦИЯ В ПАМЯТИ
+
+# Для сервиса сборки, который получает вывод Kramdoc не файлами, а текстами: конвертируем пары
+# (путь относительно папки-источника, текст) и отдаем пары (путь относительно папки результата, текст),
+# ничего не читая и не записывая на диск. Правила с ограничением по путям и переименование index.adoc
+# в _index.adoc - те же, что при конвертации папок. Файлы не .adoc отдаются без изменений.
+# Тексты конвертируются в пуле процессов пачками по BATCH_SIZE, порядок результатов - как у входных пар.
+# Пул создается при первой пачке и живет, пока жив BatchConverter, поэтому запросы после первого
+# не тратят время на запуск процессов:
+# with BatchConverter(jobs=4) as converter:
+#     for rel_path, text in converter.convert(pairs):
+#         ...
+
+# Конвертация одной пары (для пула процессов): возвращает путь результата, текст, лог и статистику по правилам
+def convert_pair(pair):
+    rel_path, text = pair
+    records = []
+    rule_stats = {}
+    if rel_path.endswith('.adoc'):
+        text = convert_text(text, rel_path, records, rule_stats)
+    return target_rel_path(rel_path), text, records, rule_stats
+
+class BatchConverter:
+    # jobs - количество процессов (None - JOBS, а если и он не задан - по числу ядер процессора,
+    # 1 - все в текущем процессе), batch_size по умолчанию (None) - BATCH_SIZE.
+    # Настройки берутся при создании, а не при импорте, поэтому их можно менять из вызывающего кода
+    def __init__(self, jobs=None, batch_size=None):
+        self.jobs = jobs or JOBS or os.cpu_count() or 1
+        self.batch_size = batch_size or BATCH_SIZE
+        self.pool = None
+        # Статистика по правилам за все конвертации (как в print_rule_stats)
+        self.rule_stats = {}
+
+    # Функция конвертирует пары (путь, текст) из pairs (любой итерируемый объект, например очередь)
+    # и по одной отдает пары (путь результата, текст). Лог по каждому документу пишется как при конвертации папок
+    def convert(self, pairs):
+        if self.jobs <= 1:
+            results = map(convert_pair, pairs)
+        else:
+            if self.pool is None:
+                self.pool = create_pool(self.jobs)
+            results = self.pool.imap(convert_pair, pairs, chunksize=self.batch_size)
+        for rel_path, text, records, rule_stats in results:
+            write_log(os.path.normpath(rel_path), records)
+            merge_rule_stats(self.rule_stats, rule_stats)
+            yield rel_path, text
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# То же одной функцией, для разовой конвертации (пул закрывается, когда все пары отданы)
+def convert_texts(pairs, jobs=None, batch_size=None):
+    with BatchConverter(jobs, batch_size) as converter:
+        yield from converter.convert(pairs)
+
+
+# ИНКРЕМЕНТАЛЬНАЯ КОНВЕРТАЦИЯ
+
+# В папке с результатами хранится манифест: для каждого файла результата - хэш файла-источника,
+# отпечаток набора правил и список правил, которые относятся к файлу по его пути
+# (то есть попадание файла в translated, toclevel_pages и прочие ограничения по путям).
+# Если ничего из этого не изменилось и файл результата на месте, файл пропускается.
+
+# Версия формата манифеста: увеличиваем при изменении состава записей (манифест другой версии не читается,
+# все файлы конвертируются заново). Изменения правил сюда не относятся, они попадают в rules_fingerprint
+MANIFEST_VERSION = 1
+
+# Функция возвращает отпечаток набора правил: меняется при изменении любой регулярки, замены или словаря
+# Ограничения по путям сюда не входят, они хранятся отдельно для каждого файла (см. rule_scope)
+def rules_fingerprint(rules=RULES):
+    h = hashlib.sha256(str(RULES_VERSION).encode('utf8'))
+    for rule in rules:
+        parts = [type(rule).__name__, rule.name, rule.message]
+        if isinstance(rule, RegexRule):
+            parts += [rule.source, rule.repl, rule.skip_regions]
+        elif isinstance(rule, LiteralRule):
+            parts += [repr(list(rule.replacements.items()))]
+        elif isinstance(rule, FunctionRule):
+            parts += [rule.func.__name__]
+        h.update(repr(parts).encode('utf8'))
+    return h.hexdigest()
+
+# Функция возвращает описание того, какие правила выполняются для файла norm_path:
+# явно - попадание в списки translated и toclevel_pages, и хэш списка имен всех выполняемых правил
+def rule_scope(norm_path, rules=RULES):
+    key = path_key(norm_path)
+    names = [rule.name for rule in rules if rule.applies_to(key)]
+    return {'translated': key.endswith(translated),
+            'toclevel': key.endswith(toclevel_pages),
+            'scope': hashlib.sha256(','.join(names).encode('utf8')).hexdigest()[:16]}
+
+# Функция возвращает хэш содержимого файла. Файл читается блоками, чтобы не держать в памяти целиком
+def file_hash(path, block_size=1024 * 1024):
+    h = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+# Ключ файла в манифесте - путь относительно папки, всегда с прямыми слэшами
+def manifest_key(path, root):
+    return os.path.relpath(path, root).replace('\\', '/')
+
+def load_manifest(output_path):
+    manifest_path = os.path.join(output_path, MANIFEST_FILE_NAME)
+    if not os.path.exists(manifest_path):
+        return {}
+    try:
+        with open(manifest_path, 'r', encoding='utf8') as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        logger.warning('Manifest is broken, converting all files: ' + manifest_path)
+        return {}
+    if not isinstance(manifest, dict) or manifest.get('version') != MANIFEST_VERSION:
+        logger.info('Manifest version changed, converting all files: ' + manifest_path)
+        return {}
+    return manifest.get('files', {})
+
+# Манифест пишем через временный файл, чтобы при падении не остался недописанный
+def save_manifest(output_path, files):
+    manifest_path = os.path.join(output_path, MANIFEST_FILE_NAME)
+    with open(manifest_path + '.tmp', 'w', encoding='utf8') as file:
+        json.dump({'version': MANIFEST_VERSION, 'files': files}, file, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+# Функция удаляет пустые папки, начиная с folder и вверх до root (сама root не удаляется)
+def remove_empty_folders(folder, root):
+    root = os.path.abspath(root)
+    folder = os.path.abspath(folder)
+    while folder != root and folder.startswith(root) and not os.listdir(folder):
+        os.rmdir(folder)
+        folder = os.path.dirname(folder)
+
+# Функция возвращает имена папок и файлов .adoc из корня папки-источника, которые нужно конвертировать (из folders)
+def source_folders(source_path, folders=FOLDERS_TO_CONVERT):
+    names = [f.name for f in os.scandir(source_path) if (f.is_dir() or f.name.endswith('.adoc'))]
+    return sorted(name for name in names if name in folders)
+
+# Путь файла результата относительно папки результата по пути файла-источника относительно папки-источника
+# Файл index.adoc переименовываем в _index.adoc (так как он не будет публиковаться сам по себе)
+def target_rel_path(rel_path):
+    return '_index.adoc' if os.path.normpath(rel_path) == 'index.adoc' else rel_path
+
+# Функция возвращает список пар (файл-источник, файл результата) для всех файлов из subfolders_names
+# (см. source_folders). Файлы из корня берем просто по расширению, папки - со всеми поддеревьями
+def list_source_files(source_path, output_path, subfolders_names):
+    pairs = []
+    for folder in sorted(subfolders_names):
+        if folder.endswith('.adoc'):
+            pairs.append((os.path.join(source_path, folder), os.path.join(output_path, target_rel_path(folder))))
+        else:
+            for paths, subdirs, files in os.walk(os.path.join(source_path, folder)):
+                # Сортируем, чтобы порядок файлов (и лога) не зависел от файловой системы
+                subdirs.sort()
+                for file_name in sorted(files):
+                    source_file = os.path.join(paths, file_name)
+                    pairs.append((source_file, os.path.join(output_path, os.path.relpath(source_file, source_path))))
+    return pairs
+
+
+# Функция проходит по файлам-источникам и приводит папку результата в соответствие с ними:
+# конвертирует новые и измененные файлы .adoc, переносит остальные файлы, удаляет результаты удаленных источников
+# manifest - манифест прошлого запуска ({} - конвертировать все)
+# only - множество путей файлов и папок источника (os.path.normpath), которыми нужно ограничиться (None - все файлы),
+# например, измененные файлы в режиме наблюдения
+# Возвращает словарь с новым манифестом и итогами: сколько файлов сконвертировано, пропущено, удалено и тп.
+def sync_tree(source_path, output_path, subfolders_names, manifest, jobs, only=None):
+    fingerprint = rules_fingerprint()
+    # При обработке части файлов записи остальных файлов переносим из старого манифеста как есть
+    new_manifest = {} if only is None else dict(manifest)
+    pending = {}
+    tasks = []
+    skipped_count = 0
+    current_keys = set()
+
+    # Проходим по всем файлам-источникам, проверяя имена папок
+    # Неизмененные файлы (размер и время изменения те же) пропускаем, не читая
+    # Файлы .adoc откладываем на конвертацию, остальные сразу переносим в папку результата
+    for source_file, target_file in list_source_files(source_path, output_path, subfolders_names):
+        if only is not None and not path_changed(source_file, only):
+            continue
+        key = manifest_key(target_file, output_path)
+        current_keys.add(key)
+        new_manifest.pop(key, None)
+        stat = os.stat(source_file)
+        entry = {'source': manifest_key(source_file, source_path), 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+        norm_path = os.path.normpath(target_file)
+        if norm_path.endswith('.adoc'):
+            entry['rules'] = fingerprint
+            entry.update(rule_scope(norm_path))
+
+        old_entry = manifest.get(key, {})
+        target_exists = os.path.exists(target_file)
+        # Хэш прошлого запуска годится, только если правила и их область для файла не изменились
+        known_hash = old_entry.get('hash')
+        if any(old_entry.get(name) != value for name, value in entry.items() if name not in ('size', 'mtime')):
+            known_hash = None
+
+        if known_hash is not None and target_exists and old_entry.get('size') == stat.st_size \
+                and old_entry.get('mtime') == stat.st_mtime_ns:
+            entry['hash'] = known_hash
+            new_manifest[key] = entry
+            skipped_count += 1
+            continue
 
+        if norm_path.endswith('.adoc'):
+            # В манифест попадет только после успешной конвертации
+            pending[norm_path] = (key, entry)
+            tasks.append((source_file, target_file, known_hash))
+            continue
+
+        entry['hash'] = file_hash(source_file)
+        if entry['hash'] == known_hash and target_exists:
+            skipped_count += 1
+        else:
+            os.makedirs(os.path.dirname(target_file), exist_ok=True)
+            copy_asset(source_file, target_file)
+        new_manifest[key] = entry
+
+    # Удаляем результаты, у которых больше нет файла-источника
+    removed_count = 0
+    for key in manifest:
+        if key in current_keys:
+            continue
+        if only is not None:
+            if not path_changed(os.path.join(source_path, manifest[key].get('source', '')), only):
+                continue
+            del new_manifest[key]
+        target_file = os.path.join(output_path, key)
+        if os.path.exists(target_file):
+            os.remove(target_file)
+            logger.info('Removed: ' + str(os.path.normpath(target_file)))
+            removed_count += 1
+            remove_empty_folders(os.path.dirname(target_file), output_path)
+
+    # Конвертируем новые и измененные файлы .adoc: каждый файл читается из источника и пишется сразу в результат
+    # Лог пишем здесь, в порядке обхода папок, независимо от того, какой процесс конвертировал файл
+    file_count = 0
+    rule_stats = {}
+    file_stats = {}
+    over_budget = []
+    for norm_path, records, file_rule_stats, source_hash, budget_exceeded in convert_files(tasks, jobs):
+        key, entry = pending[norm_path]
+        if records is None:
+            entry['hash'] = source_hash
+            new_manifest[key] = entry
+            skipped_count += 1
+            continue
+        write_log(norm_path, records)
+        # Файл, скопированный без изменений, в манифест не пишем, чтобы в следующий раз сконвертировать его снова
+        if budget_exceeded:
+            over_budget.append(norm_path)
+            continue
+        entry['hash'] = source_hash
+        new_manifest[key] = entry
+        merge_rule_stats(rule_stats, file_rule_stats)
+        file_stats[norm_path] = file_rule_stats
+        file_count += 1
+
+    return {'manifest': new_manifest, 'converted': file_count, 'skipped': skipped_count, 'removed': removed_count,
+            'over_budget': over_budget, 'rule_stats': rule_stats, 'file_stats': file_stats}
+
+
+# ПРОВЕРКА ССЫЛОК
+
+# Ссылки xref: (и <<...>>) в папке результата проверяются по индексу всех страниц и якорей этой папки.
+# Якоря - явные (+++<a id="...">, [[id]], [#id], [id="..."], anchor:id[]) и id, которые Asciidoctor создает
+# для заголовков разделов (с XREF_IDPREFIX и XREF_IDSEPARATOR). Ссылка разрешается, как в Antora: путь с ./ или ../ -
+# от папки страницы, остальные пути - от корня папки результата, '+++' (см. правило plus_xref) не учитывается.
+# Ссылки на другие компоненты и модули (с ':' в пути), ссылки с атрибутами и все внутри блоков кода не проверяются
+# (код в строке `...` Asciidoctor обрабатывает, ссылки в нем работают).
+# Страницы разбираются в пуле процессов. Индекс сохраняется в папке результата (XREF_INDEX_FILE_NAME),
+# при следующей проверке заново разбираются только страницы с другим размером или временем изменения.
+
+# Версия индекса: увеличиваем при изменении разбора страниц
+XREF_INDEX_VERSION = 1
+
+# Одна регулярка на все якоря, заголовки разделов и ссылки: совпадения идут по порядку, номер строки считается по ходу
+# Опережающая проверка первого символа - для скорости, как в region_pattern
+xref_scan_pattern = re.compile(r'''(?=[<\[a=x])(?:
+    <a\s+(?:id|name)\s*=\s*(?:"(?P<html_id>[^"\n]+)"|'(?P<html_id_quoted>[^'\n]+)')
+  | \[\[(?P<block_id>[^\]\s,]+)(?:,[^\]\n]*)?\]\]
+  | \[\#(?P<hash_id>[^\]\s.%,#]+)
+  | ^\[id=(?:"(?P<attr_id>[^"\n]+)"|(?P<attr_id_bare>[^\]\s,"]+))
+  | anchor:(?P<inline_id>[^\s\[]+)\[
+  | ^={2,6}[ \t]+(?P<title>[^\n]*?)[ \t]*$
+  | xref:(?P<xref>[^\s\[]+)\[
+  | <<(?P<short_xref>[^\s<>,]+)(?:,[^<>\n]*)?>>
+)''', re.MULTILINE | re.VERBOSE)
+
+ANCHOR_GROUPS = ('html_id', 'html_id_quoted', 'block_id', 'hash_id', 'attr_id', 'attr_id_bare', 'inline_id')
+
+# Символы, которые Asciidoctor убирает из заголовка, создавая id раздела (теги, ссылки на символы, все кроме букв,
+# цифр, '_', пробела, '-' и '.')
+invalid_id_chars = re.compile(r'<[^>]+>|&(?:[a-z][a-z]+\d{0,2}|#\d\d\d{0,4}|#x[\da-f][\da-f][\da-f]{0,3});|[^ \w\-.]+')
+# Подчеркивания курсива (_text_, __text__): Asciidoctor берет заголовок уже после разметки, без них
+emphasis_marks = re.compile(r'(?<![^\W_])_+|_+(?![^\W_])')
+
+# Функция возвращает id, который Asciidoctor создаст для раздела с заголовком title
+# Если такой id на странице уже есть (taken), добавляется номер: _title_2, _title_3
+def section_id(title, taken, prefix=XREF_IDPREFIX, separator=XREF_IDSEPARATOR):
+    text = invalid_id_chars.sub('', emphasis_marks.sub('', title.lower()))
+    if separator:
+        text = re.sub('[ .-]+', separator, text)
+        if text.endswith(separator):
+            text = text[:-len(separator)]
+        if not prefix and text.startswith(separator):
+            text = text[len(separator):]
+    else:
+        text = re.sub('[ .-]', '', text)
+    base = prefix + text
+    section = base
+    number = 2
+    while section in taken:
+        section = base + (separator or '_') + str(number)
+        number += 1
+    return section
+
+# Функция возвращает страницу (путь от корня папки результата) и якорь (или '') по цели ссылки target
+# на странице rel_path, None - ссылку не проверяем. short - ссылка вида <<...>>: в ней без '#' и '.adoc' - только якорь
+def xref_target(target, rel_path, short=False):
+    target = target.replace('+++', '')
+    if '#' in target:
+        page, fragment = target.split('#', 1)
+    elif short and not target.endswith('.adoc'):
+        page, fragment = '', target
+    else:
+        page, fragment = target, ''
+    if ':' in page or '{' in target:
+        return None
+    if not page:
+        return rel_path, fragment
+    if page.startswith(('./', '../')):
+        page = posixpath.join(posixpath.dirname(rel_path), page)
+    return posixpath.normpath(page), fragment
+
+# Функция разбирает страницу результата: возвращает путь страницы, ее якоря
+# и ссылки [строка, цель ссылки, страница, якорь] (см. xref_target). task - (путь к файлу, путь от корня результата)
+def scan_page(task):
+    path, rel_path = task
+    with open(path, 'r', encoding='utf8') as file:
+        data = file.read()
+    inside = RegionTable(data).checker(('code',))
+    anchors = []
+    taken = set()
+    refs = []
+    line = 1
+    pos = 0
+    for m in xref_scan_pattern.finditer(data):
+        if inside(m.start()):
+            continue
+        line += data.count('\n', pos, m.start())
+        pos = m.start()
+        target = m.group('xref') or m.group('short_xref')
+        if target:
+            resolved = xref_target(target, rel_path, short=m.group('xref') is None)
+            if resolved is not None:
+                refs.append([line, target] + list(resolved))
+            continue
+        title = m.group('title')
+        anchor = section_id(title, taken) if title is not None else next(filter(None, map(m.group, ANCHOR_GROUPS)))
+        if anchor not in taken:
+            taken.add(anchor)
+            anchors.append(anchor)
+    return rel_path, anchors, refs
+
+def load_xref_index(output_path):
+    index_path = os.path.join(output_path, XREF_INDEX_FILE_NAME)
+    if not os.path.exists(index_path):
+        return {}
+    try:
+        with open(index_path, 'r', encoding='utf8') as file:
+            index = json.load(file)
+    except (OSError, ValueError):
+        logger.warning('Xref index is broken, parsing all pages: ' + index_path)
+        return {}
+    if index.get('version') != XREF_INDEX_VERSION or index.get('ids') != [XREF_IDPREFIX, XREF_IDSEPARATOR]:
+        return {}
+    return index.get('pages', {})
+
+# Индекс пишем через временный файл, как манифест
+# json.dumps, а не json.dump в файл: он кодирует все сразу (на C), для большого индекса это в разы быстрее
+def save_xref_index(output_path, pages):
+    index_path = os.path.join(output_path, XREF_INDEX_FILE_NAME)
+    with open(index_path + '.tmp', 'w', encoding='utf8') as file:
+        file.write(json.dumps({'version': XREF_INDEX_VERSION, 'ids': [XREF_IDPREFIX, XREF_IDSEPARATOR], 'pages': pages},
+                              ensure_ascii=False, separators=(',', ':')))
+    os.replace(index_path + '.tmp', index_path)
+
+# Функция разбирает страницы из tasks (см. scan_page), при jobs > 1 - в пуле процессов
+def scan_pages(tasks, jobs):
+    if jobs <= 1 or len(tasks) <= 1:
+        return map(scan_page, tasks)
+    with create_pool(jobs) as pool:
+        return pool.map(scan_page, tasks, chunksize=max(1, len(tasks) // (jobs * 4)))
+
+# Функция проверяет ссылки во всех страницах .adoc папки результата output_path
+# Возвращает словарь: сколько страниц в индексе ('pages') и сколько из них разобрано заново ('parsed'),
+# сколько ссылок проверено ('xrefs') и битые ссылки ('dangling'): список (путь страницы, строка, цель, причина),
+# причина - 'page' (нет страницы) или 'anchor' (на странице нет якоря)
+def check_xrefs(output_path=OUTPUT_FOLDER_NAME, jobs=JOBS):
+    jobs = jobs or os.cpu_count() or 1
+    old_pages = load_xref_index(output_path)
+    pages = {}
+    tasks = []
+    for paths, subdirs, files in os.walk(output_path):
+        subdirs.sort()
+        for file_name in sorted(files):
+            if not file_name.endswith('.adoc'):
+                continue
+            path = os.path.join(paths, file_name)
+            rel_path = manifest_key(path, output_path)
+            stat = os.stat(path)
+            page = old_pages.get(rel_path, {})
+            if page.get('size') == stat.st_size and page.get('mtime') == stat.st_mtime_ns:
+                pages[rel_path] = page
+            else:
+                pages[rel_path] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+                tasks.append((path, rel_path))
+
+    for rel_path, anchors, refs in scan_pages(tasks, jobs):
+        pages[rel_path]['anchors'] = anchors
+        pages[rel_path]['refs'] = refs
+    if tasks or len(pages) != len(old_pages):
+        save_xref_index(output_path, pages)
+
+    anchors = {rel_path: set(page['anchors']) for rel_path, page in pages.items()}
+    dangling = []
+    xref_count = 0
+    for rel_path, page in pages.items():
+        for line, target, target_page, fragment in page['refs']:
+            xref_count += 1
+            page_anchors = anchors.get(target_page)
+            if page_anchors is None:
+                dangling.append((rel_path, line, target, 'page'))
+            elif fragment and fragment not in page_anchors:
+                dangling.append((rel_path, line, target, 'anchor'))
+    return {'pages': len(pages), 'parsed': len(tasks), 'xrefs': xref_count, 'dangling': dangling}
+
+# Функция выводит итоги check_xrefs в лог (все битые ссылки) и в командную строку (первые limit)
+def report_xrefs(result, output_path, limit=20):
+    reasons = {'page': 'no such page', 'anchor': 'no such anchor'}
+    message = 'Xrefs checked: {} in {} pages ({} parsed), dangling: {}'.format(
+        result['xrefs'], result['pages'], result['parsed'], len(result['dangling']))
+    logger.info(message)
+    print(message)
+    for i, (rel_path, line, target, reason) in enumerate(result['dangling']):
+        text = '{}:{}: {} ({})'.format(os.path.normpath(os.path.join(output_path, rel_path)), line, target,
+                                       reasons[reason])
+        logger.warning('Dangling xref: ' + text)
+        if i < limit:
+            print('  ' + text)
+    if len(result['dangling']) > limit:
+        print('  ... and {} more (see log)'.format(len(result['dangling']) - limit))
+
+
+# РЕЖИМ НАБЛЮДЕНИЯ
+
+# python convert_adoc.py --watch - после обычной конвертации скрипт не завершается, а следит за папкой-источником
+# и конвертирует только измененные, новые и удаленные файлы. Правила уже скомпилированы, манифест держится в памяти
+# (и сохраняется после каждой конвертации), поэтому правка одного файла обрабатывается за миллисекунды.
+# Изменения берутся из inotify (Linux), иначе папка опрашивается раз в WATCH_INTERVAL секунд.
+# Несколько изменений подряд (сохранение нескольких файлов, git checkout) собираются в одну конвертацию (WATCH_DEBOUNCE).
+# После конвертации можно запустить команду (WATCH_HOOK, --hook), например пересборку Antora.
+# Новые папки верхнего уровня и изменения самого скрипта подхватываются только после перезапуска.
+
+# Функция проверяет, входит ли файл в множество путей only: сам файл или одна из папок, в которых он лежит
+# (переименованная или удаленная папка приходит одним путем)
+def path_changed(path, only):
+    path = os.path.normpath(path)
+    while path not in only:
+        parent = os.path.dirname(path)
+        if parent == path or not parent:
+            return False
+        path = parent
+    return True
+
+# Функция возвращает пути, за которыми нужно следить: папки и файлы .adoc из корня источника (см. source_folders)
+def watch_roots(source_path, subfolders_names):
+    return [os.path.normpath(os.path.join(source_path, folder)) for folder in sorted(subfolders_names)]
+
+# Поиск изменений опросом: каждый раз снимаем размер и время изменения всех файлов и сравниваем с прошлым разом
+# interval по умолчанию (None) - WATCH_INTERVAL на момент создания
+class PollingWatcher:
+    def __init__(self, roots, interval=None):
+        self.roots = roots
+        self.interval = WATCH_INTERVAL if interval is None else interval
+        self.state = self.snapshot()
+
+    def snapshot(self):
+        state = {}
+        stack = list(self.roots)
+        while stack:
+            path = stack.pop()
+            try:
+                if os.path.isdir(path):
+                    for entry in os.scandir(path):
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        else:
+                            stat = entry.stat()
+                            state[os.path.normpath(entry.path)] = (stat.st_size, stat.st_mtime_ns)
+                elif os.path.exists(path):
+                    stat = os.stat(path)
+                    state[path] = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                # Файл или папку удалили во время обхода, заметим на следующем опросе
+                continue
+        return state
+
+    # Функция ждет не дольше timeout секунд (None - пока не будет изменений) и возвращает множество измененных путей
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            delay = self.interval if deadline is None else min(self.interval, max(0, deadline - time.monotonic()))
+            time.sleep(delay)
+            state = self.snapshot()
+            changed = {path for path in state.keys() | self.state.keys() if state.get(path) != self.state.get(path)}
+            self.state = state
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+
+    def close(self):
+        pass
+
+# Поиск изменений через inotify (Linux), функции берем из libc через ctypes (импортируется только здесь)
+# Флаги событий - из <sys/inotify.h>
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+INOTIFY_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE \
+    | IN_DELETE_SELF | IN_MOVE_SELF
+# Заголовок события: wd, mask, cookie, длина имени
+inotify_event = struct.Struct('iIII')
+
+class InotifyWatcher:
+    def __init__(self, roots):
+        import ctypes
+        import ctypes.util
+        self.get_errno = ctypes.get_errno
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(self.get_errno(), 'inotify_init1 failed')
+        self.roots = roots
+        # Какой папке соответствует каждый дескриптор наблюдения
+        self.folders = {}
+        # Файлы из корня источника: следим за самим корнем и берем события только по ним
+        self.root_files = set()
+        self.root_folders = set()
+        try:
+            for root in roots:
+                if os.path.isdir(root):
+                    self.add_tree(root)
+                else:
+                    self.root_files.add(root)
+                    self.root_folders.add(os.path.dirname(root))
+            for folder in self.root_folders:
+                self.add_folder(folder)
+        except OSError:
+            self.close()
+            raise
+
+    def add_folder(self, folder):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), INOTIFY_MASK)
+        if wd < 0:
+            # ENOSPC - закончился лимит fs.inotify.max_user_watches
+            raise OSError(self.get_errno(), 'inotify_add_watch failed: ' + folder)
+        self.folders[wd] = folder
+
+    def add_tree(self, folder):
+        for paths, subdirs, files in os.walk(folder):
+            self.add_folder(os.path.normpath(paths))
+
+    # Функция ждет не дольше timeout секунд (None - пока не будет изменений) и возвращает множество измененных путей
+    # None вместо множества - очередь событий переполнилась, нужно проверить все файлы
+    def wait(self, timeout=None):
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+        changed = set()
+        while True:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return changed
+            pos = 0
+            while pos < len(buf):
+                wd, mask, cookie, length = inotify_event.unpack_from(buf, pos)
+                name = os.fsdecode(buf[pos + inotify_event.size:pos + inotify_event.size + length].rstrip(b'\0'))
+                pos += inotify_event.size + length
+                if mask & IN_Q_OVERFLOW:
+                    changed = None
+                    continue
+                folder = self.folders.get(wd)
+                if folder is None:
+                    continue
+                if mask & IN_IGNORED:
+                    del self.folders[wd]
+                    continue
+                path = os.path.join(folder, name) if name else folder
+                if folder in self.root_folders and path not in self.root_files:
+                    continue
+                # В новую папку могли успеть положить файлы до того, как мы на нее подписались
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    try:
+                        self.add_tree(path)
+                    except OSError:
+                        changed = None
+                if changed is not None:
+                    changed.add(path)
+
+    def close(self):
+        os.close(self.fd)
+
+# Функция создает наблюдателя: inotify, если он есть и не отключен, иначе опрос
+def create_watcher(roots, polling=False):
+    if not polling and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(roots)
+        except (OSError, AttributeError) as e:
+            logger.warning('inotify is not available, polling source folder: ' + str(e))
+    return PollingWatcher(roots)
+
+# Функция ждет первого изменения и собирает все следующие, пока они идут чаще, чем раз в debounce секунд
+# (но не дольше 10 debounce, чтобы постоянная запись не откладывала конвертацию навсегда)
+# Возвращает множество измененных путей или None - проверить все файлы. debounce по умолчанию (None) - WATCH_DEBOUNCE
+def wait_changes(watcher, debounce=None):
+    if debounce is None:
+        debounce = WATCH_DEBOUNCE
+    changed = watcher.wait()
+    deadline = time.monotonic() + debounce * 10
+    while time.monotonic() < deadline:
+        more = watcher.wait(debounce)
+        if not more and more is not None:
+            break
+        changed = None if (changed is None or more is None) else changed | more
+    return changed
+
+# Функция запускает команду hook (через оболочку) и выводит код возврата, если он не 0
+def run_hook(hook):
+    import subprocess
+    start = time.perf_counter()
+    returncode = subprocess.run(hook, shell=True).returncode
+    logger.info('Hook finished with code ' + str(returncode) + ': ' + hook)
+    if returncode != 0:
+        print('Hook failed with code ' + str(returncode) + ': ' + hook)
+    else:
+        print('Hook finished in {:.2f} s'.format(time.perf_counter() - start))
+
+# Функция следит за папкой-источником и конвертирует изменения, пока ее не прервут (Ctrl+C)
+# manifest - манифест после первой конвертации, дальше он обновляется в памяти
+# check - проверять ссылки после каждой конвертации (см. ПРОВЕРКА ССЫЛОК)
+def watch(source_path, output_path, subfolders_names, manifest, jobs, hook=WATCH_HOOK, polling=False,
+          check=CHECK_XREFS):
+    watcher = create_watcher(watch_roots(source_path, subfolders_names), polling)
+    logger.info('Watching source folder (' + type(watcher).__name__ + ')')
+    print('Watching ' + os.path.abspath(source_path) + ' for changes, press Ctrl+C to stop')
+    try:
+        while True:
+            changed = wait_changes(watcher)
+            start = time.perf_counter()
+            result = sync_tree(source_path, output_path, subfolders_names, manifest, jobs, changed)
+            manifest = result['manifest']
+            if INCREMENTAL:
+                save_manifest(output_path, manifest)
+            if not (result['converted'] or result['removed'] or result['over_budget']):
+                continue
+            seconds = time.perf_counter() - start
+            message = 'Converted: {}, removed: {}, over time budget: {} ({:.0f} ms)'.format(
+                result['converted'], result['removed'], len(result['over_budget']), seconds * 1000)
+            logger.info(message)
+            log_summary(result, seconds)
+            print(datetime.now().strftime('%H:%M:%S') + ' ' + message)
+            if check:
+                report_xrefs(check_xrefs(output_path, jobs), output_path)
+            if hook:
+                run_hook(hook)
+    except KeyboardInterrupt:
+        print('Watch stopped')
+    finally:
+        watcher.close()
+
+
+# Функция создает файлы лога в текущей папке и направляет в них лог через очередь (см. ЛОГ)
+# Только при запуске скрипта, не при импорте. log_format - как LOG_FORMAT. Возвращает пути файлов лога
+def setup_logging(log_format=LOG_FORMAT):
+    global log_queue
+    import atexit
+    from logging.handlers import QueueHandler, QueueListener
+
+    cur_time = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    log_file = os.path.join('./', 'convert_adoc_' + cur_time)
+
+    # Файлы лога открываются на перезапись, если они уже есть
+    log_queue = queue.SimpleQueue()
+    handlers = []
+    if log_format in ('text', 'both'):
+        handlers.append(LogFileHandler(log_file + '.log', render_text, log_queue))
+    if log_format in ('jsonl', 'both'):
+        handlers.append(LogFileHandler(log_file + '.jsonl', render_json, log_queue, encoding='utf8'))
+
+    root = logging.getLogger()
+    root.setLevel(logging.DEBUG)
+    root.addHandler(QueueHandler(log_queue))
+    listener = QueueListener(log_queue, *handlers)
+    listener.start()
+    # Перед выходом поток лога дописывает очередь (файлы закрывает logging.shutdown, он выполняется позже)
+    atexit.register(listener.stop)
+    return [handler.baseFilename for handler in handlers]
+
+# Функция конвертирует все файлы из папок folders папки-источника source_path в папку результата output_path
+# (инкрементально, если не задано full). jobs - количество процессов (None - по числу ядер процессора),
+# clean - очистить папку результата перед конвертацией. Режим правил задается через configure.
+# Возвращает итоги sync_tree и список конвертируемых папок ('subfolders').
+# Если в папке-источнике нет ни одной папки из folders - FileNotFoundError
+def convert_tree(source_path=SOURCE_PATH, output_path=OUTPUT_FOLDER_NAME, jobs=JOBS, full=False,
+                 folders=FOLDERS_TO_CONVERT, clean=CLEAN_TARGET_FOLDER):
+    start = time.perf_counter()
+    jobs = jobs or os.cpu_count() or 1
+
+    # Выводим пути источника и результата 
+    logger.info('Source path: ' + str(os.path.abspath(source_path)))
+    logger.info('Output path: ' + str(os.path.abspath(output_path)))
+
+    # Берем имена нужных папок внутри папки-источника
+    subfolders_names = source_folders(source_path, folders)
+    if not subfolders_names:
+        raise FileNotFoundError('No folders found in source folder with names from: ' + str(folders))
+
+    # Чистим папку для результатов конвертации, если она есть и настройка True
+    if os.path.exists(output_path) and clean:
+        shutil.rmtree(output_path)
+
+    # Создаем папку для результатов конвертации
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+
+    # Читаем манифест прошлого запуска
+    manifest = {} if (full or not INCREMENTAL) else load_manifest(output_path)
+    result = sync_tree(source_path, output_path, subfolders_names, manifest, jobs)
+    result['subfolders'] = subfolders_names
+
+    if INCREMENTAL:
+        save_manifest(output_path, result['manifest'])
+
+    # Выводим количество сконвертированных файлов
+    logger.info('Files converted total: ' + str(result['converted']))
+    logger.info('Files skipped (unchanged): ' + str(result['skipped']))
+    logger.info('Files removed: ' + str(result['removed']))
+    if result['over_budget']:
+        logger.warning('Files over time budget (copied unchanged): ' + str(len(result['over_budget'])))
+    log_summary(result, time.perf_counter() - start)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Конвертация документов adoc после Kramdoc под Antora')
+    parser.add_argument('-j', '--jobs', type=int, default=JOBS,
+                        help='количество процессов для конвертации (по умолчанию - по числу ядер процессора)')
+    parser.add_argument('--full', action='store_true',
+                        help='сконвертировать все файлы заново, не глядя на манифест прошлого запуска')
+    parser.add_argument('--profile', default=PROFILE_FILE,
+                        help='записать статистику по правилам и файлам в JSON или CSV (по расширению файла)')
+    parser.add_argument('--top', type=int, default=PROFILE_TOP,
+                        help='сколько самых медленных правил и файлов выводить (по умолчанию %(default)s)')
+    parser.add_argument('--hardened', action=argparse.BooleanOptionalAction, default=HARDENED_RULES,
+                        help='выполнять правила в устойчивом варианте (по умолчанию %(default)s)')
+    parser.add_argument('--time-budget', type=float, default=TIME_BUDGET,
+                        help='бюджет времени на один файл в секундах, 0 - без ограничения (по умолчанию %(default)s)')
+    parser.add_argument('--prefilter', action=argparse.BooleanOptionalAction, default=LITERAL_PREFILTER,
+                        help='пропускать правила, для которых в тексте нет их литералов (по умолчанию %(default)s)')
+    parser.add_argument('--io-threads', type=int, default=IO_THREADS,
+                        help='потоков для чтения и записи файлов в фоне, для сетевых и синхронизируемых папок; '
+                             '0 - без фонового ввода-вывода (по умолчанию %(default)s)')
+    parser.add_argument('--fsync-batch', type=int, default=FSYNC_BATCH,
+                        help='сколько файлов результата записывать на диск за раз (вместе с --io-threads), '
+                             '0 - без fsync (по умолчанию %(default)s)')
+    parser.add_argument('--watch', action='store_true',
+                        help='после конвертации следить за папкой-источником и конвертировать изменения')
+    parser.add_argument('--poll', action='store_true',
+                        help='в режиме наблюдения опрашивать папку-источник вместо inotify')
+    parser.add_argument('--hook', default=WATCH_HOOK,
+                        help='команда, которая запускается после каждой конвертации в режиме наблюдения')
+    parser.add_argument('--check-xrefs', action=argparse.BooleanOptionalAction, default=CHECK_XREFS,
+                        help='проверить ссылки xref в папке результата после конвертации (по умолчанию %(default)s)')
+    parser.add_argument('--log-format', choices=('text', 'jsonl', 'both'), default=LOG_FORMAT,
+                        help='какие файлы лога писать (по умолчанию %(default)s)')
+    parser.add_argument('--render-log', metavar='JSONL',
+                        help='вывести лог JSONL в текстовом виде (как файл .log) и выйти')
+    args = parser.parse_args()
+    if args.render_log:
+        render_log(args.render_log)
+        return
+    configure(args.hardened, args.time_budget, args.prefilter)
+    configure_io(args.io_threads, args.fsync_batch)
+
+    setup_logging(args.log_format)
+    try:
+        result = convert_tree(jobs=args.jobs, full=args.full)
+    except FileNotFoundError as e:
+        # Если не нашли нужных папок, то выдаем сообщение и выходим
+        logger.warning(str(e))
+        sys.exit()
+    over_budget = result['over_budget']
+
+    # Выводим в командную строку сообщение об окончании процесса
+    print('Files converted total: ' + str(result['converted']))
+    print('Files skipped (unchanged): ' + str(result['skipped']))
+    print('Files removed: ' + str(result['removed']))
+    if over_budget:
+        print('Files over time budget (copied unchanged): ' + str(len(over_budget)))
+        for norm_path in over_budget:
+            print('  ' + norm_path)
+    print_rule_stats(result['rule_stats'])
+    print_profile_summary(result['rule_stats'], result['file_stats'], args.top)
+    if args.profile:
+        write_profile(args.profile, result['rule_stats'], result['file_stats'])
+        print('Profile: ' + args.profile)
+    print('Conversion finished')
+
+    dangling = []
+    if args.check_xrefs:
+        xrefs = check_xrefs(OUTPUT_FOLDER_NAME, args.jobs)
+        report_xrefs(xrefs, OUTPUT_FOLDER_NAME)
+        dangling = xrefs['dangling']
+
+    if args.watch:
+        watch(SOURCE_PATH, OUTPUT_FOLDER_NAME, result['subfolders'], result['manifest'],
+              args.jobs or os.cpu_count() or 1, args.hook, args.poll, args.check_xrefs)
+    elif dangling:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -15,12 +15,271 @@ https://wiki.yandex.ru/engee/dokumentacija/razrabotka-dokumentacii/julia-dokumen
 В результате документ в старом формате преобразуется в новый с сохранением всех текстов описания, 
 но с новыми ссылками на объекты(@binding и @typesig)
 
-Запуск скрипта производится без параметров: 
+Первые строки docstrings ищутся по индексу (FirstLineIndex): сначала точно, потом с точностью до пробелов,
+а сразу после открывающих кавычек - еще и нечетко (расстояние Левенштейна, см. FUZZY_MAX_RATIO).
+Нечетко сопоставленные строки выводятся с пометкой 'Fuzzy first line', ненайденные - 'First line not found'.
+
+Блоки старого формата сопоставляются с блоками нового не по отдельности, а выравниванием двух последовательностей
+(см. ВЫРАВНИВАНИЕ БЛОКОВ): ключ блока - нормализованная первая строка (описание переведено, поэтому в ключ не входит),
+совпадающие ключи выравниваются с учетом порядка блоков. Так одинаковые первые строки (несколько методов одной функции)
+получают binding и typesig своего по порядку блока. Каждому назначению выставляется уверенность (CONFIDENCE_*),
+назначения ниже MIN_CONFIDENCE выводятся с пометкой 'Low confidence' и попадают в нерешенные случаи.
+
+Запуск скрипта без параметров конвертирует один файл, указанный в теле скрипта (file_name, source_path, target_path): 
 python convert_docstrings.py
+
+Пакетный режим: все файлы с одинаковыми именами из двух папок конвертируются параллельно в нескольких процессах,
+результаты пишутся в --output-dir, а общий отчет в JSON (счетчики по файлам и нерешенные случаи с номерами строк) - в --report.
+Если остались нерешенные случаи, скрипт завершается с кодом 1:
+python convert_docstrings.py --source-dir <папка нового формата> --target-dir <папка старого формата> --output-dir converted --jobs 4
+
+Файлы нового формата разбираются один раз и кэшируются в .docstring_index_cache (см. docstring_index.py),
+повторные запуски по тому же источнику берут разбор из кэша. Отключить кэш: --no-cache
 """
 
 import os
 import re
+import sys
+import json
+import argparse
+import multiprocessing
+from bisect import bisect_left
+
+from docstring_index import load_index, CACHE_DIR
+
+# Допустимая доля отличий (расстояние Левенштейна к длине строки) при нечетком поиске первых строк
+FUZZY_MAX_RATIO = 0.1
+
+# Уверенность в назначении binding (произведение множителей, см. ВЫРАВНИВАНИЕ БЛОКОВ):
+# первая строка уникальна в обоих файлах / повторяется и выровнена по порядку блоков / найдена нечетко
+CONFIDENCE_UNIQUE = 1.0
+CONFIDENCE_ORDER = 0.9
+CONFIDENCE_FUZZY = 0.8
+# Старый binding входит в новый (а не наоборот) / не связан с новым
+CONFIDENCE_REVERSE = 0.9
+CONFIDENCE_MISMATCH = 0.5
+# Блок не выровнен, но старый binding точно совпал с одним из binding источника
+CONFIDENCE_EXCEPTION = 0.6
+# Назначения с меньшей уверенностью попадают в нерешенные случаи
+MIN_CONFIDENCE = 0.6
+# Сколько пар совпадающих ключей на блок допускается при выравнивании повторяющихся первых строк (см. align_blocks)
+ALIGN_MAX_PAIRS = 32
+
+
+# Функция нормализует строку для нечеткого поиска: убирает пробелы по краям и схлопывает пробельные символы
+def normalize_line(line):
+    return ' '.join(line.split())
+
+# Функция считает расстояние Левенштейна между строками, но не больше max_dist
+# (если расстояние больше, возвращает max_dist + 1). Считается только полоса шириной 2*max_dist+1 вокруг диагонали
+def bounded_distance(a, b, max_dist):
+    if abs(len(a) - len(b)) > max_dist:
+        return max_dist + 1
+    too_far = max_dist + 1
+    prev = [j if j <= max_dist else too_far for j in range(len(b) + 1)]
+    for i in range(1, len(a) + 1):
+        cur = [too_far] * (len(b) + 1)
+        if i <= max_dist:
+            cur[0] = i
+        lo = max(1, i - max_dist)
+        hi = min(len(b), i + max_dist)
+        for j in range(lo, hi + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost, too_far)
+        if min(cur[lo - 1:hi + 1]) > max_dist:
+            return too_far
+        prev = cur
+    return prev[len(b)]
+
+# Индекс первых строк docstrings из файла нового формата
+# Точный поиск - по множеству, поиск с точностью до пробелов - по словарю нормализованных строк,
+# нечеткий поиск - расстояние Левенштейна только до кандидатов с тем же началом или концом строки
+class FirstLineIndex:
+    # Длина начала/конца строки, по которым отбираются кандидаты для нечеткого поиска
+    BUCKET = 6
+
+    def __init__(self, first_lines, max_ratio=FUZZY_MAX_RATIO):
+        self.max_ratio = max_ratio
+        self.exact = set(first_lines)
+        self.normalized = {}
+        self.by_prefix = {}
+        self.by_suffix = {}
+        for line in first_lines:
+            norm = normalize_line(line)
+            self.normalized.setdefault(norm, line)
+            self.by_prefix.setdefault(norm[:self.BUCKET], []).append(norm)
+            self.by_suffix.setdefault(norm[-self.BUCKET:], []).append(norm)
+
+    def __contains__(self, line):
+        return line in self.exact
+
+    # Функция возвращает первую строку из источника, соответствующую line, или None
+    # fuzzy=False - только точное совпадение или совпадение с точностью до пробелов
+    def resolve(self, line, fuzzy=True):
+        if line in self.exact:
+            return line
+        norm = normalize_line(line)
+        if norm in self.normalized:
+            return self.normalized[norm]
+        if not fuzzy or not norm:
+            return None
+
+        max_dist = max(1, int(len(norm) * self.max_ratio))
+        candidates = set(self.by_prefix.get(norm[:self.BUCKET], ())) | set(self.by_suffix.get(norm[-self.BUCKET:], ()))
+        best = None
+        best_dist = max_dist + 1
+        ambiguous = False
+        for candidate in candidates:
+            dist = bounded_distance(norm, candidate, max_dist)
+            if dist < best_dist:
+                best, best_dist, ambiguous = candidate, dist, False
+            elif dist == best_dist and dist <= max_dist:
+                ambiguous = True
+        # Если есть несколько одинаково близких кандидатов, не угадываем
+        if best is None or ambiguous:
+            return None
+        return self.normalized[best]
+
+
+# ВЫРАВНИВАНИЕ БЛОКОВ
+
+# Функция возвращает наибольшую строго возрастающую по обоим элементам подпоследовательность пар (i, j),
+# упорядоченных по i, а при равных i - по убыванию j. Сортировка терпением: O(n log n) от количества пар
+def longest_increasing(pairs):
+    tails = []
+    tail_items = []
+    back = []
+    for k, (i, j) in enumerate(pairs):
+        n = bisect_left(tails, j)
+        if n == len(tails):
+            tails.append(j)
+            tail_items.append(k)
+        else:
+            tails[n] = j
+            tail_items[n] = k
+        back.append(tail_items[n - 1] if n else -1)
+    result = []
+    k = tail_items[-1] if tail_items else -1
+    while k != -1:
+        result.append(pairs[k])
+        k = back[k]
+    result.reverse()
+    return result
+
+# Функция выравнивает последовательности ключей блоков old_keys (старый формат) и new_keys (новый формат)
+# по алгоритму patience diff: совпадающие начало и конец отрезка сопоставляются сразу, затем опорами берутся ключи,
+# которые встречаются в отрезке ровно один раз в обоих файлах (из них - наибольшая возрастающая цепочка),
+# и то же повторяется в промежутках между опорами. Если уникальных ключей в промежутке нет, промежуток выравнивается
+# по наибольшей общей подпоследовательности (Хант-Шиманский: все пары совпадающих ключей и та же возрастающая цепочка).
+# Если таких пар слишком много (ALIGN_MAX_PAIRS на блок), повторяющиеся ключи сопоставляются по номеру вхождения
+# (k-й блок с этим ключом в старом файле - k-му в новом). Ключ None не совпадает ни с чем.
+# Возвращает список: для каждого старого блока номер нового блока или None
+def align_blocks(old_keys, new_keys):
+    matches = [None] * len(old_keys)
+    stack = [(0, len(old_keys), 0, len(new_keys))]
+    while stack:
+        old_lo, old_hi, new_lo, new_hi = stack.pop()
+        while old_lo < old_hi and new_lo < new_hi and old_keys[old_lo] is not None \
+                and old_keys[old_lo] == new_keys[new_lo]:
+            matches[old_lo] = new_lo
+            old_lo += 1
+            new_lo += 1
+        while old_lo < old_hi and new_lo < new_hi and old_keys[old_hi - 1] is not None \
+                and old_keys[old_hi - 1] == new_keys[new_hi - 1]:
+            old_hi -= 1
+            new_hi -= 1
+            matches[old_hi] = new_hi
+        if old_lo == old_hi or new_lo == new_hi:
+            continue
+
+        # Позиции ключей в отрезке нового файла (None не сопоставляется, поэтому в словарь не попадает)
+        new_positions = {}
+        for j in range(new_lo, new_hi):
+            if new_keys[j] is not None:
+                new_positions.setdefault(new_keys[j], []).append(j)
+        old_counts = {}
+        for i in range(old_lo, old_hi):
+            key = old_keys[i]
+            if key in new_positions:
+                old_counts[key] = old_counts.get(key, 0) + 1
+        pairs = [(i, new_positions[old_keys[i]][0]) for i in range(old_lo, old_hi)
+                 if old_counts.get(old_keys[i]) == 1 and len(new_positions[old_keys[i]]) == 1]
+        if not pairs:
+            pair_count = sum(len(new_positions[key]) * count for key, count in old_counts.items())
+            if pair_count <= ALIGN_MAX_PAIRS * (old_hi - old_lo + new_hi - new_lo):
+                for i in range(old_lo, old_hi):
+                    pairs.extend((i, j) for j in reversed(new_positions.get(old_keys[i], ())))
+            else:
+                seen = {}
+                for i in range(old_lo, old_hi):
+                    key = old_keys[i]
+                    if key in new_positions:
+                        k = seen.get(key, 0)
+                        seen[key] = k + 1
+                        if k < len(new_positions[key]):
+                            pairs.append((i, new_positions[key][k]))
+        anchors = longest_increasing(pairs)
+        if not anchors:
+            continue
+
+        # Промежутки между опорами выравниваем так же
+        prev_old, prev_new = old_lo, new_lo
+        for i, j in anchors:
+            matches[i] = j
+            stack.append((prev_old, i, prev_new, j))
+            prev_old, prev_new = i + 1, j + 1
+        stack.append((prev_old, old_hi, prev_new, new_hi))
+    return matches
+
+# Функция возвращает множитель уверенности по тому, как старый binding (строка после закрывающих кавычек)
+# соотносится с новым binding, и название случая для счетчиков
+def binding_evidence(line, binding):
+    if binding in line:
+        return CONFIDENCE_UNIQUE, 'normal'
+    if line in binding:
+        return CONFIDENCE_REVERSE, 'reverse'
+    return CONFIDENCE_MISMATCH, 'mismatch'
+
+
+# Метка места для нового binding и строка binding после закрывающих кавычек
+# (binding ищем заглядыванием вперед, чтобы найти все позиции, даже перекрывающиеся)
+place_mark = '@@PLACE'
+binding_line_pattern = re.compile(r'(?="""\n(?P<group1>[^\s@].*?)\n)')
+
+# Функция заменяет каждую метку @@PLACE на ближайшую следующую за ней строку binding (первая строка после """,
+# которая не начинается с пробела или @). Раньше это делалось повторением re.subn, пока есть замены:
+# за один проход заменялась только первая метка перед каждым binding, и для множественных блоков проходов было много.
+# Здесь один проход: идем по строкам binding по порядку, копим в стеке метки, которые встретились до очередного
+# binding, и заменяем их все на этот binding. Возвращает кортеж (текст, количество замен)
+def resolve_places(data):
+    places = []
+    pos = data.find(place_mark)
+    while pos != -1:
+        places.append(pos)
+        pos = data.find(place_mark, pos + len(place_mark))
+    if not places:
+        return data, 0
+
+    pieces = []
+    pending = []
+    pos = 0
+    next_place = 0
+    replace_count = 0
+    for m in binding_line_pattern.finditer(data, places[0]):
+        while next_place < len(places) and places[next_place] + len(place_mark) <= m.start():
+            pending.append(places[next_place])
+            next_place += 1
+        for place in pending:
+            pieces.append(data[pos:place])
+            pieces.append(m.group(1))
+            pos = place + len(place_mark)
+            replace_count += 1
+        pending.clear()
+        if next_place == len(places):
+            break
+    pieces.append(data[pos:])
+    return ''.join(pieces), replace_count
+
 
 # Задаем имя файла для конвертации
 file_name = 'base.md'
@@ -29,237 +288,415 @@ file_name = 'base.md'
 source_path = r"C:\Users\bidon\OneDrive\Документы\Ритм\Docstrings\v1.8.5_4_NewFromat"
 target_path = r"C:\Users\bidon\OneDrive\Документы\Ритм\Translated_Files\v1_8_5_Docstrings_From_Translators"
 
-source = os.path.normpath(source_path) + '\\' + file_name
-target = os.path.normpath(target_path) + '\\' + file_name
-#print()
-#print(source)
-
-with open(source, 'r', encoding='utf8') as file:
-    data = file.read()
-    #print(data)
-
-# Считаем кавычки и объекты 
-count_quotes = len(re.findall(r'"""', data))
-print()
-print('Count of """ in source: ', count_quotes)
-print('Count of objects in source: ', count_quotes/2)
-
-# Парсим файл с новым форматом
-#reg = r'\"\"\"\n(\s{4})?(?P<group1>.*?)\n(?P<group2>[\s\S]*?)\"\"\"\n@binding:\s(?P<group3>.*?)\n@typesig:\s(?P<group4>.*?)\n'
-
-r = re.compile('\"\"\"\n(\s{4})?(?P<group1>.*?)\n(?P<group2>[\s\S]*?)\"\"\"\n@binding:\s(?P<group3>.*?)\n@typesig:\s(?P<group4>.*?)\n')
-res = [m.groupdict() for m in r.finditer(data)]
-
-list_first_string = []
-list_binding = []
-list_typesig = []
-
-
-# Сохраняем в списки отдельно первые строки, байндинги и тайпсиги
-for item in res:
-    list_first_string.append(item['group1'])
-    list_binding.append(item['group3'])
-    list_typesig.append(item['group4'])
-
-print('Found first strings in source: ', len(list_first_string))
-print()
-
-#for l in list_first_string:
-#    print(l)
-
-dict_source = {}
-dict_source_simple = {}
-
-# Делаем вложенный словарь соответствий
-for i in range(len(list_first_string)):
-    dict_source[list_first_string[i]] = {'binding':list_binding[i], 'typesig':list_typesig[i]}
-#print(dict_source) 
-
-# Упрощенный словарь без первых строк
-for i in range(len(list_binding)):
-    dict_source_simple[list_binding[i]] = list_typesig[i]
-#print(dict_source_simple) 
-
-
-# Переходим к файлу, который нужно конвертить
-
-with open(target, 'r', encoding='utf8') as file2:
-    data_target = file2.read()
-#print()
-#print('Target file:', target)
-
-#count_to_replace = len(re.findall(r'\n\n\s\s\s\s', data_target))
-#print('Count to replace: ', count_to_replace)
-
-count_quotes = len(re.findall(r'"""', data_target))
-print('Count of """ in target: ', count_quotes)
-print('Count of objects in target: ', count_quotes/2)
-
-count_first_lines = 0
-
-prev_line = '@@@@@@@@'
-
-# Ищем первые строки и метим их
-lines = data_target.splitlines()
-lines_ed = []
-for line in lines:
-    if line[4:] in list_first_string and prev_line == '"""':
-        #print(line)
-        line_ed = re.sub(r'\s{4}', r'    @@@@', line)
-        #print(line_ed)
-        count_first_lines += 1
-    # Выкалываем некоторые случаи, где первая строка - короткое частое слово
-    elif (line[4:] in list_first_string) and (prev_line == '') and (not line[4:] in ['let', '...']):
-        #print(line)
-        line_ed = re.sub(r'\s{4}', r'    @@@@', line)
-        #print(line_ed)
-        count_first_lines += 1
-    else: line_ed = line
-    lines_ed.append(line_ed)
-    prev_line = line
-# Чтобы в конце точно была пустая строка
-lines_ed.append(' ')
-data_target = '\n'.join(lines_ed)
-#print(data_target)
-
-print('Count of found first strings in target: ', count_first_lines)
-
-#with open('test_result.txt', 'w', encoding='utf8') as file5:
-#    file5.write(data_target)
-
-# Первый проход - добавляем @@PLACE на месте новых binding
-data_target_tuple = re.subn(r'\n\n[^\S\r\n]{4}@{4}', r'\n\n"""\n@@PLACE\n\n\n"""\n    ', data_target)
-#print(data_target_tuple[0])
-data_target = data_target_tuple[0]
-print('Added @@PLACE: ', data_target_tuple[1])
-
-# Удаляем метки @@@@
-data_target_tuple = re.subn(r'@{4}', r'', data_target)
-data_target = data_target_tuple[0]
-print('Removed @@@@: ', data_target_tuple[1])
-
-#with open('test_result4.txt', 'w', encoding='utf8') as file4:
-#    file4.write(data_target)
-
-all_done = False
-replace_count = 0
-replaces = {}
-
-# Заменяем @@PLACE на ближайший binding, пока не заменим все 
-# (в случае множественных блоков нужно проходить неограниченное количество раз)
-while not all_done:
-    data_target_tuple = re.subn(r'@@PLACE(?P<group1>[\s\S]*?)\"\"\"\n(?P<group2>[^\s@].*?)\n', 
-                r'\2\1"""\n\2\n', 
-                data_target)
+# Количество процессов в пакетном режиме (None - по числу ядер процессора)
+JOBS = None
+# Хранить разобранные файлы нового формата в кэше (см. docstring_index.py)
+USE_INDEX_CACHE = True
+
+# Функция конвертирует один файл: source - новый формат, target - старый формат, converted_file - куда записать результат
+# Все сообщения выводятся через log (по умолчанию print), в пакетном режиме они собираются в список.
+# Возвращает отчет: счетчики и список нерешенных случаев с номерами строк (с 1) в файле результата
+def convert_docstrings(source, target, converted_file, log=print, cache_dir=CACHE_DIR):
+    # Файл с новым форматом разбираем один раз и берем из кэша (см. docstring_index.py)
+    source_index = load_index(source, cache_dir=cache_dir)
+
+    # Считаем кавычки и объекты 
+    count_quotes = source_index.quote_count
+    count_quotes_source = count_quotes
+    log()
+    log('Count of """ in source: ', count_quotes)
+    log('Count of objects in source: ', count_quotes/2)
+
+    # Первые строки, байндинги и тайпсиги
+    list_first_string = source_index.first_lines
+
+    log('Found first strings in source: ', len(list_first_string))
+    log()
+
+    # Индекс первых строк для быстрого (и нечеткого) поиска
+    first_line_index = FirstLineIndex(list_first_string)
+
+    # Упрощенный словарь без первых строк {binding: typesig}
+    dict_source_simple = source_index.by_binding()
+
+
+    # Переходим к файлу, который нужно конвертить
+
+    with open(target, 'r', encoding='utf8') as file2:
+        data_target = file2.read()
+    #print()
+    #print('Target file:', target)
+
+    #count_to_replace = len(re.findall(r'\n\n\s\s\s\s', data_target))
+    #print('Count to replace: ', count_to_replace)
+
+    count_quotes = data_target.count('"""')
+    count_quotes_target = count_quotes
+    log('Count of """ in target: ', count_quotes)
+    log('Count of objects in target: ', count_quotes/2)
+
+    count_first_lines = 0
+
+    prev_line = '@@@@@@@@'
+
+    # Ищем первые строки и метим их
+    lines = data_target.splitlines()
+    lines_ed = []
+    for line in lines:
+        # Сразу после открывающих кавычек может быть только первая строка, поэтому здесь ищем и нечетко
+        if prev_line == '"""' and first_line_index.resolve(line[4:], fuzzy=line.startswith('    ')) is not None:
+            #print(line)
+            line_ed = re.sub(r'\s{4}', r'    @@@@', line)
+            #print(line_ed)
+            count_first_lines += 1
+        # Выкалываем некоторые случаи, где первая строка - короткое частое слово
+        # Здесь ищем только с точностью до пробелов, иначе можно разбить блок по похожей строке из описания
+        elif (prev_line == '') and (not line[4:] in ['let', '...']) and (first_line_index.resolve(line[4:], fuzzy=False) is not None):
+            #print(line)
+            line_ed = re.sub(r'\s{4}', r'    @@@@', line)
+            #print(line_ed)
+            count_first_lines += 1
+        else: line_ed = line
+        lines_ed.append(line_ed)
+        prev_line = line
+    # Чтобы в конце точно была пустая строка
+    lines_ed.append(' ')
+    data_target = '\n'.join(lines_ed)
+    #print(data_target)
+
+    log('Count of found first strings in target: ', count_first_lines)
+
+    #with open('test_result.txt', 'w', encoding='utf8') as file5:
+    #    file5.write(data_target)
+
+    # Первый проход - добавляем @@PLACE на месте новых binding
+    data_target_tuple = re.subn(r'\n\n[^\S\r\n]{4}@{4}', r'\n\n"""\n@@PLACE\n\n\n"""\n    ', data_target)
+    #print(data_target_tuple[0])
     data_target = data_target_tuple[0]
-    replace_count += data_target_tuple[1]
-    if data_target_tuple[1] == 0:
-        all_done = True
-
-print('Replaced @@PLACE: ', replace_count)
-
-#print(data_target)
-
-count_check = len(re.findall(r'@@PLACE', data_target))
-print('Count check: ', count_check)
-
-count_quotes = len(re.findall(r'"""', data_target))
-print('Count of """ after replaces: ', count_quotes)
-print('Count of objects after replaces: ', count_quotes/2)
-print()
-
-#with open('test_result5.txt', 'w', encoding='utf8') as file5:
-#    file5.write(data_target)
-
-lines = data_target.splitlines()
-#print(lines[0:5])
-#lines.insert(2, 'test')
-#print(lines[0:5])
-
-prev = ''
-i = 0
-cur_binding = '@@@'
-cur_typesig = '@@@'
-binding_added = 0
-typesig_added = 0
-count_bad = 0
-count_reverse = 0
-count_normal = 0
-count_exception = 0
-
-# Делаем замены под новый формат
-while i < len(lines):
-    if lines[i].startswith('    ') and prev == '"""':
-        #print('first line:', lines[i][4:])
-        cur_first_line = lines[i][4:]
-        cur_binding = dict_source[cur_first_line]['binding']
-        #print(cur_binding)
-        cur_typesig = dict_source[cur_first_line]['typesig']
-        #print(cur_typesig)
-    
-    #if lines[i].endswith(cur_binding) and prev == '"""':
-    # Новый binding является частью старого
-    elif (lines[i][:3] != '   ') and (prev == '"""') and (cur_binding in lines[i]):
-        #print()
-        #print('Found binding:', lines[i])
-        lines[i] = '@binding: ' + cur_binding
-        binding_added += 1
-        lines.insert(i+1, '@typesig: ' + cur_typesig)
-        typesig_added += 1
-        count_normal += 1
-        #print()
-        #print('Found without spaces')
-    
-    # Старый binding является частью нового
-    elif (lines[i][:3] != '   ') and (prev == '"""') and (lines[i] in cur_binding):
-        #print('cur_binding: ', cur_binding)
-        #print('lines[i]: ', lines[i])
-        lines[i] = '@binding: ' + cur_binding
-        binding_added += 1
-        lines.insert(i+1, '@typesig: ' + cur_typesig)
-        typesig_added += 1
-        count_reverse += 1
-    
-    # Прочие случаи
-    elif (lines[i][:3] != '   ') and (prev == '"""') and (not lines[i] in list_first_string):
-        if lines[i] in dict_source_simple:
-            new_binding = lines[i]
-            new_typesig = dict_source_simple[lines[i]]
-            #print()
-            #print('new_binding', new_binding)
-            #print('new_typesig', new_typesig)
-            lines[i] = '@binding: ' + new_binding
-            binding_added += 1
-            lines.insert(i+1, '@typesig: ' + new_typesig)
-            typesig_added += 1
-            count_exception += 1
-        else:
-            #print()
+    count_places = data_target_tuple[1]
+    log('Added @@PLACE: ', data_target_tuple[1])
+
+    # Удаляем метки @@@@
+    data_target_tuple = re.subn(r'@{4}', r'', data_target)
+    data_target = data_target_tuple[0]
+    log('Removed @@@@: ', data_target_tuple[1])
+
+    #with open('test_result4.txt', 'w', encoding='utf8') as file4:
+    #    file4.write(data_target)
+
+    # Заменяем @@PLACE на ближайший binding за один проход (см. resolve_places)
+    data_target, replace_count = resolve_places(data_target)
+
+    log('Replaced @@PLACE: ', replace_count)
+
+    #print(data_target)
+
+    count_check = data_target.count('@@PLACE')
+    log('Count check: ', count_check)
+
+    count_quotes = data_target.count('"""')
+    log('Count of """ after replaces: ', count_quotes)
+    log('Count of objects after replaces: ', count_quotes/2)
+    log()
+
+    #with open('test_result5.txt', 'w', encoding='utf8') as file5:
+    #    file5.write(data_target)
+
+    lines = data_target.splitlines()
+    #print(lines[0:5])
+    #lines.insert(2, 'test')
+    #print(lines[0:5])
+
+    # Выравниваем блоки результата с блоками источника по нормализованным первым строкам (см. align_blocks)
+    # Номер блока для каждой первой строки блока считаем здесь один раз по исходным строкам: в основном цикле
+    # строки уже переписываются (""" может стать binding), и счет блоков там разошелся бы с выравниванием
+    target_first_lines = []
+    block_numbers = {}
+    prev = ''
+    for n, line in enumerate(lines):
+        if line.startswith('    ') and prev == '"""':
+            block_numbers[n] = len(target_first_lines)
+            target_first_lines.append(first_line_index.resolve(line[4:]))
+        prev = line
+    source_keys = [normalize_line(first_line) for first_line in list_first_string]
+    target_keys = [None if resolved is None else normalize_line(resolved) for resolved in target_first_lines]
+    alignment = align_blocks(target_keys, source_keys)
+
+    # Сколько раз каждый ключ встречается в файлах: уникальные выровнены однозначно, остальные - по порядку блоков
+    source_key_counts = {}
+    for key in source_keys:
+        source_key_counts[key] = source_key_counts.get(key, 0) + 1
+    target_key_counts = {}
+    for key in target_keys:
+        target_key_counts[key] = target_key_counts.get(key, 0) + 1
+
+    prev = ''
+    cur_binding = '@@@'
+    cur_typesig = '@@@'
+    cur_confidence = 0.0
+    cur_aligned = False
+    binding_added = 0
+    typesig_added = 0
+    count_bad = 0
+    count_reverse = 0
+    count_normal = 0
+    count_exception = 0
+    count_fuzzy = 0
+    count_mismatch = 0
+    count_by_order = 0
+    count_not_aligned = 0
+    count_low = 0
+    unresolved = []
+    assignments = []
+
+    # Результат собираем в новый список только добавлением в конец:
+    # вставка @typesig в середину исходного списка сдвигала бы весь хвост списка на каждом binding
+    lines_out = []
+
+    # Делаем замены под новый формат
+    for n, line in enumerate(lines):
+        # Номер строки в результате (для сообщений)
+        i = len(lines_out)
+        new_typesig = None
+        block = block_numbers.get(n)
+
+        if block is not None:
+            #print('first line:', line[4:])
+            cur_binding = '@@@'
+            cur_typesig = '@@@'
+            cur_aligned = False
+            cur_first_line = target_first_lines[block]
+            source_block = alignment[block]
+            if cur_first_line is None:
+                log('First line not found:', line[4:])
+                unresolved.append({'kind': 'first_line_not_found', 'line': i + 1, 'text': line})
+            elif source_block is None:
+                # Первая строка есть в источнике, но ее блок уже занят или идет не по порядку
+                log('Block not aligned:', line[4:])
+                unresolved.append({'kind': 'block_not_aligned', 'line': i + 1, 'text': line})
+                count_not_aligned += 1
+            else:
+                cur_aligned = True
+                cur_binding = source_index.bindings[source_block]
+                cur_typesig = source_index.typesigs[source_block]
+                key = target_keys[block]
+                if source_key_counts[key] == 1 and target_key_counts[key] == 1:
+                    cur_confidence = CONFIDENCE_UNIQUE
+                else:
+                    cur_confidence = CONFIDENCE_ORDER
+                    count_by_order += 1
+                if cur_first_line != line[4:]:
+                    log('Fuzzy first line:', line[4:], '->', cur_first_line)
+                    cur_confidence *= CONFIDENCE_FUZZY
+                    count_fuzzy += 1
+
+        # Строка старого binding после закрывающих кавычек: binding берем из выровненного блока источника,
+        # а по старому binding только оцениваем уверенность
+        elif (line[:3] != '   ') and (prev == '"""') and cur_aligned \
+                and (cur_binding in line or line in cur_binding or not line in first_line_index):
+            factor, case = binding_evidence(line, cur_binding)
+            if case == 'normal':
+                count_normal += 1
+            elif case == 'reverse':
+                count_reverse += 1
+            else:
+                count_mismatch += 1
+            confidence = cur_confidence * factor
+            if confidence < MIN_CONFIDENCE:
+                log('Low confidence:', line, '->', cur_binding, '{:.2f}'.format(confidence))
+                unresolved.append({'kind': 'low_confidence', 'line': i + 1, 'text': line, 'binding': cur_binding,
+                                   'confidence': confidence})
+                count_low += 1
+            assignments.append({'line': i + 1, 'binding': cur_binding, 'typesig': cur_typesig,
+                                'confidence': confidence})
+            line = '@binding: ' + cur_binding
+            new_typesig = cur_typesig
+            cur_aligned = False
+
+        # Блок не выровнен: ищем старый binding среди binding источника
+        elif (line[:3] != '   ') and (prev == '"""') and (not line in first_line_index):
+            if line in dict_source_simple:
+                #print()
+                #print('new_binding', line)
+                #print('new_typesig', dict_source_simple[line])
+                new_typesig = dict_source_simple[line]
+                assignments.append({'line': i + 1, 'binding': line, 'typesig': new_typesig,
+                                    'confidence': CONFIDENCE_EXCEPTION})
+                line = '@binding: ' + line
+                count_exception += 1
+            else:
+                #print()
+                #print('cur_first_line: ', cur_first_line)
+                #print('cur_binding: ', cur_binding)
+                log('Binding not found for:', line)
+                unresolved.append({'kind': 'binding_not_found', 'line': i + 1, 'text': line})
+                count_bad += 1
+        elif (prev == '"""'):
+            log('Also check line:')
+            log(line)
+            log('Line: ', i)
+            unresolved.append({'kind': 'check_line', 'line': i + 1, 'text': line})
             #print('cur_first_line: ', cur_first_line)
             #print('cur_binding: ', cur_binding)
-            print('Binding not found for:', lines[i])
-            count_bad += 1
-    elif (prev == '"""'):
-        print('Also check line:')
-        print(lines[i])
-        print('Line: ', i)
-        #print('cur_first_line: ', cur_first_line)
-        #print('cur_binding: ', cur_binding)
-        #print()
+            #print()
     
-    prev = lines[i]
-    i += 1
-
-print()
-print('count_normal:', count_normal)
-print('count_reverse:', count_reverse)
-print('count_exception:', count_exception)
-print('count_bad:', count_bad)
-
-converted_file = 'converted_' + file_name
-with open(converted_file, 'w', encoding='utf8', newline='\u000A') as file3:
-    file3.write('\n'.join(lines))
-
-print('Binding added:', binding_added)
-print('Typesig added:', typesig_added)
-print('Result: ', converted_file)
\ No newline at end of file
+        lines_out.append(line)
+        prev = line
+        if new_typesig is not None:
+            binding_added += 1
+            line = '@typesig: ' + new_typesig
+            lines_out.append(line)
+            typesig_added += 1
+            prev = line
+
+    log()
+    log('count_normal:', count_normal)
+    log('count_reverse:', count_reverse)
+    log('count_exception:', count_exception)
+    log('count_bad:', count_bad)
+    if count_mismatch > 0:
+        log('count_mismatch:', count_mismatch)
+    if count_by_order > 0:
+        log('Aligned by order:', count_by_order)
+    if count_not_aligned > 0:
+        log('Not aligned:', count_not_aligned)
+    if count_fuzzy > 0:
+        log('Fuzzy count:', count_fuzzy)
+    if count_low > 0:
+        log('Low confidence count:', count_low)
+
+    with open(converted_file, 'w', encoding='utf8', newline='\u000A') as file3:
+        file3.write('\n'.join(lines_out))
+
+    log('Binding added:', binding_added)
+    log('Typesig added:', typesig_added)
+    log('Result: ', converted_file)
+
+    # Отчет по файлу для пакетного режима
+    return {
+        'source': source,
+        'target': target,
+        'result': converted_file,
+        'counts': {
+            'quotes_source': count_quotes_source,
+            'first_strings_source': len(list_first_string),
+            'quotes_target': count_quotes_target,
+            'first_strings_target': count_first_lines,
+            'places_added': count_places,
+            'places_replaced': replace_count,
+            'places_left': count_check,
+            'normal': count_normal,
+            'reverse': count_reverse,
+            'exception': count_exception,
+            'bad': count_bad,
+            'fuzzy': count_fuzzy,
+            'mismatch': count_mismatch,
+            'by_order': count_by_order,
+            'not_aligned': count_not_aligned,
+            'low_confidence': count_low,
+            'binding_added': binding_added,
+            'typesig_added': typesig_added,
+        },
+        'unresolved': unresolved,
+        'assignments': assignments,
+    }
+
+
+# ПАКЕТНЫЙ РЕЖИМ
+
+# Функция для пула процессов: конвертирует пару файлов и возвращает отчет вместе с сообщениями
+def convert_task(task):
+    source, target, converted_file, cache_dir = task
+    messages = []
+    def log(*args):
+        messages.append(' '.join(str(arg) for arg in args))
+    report = convert_docstrings(source, target, converted_file, log=log, cache_dir=cache_dir)
+    report['messages'] = messages
+    return report
+
+# Функция находит пары файлов с одинаковыми именами в папках source_dir (новый формат) и target_dir (старый формат)
+# Возвращает список имен пар и списки имен файлов, которые есть только в одной из папок
+def pair_files(source_dir, target_dir, extension='.md'):
+    source_names = {name for name in os.listdir(source_dir) if name.endswith(extension)}
+    target_names = {name for name in os.listdir(target_dir) if name.endswith(extension)}
+    return (sorted(source_names & target_names),
+            sorted(source_names - target_names),
+            sorted(target_names - source_names))
+
+# Функция конвертирует все пары файлов из двух папок в пуле процессов и пишет общий отчет в JSON
+# Возвращает общий отчет
+def convert_batch(source_dir, target_dir, output_dir, report_file, jobs, cache_dir=CACHE_DIR):
+    names, only_source, only_target = pair_files(source_dir, target_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    tasks = [(os.path.join(source_dir, name), os.path.join(target_dir, name), os.path.join(output_dir, name), cache_dir)
+             for name in names]
+
+    if jobs <= 1 or len(tasks) <= 1:
+        reports = [convert_task(task) for task in tasks]
+    else:
+        with multiprocessing.Pool(processes=jobs) as pool:
+            reports = pool.map(convert_task, tasks)
+
+    unresolved_count = len(only_target)
+    for name, report in zip(names, reports):
+        report['file'] = name
+        unresolved_count += len(report['unresolved']) + report['counts']['places_left']
+        print(name + ':', 'normal', report['counts']['normal'], 'reverse', report['counts']['reverse'],
+              'exception', report['counts']['exception'], 'bad', report['counts']['bad'],
+              'unresolved', len(report['unresolved']))
+
+    # Файлы старого формата без пары в новом формате сконвертировать нельзя - это тоже нерешенные случаи
+    for name in only_target:
+        print('No source file for:', name)
+
+    batch_report = {
+        'source_dir': source_dir,
+        'target_dir': target_dir,
+        'output_dir': output_dir,
+        'files': reports,
+        'only_source': only_source,
+        'only_target': only_target,
+        'unresolved_total': unresolved_count,
+    }
+    with open(report_file, 'w', encoding='utf8') as file:
+        json.dump(batch_report, file, ensure_ascii=False, indent=1)
+
+    print('Files converted:', len(reports))
+    print('Unresolved total:', unresolved_count)
+    print('Report:', report_file)
+    return batch_report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Конвертация переведенных docstrings из старого формата в новый')
+    parser.add_argument('--source-dir', help='папка с файлами нового формата (пакетный режим)')
+    parser.add_argument('--target-dir', help='папка с переведенными файлами старого формата (пакетный режим)')
+    parser.add_argument('--output-dir', default='converted_docstrings',
+                        help='папка для результатов в пакетном режиме (по умолчанию converted_docstrings)')
+    parser.add_argument('--report', default='convert_docstrings_report.json',
+                        help='файл общего отчета в пакетном режиме (по умолчанию convert_docstrings_report.json)')
+    parser.add_argument('-j', '--jobs', type=int, default=JOBS,
+                        help='количество процессов в пакетном режиме (по умолчанию - по числу ядер процессора)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='не использовать кэш разобранных файлов нового формата')
+    args = parser.parse_args()
+    cache_dir = CACHE_DIR if (USE_INDEX_CACHE and not args.no_cache) else None
+
+    # Без параметров конвертируем один файл file_name из source_path и target_path, как раньше
+    if args.source_dir is None and args.target_dir is None:
+        source = os.path.normpath(source_path) + '\\' + file_name
+        target = os.path.normpath(target_path) + '\\' + file_name
+        convert_docstrings(source, target, 'converted_' + file_name, cache_dir=cache_dir)
+        return 0
+
+    if args.source_dir is None or args.target_dir is None:
+        parser.error('для пакетного режима нужны обе папки: --source-dir и --target-dir')
+
+    jobs = args.jobs or os.cpu_count() or 1
+    batch_report = convert_batch(args.source_dir, args.target_dir, args.output_dir, args.report, jobs, cache_dir)
+    # Ненулевой код возврата, если остались нерешенные случаи (для запуска из сборки)
+    return 1 if batch_report['unresolved_total'] > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,175 @@
+"""
+Индекс docstrings в "новом" формате (см. convert_docstrings.py)
+
+Файл нового формата состоит из блоков вида:
+\"\"\"
+    первая строка
+    описание...
+\"\"\"
+@binding: Base.foo
+@typesig: Tuple{Any}
+
+Разбор большого файла регуляркой занимает заметное время, а при конвертации нескольких файлов
+по одному и тому же источнику он повторялся каждый раз. Здесь файл разбирается один раз в компактное
+хранилище записей (первая строка, binding, typesig, смещения блока в байтах), которое сохраняется
+в бинарный кэш. Имя файла кэша - хэш пути к файлу-источнику и хэш его содержимого, в самом кэше записана
+версия формата, поэтому при изменении источника или формата индекса кэш просто пересобирается.
+Битый или несовместимый файл кэша тоже просто пересобирается, а при сохранении нового индекса
+старые файлы кэша того же источника удаляются, так что кэш не растет с каждой правкой источника.
+
+Использование из других скриптов:
+from docstring_index import load_index
+index = load_index(path)
+
+Запуск из командной строки (построить кэш и вывести количество записей):
+python docstring_index.py <файл нового формата>
+"""
+
+import os
+import re
+import sys
+import time
+import pickle
+import hashlib
+from collections import namedtuple
+
+# Чтение файла-источника - то же, что в convert_adoc.py (mmap и универсальные переводы строк)
+from convert_adoc import decode_text, map_file
+
+# Версия формата индекса. Увеличиваем при любом изменении разбора или состава записей
+INDEX_VERSION = 1
+# Папка для кэша индексов (рядом со скриптом)
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.docstring_index_cache')
+
+# Регулярка для блоков нового формата (та же, что была в convert_docstrings.py)
+docstring_pattern = re.compile(r'"""\n(\s{4})?(?P<group1>.*?)\n(?P<group2>[\s\S]*?)"""\n@binding:\s(?P<group3>.*?)\n@typesig:\s(?P<group4>.*?)\n')
+
+# Одна запись индекса: начало и конец блока - смещения в байтах UTF-8 в тексте с переводами строк \n
+DocstringRecord = namedtuple('DocstringRecord', ['first_line', 'binding', 'typesig', 'start', 'end'])
+
+
+# Индекс хранится по столбцам (отдельный список на каждое поле), так он компактнее и быстрее сохраняется
+class DocstringIndex:
+    def __init__(self, source_hash, quote_count, first_lines, bindings, typesigs, starts, ends):
+        self.source_hash = source_hash
+        # Количество """ в файле (выводится при конвертации)
+        self.quote_count = quote_count
+        self.first_lines = first_lines
+        self.bindings = bindings
+        self.typesigs = typesigs
+        self.starts = starts
+        self.ends = ends
+
+    def __len__(self):
+        return len(self.first_lines)
+
+    def __iter__(self):
+        for i in range(len(self.first_lines)):
+            yield self.record(i)
+
+    def record(self, i):
+        return DocstringRecord(self.first_lines[i], self.bindings[i], self.typesigs[i], self.starts[i], self.ends[i])
+
+    # Словарь {первая строка: {'binding': ..., 'typesig': ...}}, при повторах первой строки берется последняя
+    def by_first_line(self):
+        return {first_line: {'binding': binding, 'typesig': typesig}
+                for first_line, binding, typesig in zip(self.first_lines, self.bindings, self.typesigs)}
+
+    # Словарь {binding: typesig}, при повторах binding берется последний
+    def by_binding(self):
+        return dict(zip(self.bindings, self.typesigs))
+
+    # Разбираем текст файла нового формата
+    @classmethod
+    def parse(cls, data, source_hash=None):
+        first_lines, bindings, typesigs, starts, ends = [], [], [], [], []
+        # Смещения в байтах считаем по ходу разбора, кодируя только куски между соседними блоками
+        pos = 0
+        byte_pos = 0
+        for m in docstring_pattern.finditer(data):
+            start, end = m.span()
+            byte_pos += len(data[pos:start].encode('utf8'))
+            starts.append(byte_pos)
+            byte_pos += len(data[start:end].encode('utf8'))
+            ends.append(byte_pos)
+            pos = end
+            first_lines.append(m.group('group1'))
+            bindings.append(m.group('group3'))
+            typesigs.append(m.group('group4'))
+        return cls(source_hash, data.count('"""'), first_lines, bindings, typesigs, starts, ends)
+
+    def to_state(self):
+        return (INDEX_VERSION, self.source_hash, self.quote_count,
+                self.first_lines, self.bindings, self.typesigs, self.starts, self.ends)
+
+    @classmethod
+    def from_state(cls, state):
+        if not isinstance(state, tuple) or not state or state[0] != INDEX_VERSION:
+            raise ValueError('Unsupported docstring index version')
+        return cls(*state[1:])
+
+
+# Файл кэша: <хэш пути к источнику>.<хэш содержимого>.idx
+def cache_path(path_key, source_hash, cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, path_key + '.' + source_hash + '.idx')
+
+# Функция возвращает короткий ключ файла-источника по его абсолютному пути (префикс имен его файлов кэша)
+def source_path_key(path):
+    return hashlib.sha256(os.path.abspath(path).encode('utf8', 'surrogateescape')).hexdigest()[:16]
+
+# Функция возвращает индекс файла path: из кэша, если он есть и подходит, иначе разбирает файл и сохраняет кэш
+# Файл отображается в память, хэш считается прямо по нему: при попадании в кэш файл не копируется и не декодируется.
+# cache_dir=None - без кэша
+def load_index(path, cache_dir=CACHE_DIR):
+    with open(path, 'rb') as file, map_file(file) as raw:
+        source_hash = hashlib.sha256(raw).hexdigest()
+
+        if cache_dir is not None:
+            path_key = source_path_key(path)
+            cached = cache_path(path_key, source_hash, cache_dir)
+            if os.path.exists(cached):
+                # Любая ошибка чтения или разбора кэша (битый файл, состояние другой версии) - пересобираем индекс
+                try:
+                    with open(cached, 'rb') as cache_file:
+                        index = DocstringIndex.from_state(pickle.load(cache_file))
+                    if index.source_hash == source_hash:
+                        return index
+                except (OSError, ValueError, TypeError, AttributeError, KeyError, ImportError, EOFError,
+                        pickle.UnpicklingError):
+                    pass
+
+        data = decode_text(raw)
+
+    index = DocstringIndex.parse(data, source_hash)
+    del data
+    if cache_dir is not None:
+        save_index(index, path_key, cache_dir)
+        prune_cache(path_key, index.source_hash, cache_dir)
+    return index
+
+# Кэш пишем через временный файл, чтобы параллельные запуски не прочитали недописанный
+def save_index(index, path_key, cache_dir=CACHE_DIR):
+    os.makedirs(cache_dir, exist_ok=True)
+    cached = cache_path(path_key, index.source_hash, cache_dir)
+    tmp_path = cached + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        pickle.dump(index.to_state(), file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cached)
+
+# Функция удаляет файлы кэша того же источника (path_key) с другим содержимым - они устарели
+# Файл, который уже удалил параллельный запуск, пропускаем
+def prune_cache(path_key, source_hash, cache_dir=CACHE_DIR):
+    current = os.path.basename(cache_path(path_key, source_hash, cache_dir))
+    for name in os.listdir(cache_dir):
+        if name.startswith(path_key + '.') and name.endswith('.idx') and name != current:
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except FileNotFoundError:
+                pass
+
+
+if __name__ == '__main__':
+    for path in sys.argv[1:]:
+        start = time.perf_counter()
+        index = load_index(path)
+        print(path + ':', len(index), 'docstrings,', '{:.3f} s'.format(time.perf_counter() - start))
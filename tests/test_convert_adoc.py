@@ -0,0 +1,215 @@
+"""
+Регрессионные тесты convert_adoc.py
+
+Страницы в fixtures/kramdoc сконвертированы исходной версией скрипта (до переделок под производительность),
+результат лежит в fixtures/expected. Любое расхождение с ним - изменение поведения конвертации.
+Единственное намеренное расхождение (escaped_brackets по областям документа, см. RTFM-687) проверяется отдельно.
+
+Запуск из корня репозитория:
+python -m unittest discover tests
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import convert_adoc
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+SOURCE_DIR = os.path.join(FIXTURES, 'kramdoc')
+EXPECTED_DIR = os.path.join(FIXTURES, 'expected')
+
+
+# Файлы читаем без преобразования переводов строк, чтобы сравнение было байт в байт
+def read_text(path):
+    with open(path, 'r', encoding='utf8', newline='') as file:
+        return file.read()
+
+def write_text(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf8', newline='') as file:
+        file.write(text)
+
+# Пути страниц-образцов относительно fixtures/kramdoc
+def fixture_pages():
+    pages = []
+    for root, _, files in os.walk(SOURCE_DIR):
+        for file_name in sorted(files):
+            pages.append(os.path.relpath(os.path.join(root, file_name), SOURCE_DIR).replace('\\', '/'))
+    return sorted(pages)
+
+
+# Тесты меняют режим правил через configure - после каждого теста возвращаем настройки как были
+class ConfigureMixin:
+    def setUp(self):
+        saved = (convert_adoc.HARDENED_RULES, convert_adoc.TIME_BUDGET, convert_adoc.LITERAL_PREFILTER)
+        self.addCleanup(convert_adoc.configure, saved[0], saved[1] or 0, saved[2])
+
+
+class ConvertTextTest(ConfigureMixin, unittest.TestCase):
+    def test_fixture_pages_exist(self):
+        self.assertEqual(fixture_pages(), ['index.adoc', 'manual/strings.adoc', 'stdlib/Markdown.adoc'])
+
+    # Результат совпадает с исходной версией скрипта во всех режимах правил
+    def test_matches_baseline_output(self):
+        for hardened in (True, False):
+            for prefilter in (True, False):
+                convert_adoc.configure(hardened_rules=hardened, literal_prefilter=prefilter)
+                for rel_path in fixture_pages():
+                    with self.subTest(page=rel_path, hardened=hardened, prefilter=prefilter):
+                        expected = read_text(os.path.join(EXPECTED_DIR, convert_adoc.target_rel_path(rel_path)))
+                        text = read_text(os.path.join(SOURCE_DIR, rel_path))
+                        self.assertEqual(convert_adoc.convert_text(text, rel_path), expected)
+
+    # Переводы строк \r\n приводятся к \n, как при чтении файла
+    def test_crlf_source(self):
+        rel_path = 'manual/strings.adoc'
+        expected = read_text(os.path.join(EXPECTED_DIR, rel_path))
+        text = read_text(os.path.join(SOURCE_DIR, rel_path)).replace('\n', '\r\n')
+        self.assertEqual(convert_adoc.convert_text(text, rel_path), expected)
+
+    # То же через convert_texts в пуле процессов: пары возвращаются в исходном порядке
+    def test_convert_texts(self):
+        pairs = [(rel_path, read_text(os.path.join(SOURCE_DIR, rel_path))) for rel_path in fixture_pages()]
+        results = list(convert_adoc.convert_texts(pairs, jobs=2, batch_size=1))
+        self.assertEqual([rel_path for rel_path, _ in results],
+                         [convert_adoc.target_rel_path(rel_path) for rel_path, _ in pairs])
+        for rel_path, text in results:
+            self.assertEqual(text, read_text(os.path.join(EXPECTED_DIR, rel_path)))
+
+    # Намеренное отличие от исходной версии: \] снимается везде, кроме ссылок и пропусков +++ (RTFM-687)
+    def test_escaped_brackets_by_region(self):
+        text = ('footnote:[text \\] more] and `x\\])`\n'
+                'xref:./base.adoc#Base.getindex[`A[i\\]`] and link:./a.md[`f(x\\])`]\n'
+                '+++a\\]+++\n')
+        expected = ('footnote:[text ] more] and `x])`\n'
+                    'xref:./base.adoc#Base.getindex[`A[i\\]`] and xref:././a.adoc[`f(x\\])`]\n'
+                    '+++a\\]+++\n')
+        self.assertEqual(convert_adoc.convert_text(text, 'manual/strings.adoc'), expected)
+
+    # Текст, который не уложился в бюджет времени, возвращается как есть
+    def test_time_budget_returns_source(self):
+        convert_adoc.configure(time_budget=1e-9)
+        records = []
+        text = read_text(os.path.join(SOURCE_DIR, 'manual/strings.adoc')).replace('\n', '\r\n')
+        self.assertEqual(convert_adoc.convert_text(text, 'manual/strings.adoc', records), text)
+        self.assertEqual(len(records), 1)
+
+
+# Инкрементальная конвертация дерева: пропуск неизмененных файлов и удаление результатов удаленных источников
+class ManifestTest(ConfigureMixin, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        self.source = os.path.join(root, 'kramdoc')
+        self.output = os.path.join(root, 'output')
+        shutil.copytree(SOURCE_DIR, self.source)
+        with open(os.path.join(self.source, 'manual', 'image.png'), 'wb') as file:
+            file.write(b'\x89PNGdata')
+
+    def convert(self, **kwargs):
+        return convert_adoc.convert_tree(self.source, self.output, jobs=1, **kwargs)
+
+    def manifest(self):
+        return convert_adoc.load_manifest(self.output)
+
+    def test_first_run_converts_all(self):
+        result = self.convert()
+        self.assertEqual((result['converted'], result['skipped'], result['removed']), (3, 0, 0))
+        for rel_path in fixture_pages():
+            target_rel_path = convert_adoc.target_rel_path(rel_path)
+            self.assertEqual(read_text(os.path.join(self.output, target_rel_path)),
+                             read_text(os.path.join(EXPECTED_DIR, target_rel_path)))
+        self.assertEqual(sorted(self.manifest()),
+                         ['_index.adoc', 'manual/image.png', 'manual/strings.adoc', 'stdlib/Markdown.adoc'])
+
+    def test_unchanged_files_are_skipped(self):
+        self.convert()
+        manifest = self.manifest()
+        result = self.convert()
+        self.assertEqual((result['converted'], result['skipped'], result['removed']), (0, 4, 0))
+        self.assertEqual(self.manifest(), manifest)
+
+    # Новое время изменения при том же содержимом: файл читается, но по хэшу не конвертируется
+    def test_touched_file_is_skipped_by_hash(self):
+        self.convert()
+        source_file = os.path.join(self.source, 'manual', 'strings.adoc')
+        stat = os.stat(source_file)
+        os.utime(source_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        result = self.convert()
+        self.assertEqual((result['converted'], result['skipped']), (0, 4))
+        self.assertEqual(self.manifest()['manual/strings.adoc']['mtime'], stat.st_mtime_ns + 10 ** 9)
+
+    def test_changed_file_is_converted(self):
+        self.convert()
+        source_file = os.path.join(self.source, 'manual', 'strings.adoc')
+        write_text(source_file, read_text(source_file) + '\n!!! note\n    Added.\n')
+        result = self.convert()
+        self.assertEqual((result['converted'], result['skipped']), (1, 3))
+        self.assertIn('Added.', read_text(os.path.join(self.output, 'manual', 'strings.adoc')))
+
+    # Результат, удаленный вручную, создается заново
+    def test_missing_target_is_converted(self):
+        self.convert()
+        os.remove(os.path.join(self.output, 'stdlib', 'Markdown.adoc'))
+        result = self.convert()
+        self.assertEqual((result['converted'], result['skipped']), (1, 3))
+        self.assertTrue(os.path.exists(os.path.join(self.output, 'stdlib', 'Markdown.adoc')))
+
+    # Результат удаленного источника удаляется вместе с опустевшей папкой и пропадает из манифеста
+    def test_deleted_source_is_removed(self):
+        self.convert()
+        shutil.rmtree(os.path.join(self.source, 'stdlib'))
+        result = self.convert()
+        self.assertEqual((result['converted'], result['skipped'], result['removed']), (0, 3, 1))
+        self.assertFalse(os.path.exists(os.path.join(self.output, 'stdlib')))
+        self.assertNotIn('stdlib/Markdown.adoc', self.manifest())
+
+    def test_full_converts_all(self):
+        self.convert()
+        result = self.convert(full=True)
+        self.assertEqual((result['converted'], result['skipped']), (3, 0))
+
+    # Другие правила - другой отпечаток в манифесте: все файлы .adoc конвертируются заново
+    def test_rules_change_converts_all(self):
+        self.convert()
+        manifest = self.manifest()
+        for entry in manifest.values():
+            if 'rules' in entry:
+                entry['rules'] = 'old'
+        convert_adoc.save_manifest(self.output, manifest)
+        result = self.convert()
+        self.assertEqual((result['converted'], result['skipped']), (3, 1))
+
+    def test_manifest_version_mismatch_converts_all(self):
+        self.convert()
+        write_text(os.path.join(self.output, convert_adoc.MANIFEST_FILE_NAME), '{"version": 0, "files": {}}')
+        self.assertEqual(self.manifest(), {})
+        result = self.convert()
+        self.assertEqual(result['converted'], 3)
+
+    # Файл, который не уложился в бюджет, копируется байт в байт и не попадает в манифест
+    def test_over_budget_file_is_copied_and_retried(self):
+        source_file = os.path.join(self.source, 'manual', 'strings.adoc')
+        write_text(source_file, read_text(source_file).replace('\n', '\r\n'))
+        convert_adoc.configure(time_budget=1e-9)
+        with self.assertLogs('convert_adoc', level='WARNING'):
+            result = self.convert()
+        self.assertEqual(len(result['over_budget']), 3)
+        target_file = os.path.join(self.output, 'manual', 'strings.adoc')
+        with open(source_file, 'rb') as source, open(target_file, 'rb') as target:
+            self.assertEqual(source.read(), target.read())
+        self.assertEqual(sorted(self.manifest()), ['manual/image.png'])
+
+        convert_adoc.configure(time_budget=0)
+        result = self.convert()
+        self.assertEqual((result['converted'], result['skipped']), (3, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+"""
+Регрессионные тесты convert_docstrings.py и docstring_index.py
+
+Запуск из корня репозитория:
+python -m unittest discover tests
+"""
+
+import os
+import sys
+import pickle
+import random
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import convert_docstrings
+import docstring_index
+
+
+# Блок нового формата (источник)
+def new_block(first_line, binding):
+    return '"""\n    ' + first_line + '\n\n"""\n@binding: ' + binding + '\n@typesig: T' + binding + '\n'
+
+# Блок старого формата (файл, который конвертируем): после закрывающих кавычек - старый binding
+def old_block(first_line, binding):
+    return '"""\n    ' + first_line + '\n"""\n' + binding + '\n'
+
+
+class AlignBlocksTest(unittest.TestCase):
+    # Проверяем то, что должно выполняться для любого выравнивания:
+    # совпадают только равные ключи (None - ни с чем), номера новых блоков возрастают
+    def assert_consistent(self, old_keys, new_keys, matches):
+        self.assertEqual(len(matches), len(old_keys))
+        matched = [(i, j) for i, j in enumerate(matches) if j is not None]
+        for i, j in matched:
+            self.assertIsNotNone(old_keys[i])
+            self.assertEqual(old_keys[i], new_keys[j])
+        self.assertEqual([j for _, j in matched], sorted(set(j for _, j in matched)))
+
+    def test_identical_with_duplicates(self):
+        keys = ['a', 'x', 'x', 'b', 'x']
+        self.assertEqual(convert_docstrings.align_blocks(keys, list(keys)), [0, 1, 2, 3, 4])
+
+    # Лишний повтор в новом файле остается без пары, уникальный ключ служит опорой
+    def test_extra_duplicate_in_new(self):
+        self.assertEqual(convert_docstrings.align_blocks(['x', 'u', 'x'], ['x', 'x', 'u', 'x']), [0, 2, 3])
+
+    # Повторы без уникальных ключей выравниваются по порядку
+    def test_duplicates_without_anchors(self):
+        self.assertEqual(convert_docstrings.align_blocks(['p', 'x', 'x', 'q'], ['r', 'x', 'x', 'x', 's']),
+                         [None, 1, 2, None])
+        self.assertEqual(convert_docstrings.align_blocks(['b', 'a', 'b', 'a'], ['a', 'b', 'a', 'b']),
+                         [None, 0, 1, 2])
+
+    def test_none_keys_never_match(self):
+        self.assertEqual(convert_docstrings.align_blocks(['a', None, 'a'], ['a', 'a']), [0, None, 1])
+        self.assertEqual(convert_docstrings.align_blocks([None, None], [None, None]), [None, None])
+
+    # Слишком много пар совпадающих ключей: повторы сопоставляются по номеру вхождения
+    def test_duplicates_by_occurrence(self):
+        with mock.patch.object(convert_docstrings, 'ALIGN_MAX_PAIRS', 0):
+            self.assertEqual(convert_docstrings.align_blocks(['p', 'x', 'x', 'q'], ['r', 'x', 'x', 'x', 's']),
+                             [None, 1, 2, None])
+            self.assertEqual(convert_docstrings.align_blocks(['p', 'x', 'y', 'x', 'y', 'q'],
+                                                             ['r', 'y', 'x', 'y', 'x', 's']),
+                             [None, None, 1, 2, 3, None])
+
+    def test_random_sequences_are_consistent(self):
+        rng = random.Random(1)
+        for max_pairs in (convert_docstrings.ALIGN_MAX_PAIRS, 0):
+            with mock.patch.object(convert_docstrings, 'ALIGN_MAX_PAIRS', max_pairs):
+                for _ in range(300):
+                    old_keys = [rng.choice('abc' + 'x' * 3) if rng.random() > 0.1 else None
+                                for _ in range(rng.randint(0, 20))]
+                    new_keys = [rng.choice('abcd' + 'x' * 3) for _ in range(rng.randint(0, 20))]
+                    self.assert_consistent(old_keys, new_keys, convert_docstrings.align_blocks(old_keys, new_keys))
+
+
+class ConvertDocstringsTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def convert(self, source_text, target_text):
+        source = os.path.join(self.root, 'new.md')
+        target = os.path.join(self.root, 'old.md')
+        converted_file = os.path.join(self.root, 'converted.md')
+        for path, text in ((source, source_text), (target, target_text)):
+            with open(path, 'w', encoding='utf8') as file:
+                file.write(text)
+        result = convert_docstrings.convert_docstrings(source, target, converted_file, log=lambda *args: None,
+                                                       cache_dir=None)
+        with open(converted_file, 'r', encoding='utf8') as file:
+            return file.read(), result
+
+    def bindings(self, text):
+        return [line[len('@binding: '):] for line in text.splitlines() if line.startswith('@binding: ')]
+
+    # Блоки с одинаковой первой строкой получают binding по порядку
+    def test_duplicate_first_lines(self):
+        source = new_block('Get value.', 'Base.get') + new_block('Get value.', 'Base.get!') + new_block('Other.', 'C')
+        target = old_block('Get value.', 'get') + old_block('Get value.', 'get!') + old_block('Other.', 'C')
+        text, result = self.convert(source, target)
+        self.assertEqual(self.bindings(text), ['Base.get', 'Base.get!', 'C'])
+        self.assertEqual(result['unresolved'], [])
+
+    # Строка """ сразу после закрывающих кавычек становится binding - номера следующих блоков не сдвигаются
+    def test_quotes_taken_as_binding(self):
+        source = new_block('first A', 'A') + new_block('first B', 'B') + new_block('first C', 'C')
+        target = '"""\n    first A\n"""\n' + old_block('first B', 'B') + old_block('first C', 'C')
+        text, _ = self.convert(source, target)
+        self.assertEqual(self.bindings(text), ['A', 'B', 'C'])
+        self.assertIn('@binding: C\n@typesig: TC\n', text)
+
+
+class DocstringIndexCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.cache_dir = os.path.join(self.root, 'cache')
+        self.source = os.path.join(self.root, 'new.md')
+        self.write_source(new_block('first A', 'A'))
+
+    def write_source(self, text):
+        with open(self.source, 'w', encoding='utf8') as file:
+            file.write(text)
+
+    def test_bad_cache_is_rebuilt(self):
+        index = docstring_index.load_index(self.source, self.cache_dir)
+        cache_file = os.path.join(self.cache_dir, os.listdir(self.cache_dir)[0])
+        for state in (b'garbage', pickle.dumps((docstring_index.INDEX_VERSION,)), pickle.dumps({'a': 1}),
+                      pickle.dumps((docstring_index.INDEX_VERSION + 1,) + index.to_state()[1:])):
+            with open(cache_file, 'wb') as file:
+                file.write(state)
+            self.assertEqual(docstring_index.load_index(self.source, self.cache_dir).bindings, ['A'])
+
+    # В кэше остается только индекс текущего содержимого источника
+    def test_old_entries_are_pruned(self):
+        docstring_index.load_index(self.source, self.cache_dir)
+        other = os.path.join(self.root, 'other.md')
+        shutil.copyfile(self.source, other)
+        docstring_index.load_index(other, self.cache_dir)
+        self.write_source(new_block('first A', 'A') + new_block('first B', 'B'))
+        self.assertEqual(docstring_index.load_index(self.source, self.cache_dir).bindings, ['A', 'B'])
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+        self.assertEqual(docstring_index.load_index(other, self.cache_dir).bindings, ['A'])
+
+
+if __name__ == '__main__':
+    unittest.main()